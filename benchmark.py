@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+import numpy as np
+
+# Offline benchmark suite for the localization, crop loading and evaluation code paths.
+# It runs on synthetic JPEGs with Food-101-like sizes and on the same architectures with random weights,
+# so neither the dataset nor the trained models are needed. Each benchmark runs in a fresh process to measure
+# its own peak memory. Results are written to a JSON file that can be compared with the one of another commit:
+#   python benchmark.py --output results/bench_new.json --compare results/bench_old.json
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description='offline throughput benchmarks on synthetic data')
+parser.add_argument('--images', type=int, default=20, help='number of synthetic images. Default: 20')
+parser.add_argument('--benchmarks', type=str, nargs='+', default=['localization', 'crops', 'evaluation'],
+                    help='benchmarks to run, among localization, crops and evaluation')
+parser.add_argument('--cascade', action='store_true', help='run the localization with the cascaded ensemble')
+parser.add_argument('--packing', type=int, default=0,
+                    help='run the localization with scale-mosaic packing, over groups of this many images. Default: 0 (off)')
+parser.add_argument('--tile_memory_mb', type=int,
+                    help='memory budget of the tiled FCN inference, which it enables. Default: the localization '
+                         'setting')
+parser.add_argument('--classifier', type=str, default='vgg16', help='classifier used in the evaluation benchmark')
+parser.add_argument('--output', type=str, help='JSON results file. Default: results/benchmark_<commit>_<time>.json')
+parser.add_argument('--compare', type=str, help='JSON results file of a previous run to compare with')
+parser.add_argument('--workdir', type=str, help='directory for the synthetic dataset. Default: a temporary one')
+
+
+def percentiles_ms(seconds):
+    ms = np.array(seconds) * 1000
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+    return dict(mean_ms=float(ms.mean()), p50_ms=float(p50), p90_ms=float(p90), p99_ms=float(p99))
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def benchmark_localization(workdir, images, options):
+    import ensemble_localization
+    from ensemble_localization import fcn_ensemble, process_image, process_images, select_best_crop
+
+    load_start = time.time()
+    fcns = fcn_ensemble(trained=False)
+    load_time = time.time() - load_start
+    ensemble_localization.profiler.enabled = True
+    if options.get("tile_memory_mb"):
+        ensemble_localization.TILING = True
+        ensemble_localization.tile_memory_mb = options["tile_memory_mb"]
+
+    latencies = []
+    start = time.time()
+    if options.get("packing"):
+        # latency per image of a packed group: the group time divided by its images
+        for group_start in range(0, len(images), options["packing"]):
+            group = images[group_start:group_start + options["packing"]]
+            group_time = time.time()
+            for results in process_images([(filename, (group_start + i) % 101, shape)
+                                           for i, (filename, label, shape) in enumerate(group)], fcns=fcns):
+                select_best_crop(results)
+            latencies += [(time.time() - group_time) / len(group)] * len(group)
+    else:
+        for i, (filename, label, shape) in enumerate(images):
+            image_start = time.time()
+            select_best_crop(process_image(filename, i % 101, shape, fcns=fcns, cascade=options["cascade"]))
+            latencies.append(time.time() - image_start)
+    elapsed = time.time() - start
+    return dict(images=len(images), images_sec=len(images) / elapsed, model_load_s=load_time,
+                latency=percentiles_ms(latencies), stages=ensemble_localization.profiler.report(),
+                forward_passes=dict(ensemble_localization.forward_passes))
+
+
+def benchmark_crops(workdir, images, options):
+    from evaluation import classifiers
+    from utils.crop_generator import yield_crops
+
+    _, input_size, preprocess_func, _ = classifiers[options["classifier"]]
+    generator = yield_crops(os.path.join(workdir, "cropsdata.pickle"), input_size, preprocess_func)
+    latencies = []
+    start = time.time()
+    for _ in images:
+        crop_start = time.time()
+        next(generator)
+        latencies.append(time.time() - crop_start)
+    elapsed = time.time() - start
+    return dict(images=len(images), images_sec=len(images) / elapsed, latency=percentiles_ms(latencies))
+
+
+def benchmark_evaluation(workdir, images, options):
+    from evaluation import classifiers, build_classifier, eval_on_orig_cropped_test_set
+
+    _, input_size, preprocess_func, _ = classifiers[options["classifier"]]
+    load_start = time.time()
+    clf = build_classifier(options["classifier"], trained=False)
+    load_time = time.time() - load_start
+    start = time.time()
+    # original and cropped test sets, one image per step each
+    eval_on_orig_cropped_test_set(clf, input_size, clf.get_config()['layers'][0]['config']['name'], preprocess_func,
+                                  os.path.join(workdir, "cropsdata.pickle"), steps=len(images))
+    elapsed = time.time() - start
+    return dict(images=2 * len(images), images_sec=2 * len(images) / elapsed, model_load_s=load_time)
+
+
+benchmarks = dict(localization=benchmark_localization, crops=benchmark_crops, evaluation=benchmark_evaluation)
+
+
+# Entry point of the benchmark processes: the code under test uses paths relative to the working directory
+def run_benchmark(name, workdir, images, options):
+    sys.path.insert(0, repo_dir)
+    os.chdir(workdir)
+    result = benchmarks[name](workdir, images, options)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, previous):
+    print("\nComparison with commit", previous["commit"])
+    for name, result in sorted(results["benchmarks"].items()):
+        if name not in previous["benchmarks"]:
+            continue
+        old = previous["benchmarks"][name]
+        print("{:14s} images/sec {:8.2f} -> {:8.2f} ({:+.1f}%)   peak rss {:8.0f}MB -> {:8.0f}MB".format(
+            name, old["images_sec"], result["images_sec"], (result["images_sec"] / old["images_sec"] - 1) * 100,
+            old["peak_rss_mb"], result["peak_rss_mb"]))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="benchmark_")
+
+    from utils.synthetic_dataset import create_synthetic_dataset
+    images = create_synthetic_dataset(workdir, args.images)
+
+    results = dict(commit=git_commit(), time=time.strftime("%Y-%m-%d %H:%M:%S"), host=socket.gethostname(),
+                   platform=platform.platform(), cpus=multiprocessing.cpu_count(), python=platform.python_version(),
+                   config=dict(images=args.images, classifier=args.classifier, cascade=args.cascade,
+                               packing=args.packing, tile_memory_mb=args.tile_memory_mb), benchmarks={})
+    # spawn: every benchmark gets a fresh interpreter and TensorFlow session
+    context = multiprocessing.get_context('spawn')
+    for name in args.benchmarks:
+        print("Running benchmark", name)
+        with context.Pool(1) as pool:
+            results["benchmarks"][name] = pool.apply(run_benchmark, (name, workdir, images, results["config"]))
+        print("{}: {:.2f} images/sec".format(name, results["benchmarks"][name]["images_sec"]))
+
+    output = args.output or os.path.join(repo_dir, 'results', 'benchmark_{}_{}.json'.format(
+        results["commit"], time.strftime("%Y-%m-%d_%H-%M-%S")))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as outfile:
+        json.dump(results, outfile, indent=2, sort_keys=True)
+    print("Results written in", output)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import pickle
+import random
+import argparse
+from collections import defaultdict
+import numpy as np
+import keras
+from keras import backend as K
+from keras.models import Model
+from keras.layers import Input, Lambda, AveragePooling2D, Conv2D
+from keras.preprocessing import image
+
+from ensemble_localization import fcn_ensemble, process_image, select_best_crop, crop_record, dataset_file_list, \
+    scale_pyramid, fuse_heatmaps, predict_from_filename, load_input, kernel_sizes, preprocess_func, fcn_names
+from evaluation import classifiers, build_classifier
+from utils.image_decoding import image_shape, load_crop
+from utils.labels_ix_mapping import class_name_to_idx
+from utils.classification_metrics import ClassificationMetrics
+from utils.memory_management import memory_growth_config
+from utils.weight_bundles import load_weights
+
+# Distillation of the four-FCN localization ensemble into a single convolutionalized MobileNet (the student):
+#   python distillation.py targets    # ensemble vote and score maps of every scale of the training images
+#   python distillation.py train      # student trained on the maps
+#   python distillation.py report --student <weights>   # student vs ensemble crops and downstream accuracy
+# The student heatmap grid is the one of the ensemble: its kernel is the VGG16 one (288 pixels, a 9x9 MobileNet
+# feature map averaged as in convolutionalize_vgg16), so an input of 288 + (n - 1) * 32 pixels gives n elements.
+
+parser = argparse.ArgumentParser(description='distillation of the FCN ensemble into a lightweight localizer')
+parser.add_argument('command', type=str, choices=['targets', 'train', 'report'])
+parser.add_argument('--targets', type=str, default='distillation_targets', help='ensemble maps directory')
+parser.add_argument('--set', type=str, default='train', help='dataset split of the targets. Default: train')
+parser.add_argument('--folders', type=int, default=101, help='number of class folders. Default: 101')
+parser.add_argument('--instances', type=int, default=750, help='images per class folder. Default: 750 (train), use 250 for test')
+parser.add_argument('--student', type=str, help='student weights, to resume the training or for the report')
+parser.add_argument('--epochs', type=int, default=30, help='training epochs. Default: 30')
+parser.add_argument('--batch_size', type=int, default=16, help='training batch size. Default: 16')
+parser.add_argument('--steps', type=int, default=2000, help='training steps per epoch. Default: 2000')
+parser.add_argument('--classifier', type=str, default='xception', choices=sorted(classifiers),
+                    help='classifier of the report crops. Default: xception')
+parser.add_argument('--ensemble_crops', type=str, help='cropsdata file of the ensemble, to reuse its crops in the report')
+
+student_kernel_size = kernel_sizes[0]
+student_preprocess = keras.applications.mobilenet.preprocess_input
+student_names = ["studentFCN"]
+# relative weight of the vote loss (the student argmax should be the label where the FCNs vote for it)
+# with respect to the score loss (the student label probability should be the ensemble mean one)
+vote_loss_weight = 1.
+validation_fraction = 0.05
+
+
+# Function used to convolutionalize MobileNet, starting from the ImageNet weights if no weights are given
+def student_fcn(weights_fn=None, alpha=1.0):
+    mobilenet = keras.applications.mobilenet.MobileNet(alpha=alpha, include_top=False, weights=None,
+                                                        input_shape=(None, None, 3))
+    if not weights_fn:
+        # the ImageNet weights are only available for static input shapes
+        imagenet = keras.applications.mobilenet.MobileNet(alpha=alpha, include_top=False, weights='imagenet',
+                                                           input_shape=(224, 224, 3))
+        mobilenet.set_weights(imagenet.get_weights())
+    x = AveragePooling2D(pool_size=(9, 9), strides=(1, 1))(mobilenet.output)
+    x = Conv2D(101, (1, 1), strides=(1, 1), activation='softmax', padding='valid', name="conv2d_fcn")(x)
+    student = Model(inputs=mobilenet.input, outputs=x)
+    if weights_fn:
+        load_weights(student, weights_fn)
+    return student
+
+
+# Drop-in counterpart of process_image with the student: the same results (one FCN voting) at every scale.
+# The ensemble stops at the first scale where all its FCNs agree; a single FCN always agrees with itself,
+# so the student looks at all the scales.
+def student_process_image(student, input_fn, input_cix, img_shape, upsampling_step=1.2, max_scale_factor=3.0):
+    results = []
+    if not os.path.exists(input_fn):
+        print ("The image file " + str(input_fn) + " does not exist")
+        return results
+    for scale_ix, (scale_factor, heatmap_h, heatmap_w) in enumerate(scale_pyramid(img_shape, upsampling_step,
+                                                                                   max_scale_factor)):
+        input_size = (student_kernel_size + (heatmap_h - 1) * 32, student_kernel_size + (heatmap_w - 1) * 32)
+        heatmap = predict_from_filename(student, input_fn, input_size, student_preprocess,
+                                        "predict/studentFCN/scale" + str(scale_ix))[0]
+        results.append(fuse_heatmaps([heatmap], [np.argmax(heatmap, axis=2) == input_cix], input_cix, scale_factor))
+    return results
+
+
+# Ensemble maps of every scale of an image: number of FCNs voting for the label and mean label probability,
+# i.e. the maps fused by process_image
+def ensemble_maps(fcns, input_fn, input_cix, img_shape):
+    maps = []
+    for scale_factor, heatmap_h, heatmap_w in scale_pyramid(img_shape):
+        heatmaps = [predict_from_filename(fcn, input_fn, (kernel_sizes[ix] + (heatmap_h - 1) * 32,
+                                                          kernel_sizes[ix] + (heatmap_w - 1) * 32), preprocess_func[ix],
+                                          "predict/" + fcn_names[ix])[0]
+                    for ix, fcn in enumerate(fcns)]
+        votes = np.sum([np.argmax(heatmap, axis=2) == input_cix for heatmap in heatmaps], axis=0).astype(np.uint8)
+        scores = np.mean([heatmap[:, :, input_cix] for heatmap in heatmaps], axis=0).astype(np.float16)
+        maps.append((scale_factor, votes, scores))
+    return maps
+
+
+def targets_filename(targets_dir, filename):
+    return os.path.join(targets_dir, os.path.relpath(filename, "dataset-ethz101food")) + ".npz"
+
+
+# Writes the ensemble maps of the images, one npz per image; the images with maps already written are skipped
+def generate_targets(targets_dir, file_list):
+    fcns = fcn_ensemble()
+    start = time.time()
+    for i, (filename, class_folder) in enumerate(file_list):
+        out_filename = targets_filename(targets_dir, filename)
+        if os.path.exists(out_filename):
+            continue
+        img_shape = image_shape(filename)
+        maps = ensemble_maps(fcns, filename, class_name_to_idx(class_folder), img_shape)
+        os.makedirs(os.path.dirname(out_filename), exist_ok=True)
+        arrays = {}
+        for s, (_, votes, scores) in enumerate(maps):
+            arrays["votes_" + str(s)] = votes
+            arrays["scores_" + str(s)] = scores
+        np.savez_compressed(out_filename + ".tmp.npz", filename=filename, label=class_folder, img_shape=img_shape,
+                            factors=np.array([factor for factor, _, _ in maps]), **arrays)
+        os.replace(out_filename + ".tmp.npz", out_filename)
+        if (i + 1) % 100 == 0:
+            print("{} targets of {} of {} images, {:.2f} images/sec".format(
+                time.strftime("%Y-%m-%d %H:%M:%S"), i + 1, len(file_list), (i + 1) / (time.time() - start)))
+
+
+# Training samples (filename, label index, student input size, votes, scores), one per image scale
+def load_samples(targets_dir):
+    with open("dataset-ethz101food/meta/classes.txt") as file:
+        map_label_ix = {label.strip('\n'): ix for (ix, label) in enumerate(file.readlines())}
+    samples = []
+    for root, _, files in os.walk(targets_dir):
+        for target_file in sorted(files):
+            if not target_file.endswith(".npz") or target_file.endswith(".tmp.npz"):
+                continue
+            data = np.load(os.path.join(root, target_file))
+            for s in range(len(data["factors"])):
+                votes = data["votes_" + str(s)]
+                input_size = (student_kernel_size + (votes.shape[0] - 1) * 32, student_kernel_size + (votes.shape[1] - 1) * 32)
+                samples.append((str(data["filename"]), map_label_ix[str(data["label"])], input_size, votes,
+                                data["scores_" + str(s)]))
+    return samples
+
+
+# Batches of samples with the same input size (Food-101 images share a few sizes, hence a few pyramids)
+def distillation_batches(samples, batch_size, seed=None):
+    rng = random.Random(seed)
+    buckets = defaultdict(list)
+    for sample in samples:
+        buckets[sample[2]].append(sample)
+    sizes = list(buckets)
+    weights = [len(buckets[size]) for size in sizes]
+    while True:
+        bucket = buckets[rng.choices(sizes, weights)[0]]
+        batch = rng.sample(bucket, min(batch_size, len(bucket)))
+        x = np.concatenate([load_input(filename, input_size, student_preprocess) for filename, _, input_size, _, _ in batch])
+        labels = keras.utils.to_categorical([label for _, label, _, _, _ in batch], 101)
+        scores = np.stack([scores for _, _, _, _, scores in batch]).astype(np.float32)[..., np.newaxis]
+        votes = np.stack([votes for _, _, _, votes, _ in batch]).astype(np.float32)[..., np.newaxis] / len(fcn_names)
+        yield [x, labels], [scores, votes]
+
+
+# -log of the student label probability, weighted by the fraction of FCNs voting for the label
+def vote_loss(y_true, y_pred):
+    return -K.mean(y_true * K.log(K.clip(y_pred, K.epsilon(), 1.)), axis=-1)
+
+
+# Student with a label input, whose outputs are the student label probability maps compared with the ensemble ones
+def distillation_model(student):
+    label = Input(shape=(101,), name="label")
+    label_probability = Lambda(lambda args: K.sum(args[0] * K.reshape(args[1], (-1, 1, 1, 101)), axis=-1, keepdims=True),
+                               name="label_probability")([student.output, label])
+    score = Lambda(lambda x: x, name="score")(label_probability)
+    votes = Lambda(lambda x: x, name="votes")(label_probability)
+    model = Model(inputs=[student.input, label], outputs=[score, votes])
+    model.compile(optimizer=keras.optimizers.Adam(lr=1e-4), loss={"score": "binary_crossentropy", "votes": vote_loss},
+                  loss_weights={"score": 1., "votes": vote_loss_weight})
+    return model
+
+
+def train_student(targets_dir, weights_fn, epochs, batch_size, steps):
+    samples = load_samples(targets_dir)
+    # validation on whole images: the scales of an image stay on the same side of the split
+    filenames = sorted({sample[0] for sample in samples})
+    random.Random(42).shuffle(filenames)
+    val_filenames = set(filenames[:int(len(filenames) * validation_fraction)])
+    train_samples = [sample for sample in samples if sample[0] not in val_filenames]
+    val_samples = [sample for sample in samples if sample[0] in val_filenames]
+    print("{} training and {} validation samples from {} images".format(len(train_samples), len(val_samples), len(filenames)))
+
+    timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+    os.makedirs("trained_models", exist_ok=True)
+    os.makedirs("logs", exist_ok=True)
+    student = student_fcn(weights_fn)
+    model = distillation_model(student)
+    callbacks = [keras.callbacks.ModelCheckpoint("trained_models/student_mobilenet_" + timestamp + ".hdf5",
+                                                 monitor='val_loss', save_best_only=True, save_weights_only=True),
+                 keras.callbacks.EarlyStopping(monitor='val_loss', patience=4),
+                 keras.callbacks.ReduceLROnPlateau(monitor='val_loss', factor=0.2, patience=2),
+                 keras.callbacks.CSVLogger("logs/student_mobilenet_" + timestamp + ".csv")]
+    return model.fit_generator(distillation_batches(train_samples, batch_size),
+                               steps_per_epoch=steps, epochs=epochs,
+                               validation_data=distillation_batches(val_samples, batch_size, seed=0),
+                               validation_steps=max(1, len(val_samples) // batch_size // 4),
+                               callbacks=callbacks)
+
+
+# Intersection over union of two square crop rects
+def rect_iou(rect_a, rect_b):
+    (top_a, left_a), side_a = rect_a["lower_left"], rect_a["side"]
+    (top_b, left_b), side_b = rect_b["lower_left"], rect_b["side"]
+    h = max(0, min(top_a + side_a, top_b + side_b) - max(top_a, top_b))
+    w = max(0, min(left_a + side_a, left_b + side_b) - max(left_a, left_b))
+    return float(h * w) / (side_a ** 2 + side_b ** 2 - h * w)
+
+
+# Student vs ensemble crops on the images: localization time, rect agreement and accuracy of a classifier on the crops
+def compare_localizers(student, file_list, classifier, ensemble_crops=None):
+    fcns = fcn_ensemble() if ensemble_crops is None else None
+    clf = build_classifier(classifier)
+    _, input_size, preprocess, _ = classifiers[classifier]
+    metrics = dict(ensemble=ClassificationMetrics(), student=ClassificationMetrics())
+    seconds = dict(ensemble=[], student=[])
+    ious, same_scale = [], []
+    for i, (filename, class_folder) in enumerate(file_list):
+        img_shape = image_shape(filename)
+        input_cix = class_name_to_idx(class_folder)
+        if ensemble_crops is None:
+            start = time.perf_counter()
+            ensemble_record = crop_record(filename, class_folder,
+                                          select_best_crop(process_image(filename, input_cix, img_shape, fcns=fcns)))
+            seconds["ensemble"].append(time.perf_counter() - start)
+        else:
+            ensemble_record = ensemble_crops[filename]
+        start = time.perf_counter()
+        student_record = crop_record(filename, class_folder,
+                                     select_best_crop(student_process_image(student, filename, input_cix, img_shape)),
+                                     names=student_names)
+        seconds["student"].append(time.perf_counter() - start)
+
+        ious.append(rect_iou(ensemble_record["rect"], student_record["rect"]))
+        same_scale.append(ensemble_record["crop"]["factor"] == student_record["crop"]["factor"])
+        for name, record in (("ensemble", ensemble_record), ("student", student_record)):
+            img = load_crop(filename, record["rect"]["lower_left"], record["rect"]["side"], (input_size[1], input_size[0]),
+                            cache=True)
+            metrics[name].update([input_cix], clf.predict(preprocess(np.expand_dims(image.img_to_array(img), axis=0))))
+        if (i + 1) % 100 == 0:
+            print("Compared", i + 1, "of", len(file_list), "images, mean IoU {:.3f}".format(np.mean(ious)))
+
+    report = dict(images=len(file_list), classifier=classifier,
+                  localization_ms={name: 1000 * float(np.mean(times)) for name, times in seconds.items() if times},
+                  iou_mean=float(np.mean(ious)), iou_median=float(np.median(ious)),
+                  iou_above_0_5=float(np.mean(np.array(ious) > 0.5)), same_scale=float(np.mean(same_scale)),
+                  top1={name: m.top1 for name, m in metrics.items()},
+                  top5={name: m.topk for name, m in metrics.items()})
+    if seconds["ensemble"]:
+        report["speedup"] = float(np.mean(seconds["ensemble"]) / np.mean(seconds["student"]))
+    return report
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    memory_growth_config(model_name="localization")
+    if args.command == "targets":
+        generate_targets(args.targets, dataset_file_list(args.set, args.folders, args.instances))
+    elif args.command == "train":
+        train_student(args.targets, args.student, args.epochs, args.batch_size, args.steps)
+    else:
+        ensemble_crops = None
+        if args.ensemble_crops:
+            with open(args.ensemble_crops, "rb") as cropfile:
+                ensemble_crops = {record["filename"]: record for record in pickle.load(cropfile)}
+        report = compare_localizers(student_fcn(args.student), dataset_file_list("test", args.folders, args.instances),
+                                    args.classifier, ensemble_crops)
+        print(json.dumps(report, indent=2))
+        os.makedirs("results", exist_ok=True)
+        with open(os.path.join("results", "distillation_report_" + time.strftime("%Y-%m-%d_%H-%M-%S") + ".json"), "w") as outfile:
+            json.dump(report, outfile, indent=2)
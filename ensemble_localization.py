@@ -2,6 +2,7 @@ from keras.preprocessing import image
 import keras
 from keras.models import Model
 from keras.regularizers import l2
+from keras import backend as K
 from keras.layers import Conv2D, AveragePooling2D, Dense, BatchNormalization, LeakyReLU, GlobalAveragePooling2D, Dropout
 # non-graphical plot backend
 # import matplotlib
@@ -12,22 +13,48 @@ import matplotlib.patches as patches
 import time
 import pickle
 import os
+import tempfile
 import numpy as np
 import PIL
 from PIL import Image
 from utils.labels_ix_mapping import ix_to_class_name, class_name_to_idx
+from utils.profiling import StageProfiler
+from utils.image_decoding import open_image, image_shape
+from utils.memory_management import memory_growth_config
+from utils.weight_bundles import load_weights
 dataset_path = "dataset-ethz101food"
 
-
-# Function used to convolutionalize the VGG16 architecture
-def convolutionalize_vgg16():
-    vgg16 = keras.applications.vgg16.VGG16(include_top=False, weights='imagenet', input_shape=(None, None, 3))
+# hot-path instrumentation: per-stage timings, reported every profiling_interval images and at the end
+PROFILING = False
+profiling_interval = 250
+profiler = StageProfiler(enabled=PROFILING,
+                         report_filename="profiling_" + time.strftime("%Y-%m-%d_%H-%M-%S") + ".jsonl")
+# JPEG decoding at reduced resolution (DCT-domain downscaling) when the FCN input is well below the image size
+REDUCED_DECODING = True
+# tiled inference: FCN inputs whose estimated activation memory exceeds tile_memory_mb are processed segment by
+# segment (the FCN split at the layers all the following ones depend on), each segment in overlapping tiles aligned to
+# its stride and with margins of its receptive field, whose outputs are stitched together. Peak activation memory is
+# estimated as tile_memory_safety times the largest activation; MemoryError when a segment cannot fit.
+# The preprocessed input and the stitched outputs count against tile_memory_mb too: together they are held in memory
+# up to half of it, the ones beyond in anonymous temporary files in tile_spill_dir (the system one when None), so that
+# the peak memory of the inference does not grow with the image size. Off until measured on the Food-101 images.
+TILING = False
+tile_memory_mb = 1024
+tile_memory_safety = 3
+tile_spill_dir = None
+
+
+# Function used to convolutionalize the VGG16 architecture.
+# The convolutionalize_* backbones are built without the ImageNet weights, all replaced by the fine-tuned weights_fn
+def convolutionalize_vgg16(weights_fn="trained_models/top5_vgg16_acc77_2017-12-24/vgg16_ft_weights_acc0.78_e15_2017-12-23_22-53-03.hdf5"):
+    vgg16 = keras.applications.vgg16.VGG16(include_top=False, weights=None, input_shape=(None, None, 3))
 
     x = GlobalAveragePooling2D(name="global_average_pooling2d_1")(vgg16.output)
     out = Dense(101, activation='softmax', name='output_layer')(x)
     vgg16 = Model(inputs=vgg16.input, outputs=out)
 
-    vgg16.load_weights("trained_models/top5_vgg16_acc77_2017-12-24/vgg16_ft_weights_acc0.78_e15_2017-12-23_22-53-03.hdf5")
+    if weights_fn:
+        load_weights(vgg16, weights_fn)
 
     p_dim = vgg16.get_layer("global_average_pooling2d_1").input_shape
     out_dim = vgg16.get_layer("output_layer").get_weights()[1].shape[0]
@@ -50,14 +77,15 @@ def convolutionalize_vgg16():
 
 
 # Function used to convolutionalize the Xception architecture
-def convolutionalize_xception():
-    xce = keras.applications.xception.Xception(include_top=False, weights='imagenet', input_shape=(None, None, 3))
+def convolutionalize_xception(weights_fn="trained_models/top1_xception_acc80_2017-12-25/xception_ft_weights_acc0.81_e9_2017-12-24_13-00-22.hdf5"):
+    xce = keras.applications.xception.Xception(include_top=False, weights=None, input_shape=(None, None, 3))
 
     x = GlobalAveragePooling2D(name="global_average_pooling2d_1")(xce.output)
     out = Dense(101, activation='softmax', name='output_layer')(x)
     xce = Model(inputs=xce.input, outputs=out)
 
-    xce.load_weights("trained_models/top1_xception_acc80_2017-12-25/xception_ft_weights_acc0.81_e9_2017-12-24_13-00-22.hdf5")
+    if weights_fn:
+        load_weights(xce, weights_fn)
 
     p_dim = xce.get_layer("global_average_pooling2d_1").input_shape
     out_dim = xce.get_layer("output_layer").get_weights()[1].shape[0]
@@ -80,13 +108,14 @@ def convolutionalize_xception():
 
 
 # Function used to convolutionalize the InceptionResNetV2 architecture
-def convolutionalize_incresv2():
-    incresv2 = keras.applications.inception_resnet_v2.InceptionResNetV2(include_top=False, weights='imagenet',
+def convolutionalize_incresv2(weights_fn="trained_models/top2_incresnetv2_acc79_2017-12-22/incv2resnet_ft_weights_acc0.79_e4_2017-12-21_09-02-16.hdf5"):
+    incresv2 = keras.applications.inception_resnet_v2.InceptionResNetV2(include_top=False, weights=None,
                                                                         input_shape=(None, None, 3))
     x = GlobalAveragePooling2D(name="global_average_pooling2d_1")(incresv2.output)
     out = Dense(101, activation='softmax', name='output_layer')(x)
     incresv2 = Model(inputs=incresv2.input, outputs=out)
-    incresv2.load_weights("trained_models/top2_incresnetv2_acc79_2017-12-22/incv2resnet_ft_weights_acc0.79_e4_2017-12-21_09-02-16.hdf5")
+    if weights_fn:
+        load_weights(incresv2, weights_fn)
 
     out_dim = incresv2.get_layer("output_layer").get_weights()[1].shape[0]
     p_dim = incresv2.get_layer("global_average_pooling2d_1").input_shape
@@ -103,8 +132,8 @@ def convolutionalize_incresv2():
     return incresv2
 
 # Function used to convolutionalize the InceptionV3 architecture
-def convolutionalize_incv3():
-    incv3 = keras.applications.inception_v3.InceptionV3(include_top=False, weights='imagenet',
+def convolutionalize_incv3(weights_fn="trained_models/top3_inceptionv3_acc79_2017-12-27/inceptionv3_ft_weights_acc0.79_e10_2017-12-25_22-10-02.hdf5"):
+    incv3 = keras.applications.inception_v3.InceptionV3(include_top=False, weights=None,
                                                         input_shape=(None, None, 3))
     x = GlobalAveragePooling2D()(incv3.output)
     x = Dense(1024, kernel_initializer='he_uniform', bias_initializer="he_uniform", kernel_regularizer=l2(.0005),
@@ -120,7 +149,8 @@ def convolutionalize_incv3():
     out = Dense(101, kernel_initializer='he_uniform', bias_initializer="he_uniform", activation='softmax',
                 name='output_layer')(x)
     incv3 = Model(inputs=incv3.input, outputs=out, name="output_layer")
-    incv3.load_weights("trained_models/top3_inceptionv3_acc79_2017-12-27/inceptionv3_ft_weights_acc0.79_e10_2017-12-25_22-10-02.hdf5")
+    if weights_fn:
+        load_weights(incv3, weights_fn)
 
     W1, b1 = incv3.get_layer("fully-connected1").get_weights()
     W2, b2 = incv3.get_layer("fully-connected2").get_weights()
@@ -157,53 +187,12 @@ def convolutionalize_incv3():
     incv3 = Model(inputs=incv3.input, outputs=x)
     return incv3
 
-# FCNs declarations
-vgg16FCN = convolutionalize_vgg16()
-
-xceptionFCN = convolutionalize_xception()
-
-incresv2FCN = convolutionalize_incresv2()
-
-incv3FCN = convolutionalize_incv3()
-
-# CLFs (classifiers) declarations
-vgg16CLF = keras.applications.vgg16.VGG16(include_top=False, weights='imagenet', input_shape=(224, 224, 3))
-x = GlobalAveragePooling2D()(vgg16CLF.output)
-out = Dense(101, activation='softmax', name='output_layer')(x)
-vgg16CLF = Model(inputs=vgg16CLF.input, outputs=out)
-vgg16CLF.load_weights("trained_models/top5_vgg16_acc77_2017-12-24/vgg16_ft_weights_acc0.78_e15_2017-12-23_22-53-03.hdf5")
-
-vgg19CLF = keras.applications.vgg19.VGG19(include_top=False, weights='imagenet', input_shape=(224, 224, 3))
-x = GlobalAveragePooling2D()(vgg19CLF.output)
-out = Dense(101, activation='softmax', name='output_layer')(x)
-vgg19CLF = Model(inputs=vgg19CLF.input, outputs=out)
-vgg19CLF.load_weights("trained_models/top4_vgg19_acc78_2017-12-23/vgg19_ft_weights_acc0.78_e26_2017-12-22_23-55-53.hdf5")
-
-xceptionCLF = keras.applications.xception.Xception(include_top=False, weights='imagenet', input_shape=(299, 299, 3))
-x = GlobalAveragePooling2D()(xceptionCLF.output)
-out = Dense(101, activation='softmax', name='output_layer')(x)
-xceptionCLF = Model(inputs=xceptionCLF.input, outputs=out)
-xceptionCLF.load_weights("trained_models/top1_xception_acc80_2017-12-25/xception_ft_weights_acc0.81_e9_2017-12-24_13-00-22.hdf5")
-
-incresv2CLF = keras.applications.inception_resnet_v2.InceptionResNetV2(include_top=False, weights='imagenet', input_shape=(299, 299, 3))
-x = GlobalAveragePooling2D()(incresv2CLF.output)
-out = Dense(101, activation='softmax', name='output_layer')(x)
-incresv2CLF = Model(inputs=incresv2CLF.input, outputs=out)
-incresv2CLF.load_weights("trained_models/top2_incresnetv2_acc79_2017-12-22/incv2resnet_ft_weights_acc0.79_e4_2017-12-21_09-02-16.hdf5")
-
-incv3CLF = keras.applications.inception_v3.InceptionV3(include_top=False, weights='imagenet', input_shape=(299, 299, 3))
-x = GlobalAveragePooling2D()(incv3CLF.output)
-x = Dense(1024, kernel_initializer='he_uniform', bias_initializer="he_uniform", kernel_regularizer=l2(.0005), bias_regularizer=l2(.0005))(x)
-x = LeakyReLU()(x)
-x = BatchNormalization()(x)
-x = Dropout(0.5)(x)
-x = Dense(512, kernel_initializer='he_uniform', bias_initializer="he_uniform", kernel_regularizer=l2(.0005), bias_regularizer=l2(.0005))(x)
-x = LeakyReLU()(x)
-x = BatchNormalization()(x)
-x = Dropout(0.5)(x)
-out = Dense(101, kernel_initializer='he_uniform', bias_initializer="he_uniform", activation='softmax', name='output_layer')(x)
-incv3CLF = Model(inputs=incv3CLF.input, outputs=out)
-incv3CLF.load_weights("trained_models/top3_inceptionv3_acc79_2017-12-27/inceptionv3_ft_weights_acc0.79_e10_2017-12-25_22-10-02.hdf5")
+# FCNs declarations, with random weights if not trained (e.g. for benchmarking without the trained models)
+def fcn_ensemble(trained=True):
+    if trained:
+        return [convolutionalize_vgg16(), convolutionalize_xception(), convolutionalize_incresv2(), convolutionalize_incv3()]
+    return [convolutionalize_vgg16(None), convolutionalize_xception(None), convolutionalize_incresv2(None),
+            convolutionalize_incv3(None)]
 
 
 def predict_from_imgarray(model, img, input_size, preprocess):
@@ -215,39 +204,318 @@ def predict_from_imgarray(model, img, input_size, preprocess):
     preds = model.predict(img_preprocessed_image)
     return preds
 
-def predict_from_filename(model, filename, input_size, preprocess):
-    input_img = image.load_img(filename, target_size=input_size)
-    input_img = image.img_to_array(input_img)
-    input_image_expandedim = np.expand_dims(input_img, axis=0)
-    input_preprocessed_image = preprocess(input_image_expandedim)
-    preds = model.predict(input_preprocessed_image)
+def predict_from_filename(model, filename, input_size, preprocess, stage_name="predict"):
+    input_preprocessed_image = load_input(filename, input_size, preprocess)
+    if TILING:
+        # the only reference to the input in memory is dropped when it is spilled
+        input_preprocessed_image = spill_buffer(input_preprocessed_image)
+    with profiler.stage(stage_name, size=input_size):
+        preds = predict_tiled(model, input_preprocessed_image) if TILING else model.predict(input_preprocessed_image)
     return preds
 
+# same steps of image.load_img(filename, target_size=input_size), split to time them separately.
+# The decoded image is reused by the following calls on the same file.
+def load_input(filename, input_size, preprocess):
+    with profiler.stage("image_load"):
+        input_img = open_image(filename, min_size=(input_size[1], input_size[0]) if REDUCED_DECODING else None)
+    with profiler.stage("resize"):
+        if input_img.size != (input_size[1], input_size[0]):
+            input_img = input_img.resize((input_size[1], input_size[0]))
+    with profiler.stage("preprocess_input"):
+        input_img = image.img_to_array(input_img)
+        input_image_expandedim = np.expand_dims(input_img, axis=0)
+        input_preprocessed_image = preprocess(input_image_expandedim)
+    return input_preprocessed_image
+
+def _inbound_layers(layer):
+    nodes = getattr(layer, '_inbound_nodes', None) or getattr(layer, 'inbound_nodes', [])
+    return nodes[0].inbound_layers if nodes else []
+
+# Geometry of the layers of model from start (the input layer by default), relative to the output of start: by layer
+# name, theoretical receptive field (height, width), jump (stride) and activation bytes per element of that output
+def _layer_geometry(model, start=None):
+    layers = model.layers[model.layers.index(start):] if start is not None else model.layers
+    fields = {}
+    for layer in layers:
+        inbound = [l for l in _inbound_layers(layer) if l.name in fields]
+        if inbound:
+            rf = tuple(max(fields[l.name][0][a] for l in inbound) for a in (0, 1))
+            jump = fields[inbound[0].name][1]
+        else:
+            rf, jump = (1, 1), (1, 1)
+        kernel = getattr(layer, 'kernel_size', None) or getattr(layer, 'pool_size', None)
+        if kernel and layer is not start:
+            dilation = getattr(layer, 'dilation_rate', (1, 1))
+            rf = tuple(rf[a] + (kernel[a] - 1) * dilation[a] * jump[a] for a in (0, 1))
+            jump = tuple(jump[a] * layer.strides[a] for a in (0, 1))
+        output_shapes = layer.get_output_shape_at(0)
+        output_shapes = output_shapes if isinstance(output_shapes, list) else [output_shapes]
+        channels = sum(shape[-1] for shape in output_shapes)
+        fields[layer.name] = (rf, jump, 4. * channels / (jump[0] * jump[1]))
+    return fields
+
+# FCN geometry, by model: theoretical receptive field (height, width) of the output and estimated peak activation
+# bytes per input pixel
+_fcn_geometry = {}
+
+def fcn_geometry(model):
+    if id(model) not in _fcn_geometry:
+        fields = _layer_geometry(model)
+        _fcn_geometry[id(model)] = (fields[model.layers[-1].name][0],
+                                    max(field[2] for field in fields.values()) * tile_memory_safety)
+    return _fcn_geometry[id(model)]
+
+# Layers of model whose output is the only input of all the following layers (the input and output layers included)
+def cut_layers(model):
+    last_use = {}
+    for i, layer in enumerate(model.layers):
+        for inbound in _inbound_layers(layer):
+            last_use[inbound.name] = i
+    cuts = []
+    reach = -1
+    for i, layer in enumerate(model.layers):
+        if reach <= i:
+            cuts.append(layer)
+        reach = max(reach, last_use.get(layer.name, -1))
+    return cuts
+
+# Model running the layers of model after start up to end on its own input, which takes the output of start
+def _segment_model(model, start, end):
+    if start is model.layers[0]:
+        return Model(inputs=model.input, outputs=end.output)
+    segment_input = keras.layers.Input(shape=(None, None, start.get_output_shape_at(0)[-1]))
+    tensors = {start.name: segment_input}
+    for layer in model.layers[model.layers.index(start) + 1:model.layers.index(end) + 1]:
+        inputs = [tensors[l.name] for l in _inbound_layers(layer)]
+        tensors[layer.name] = layer(inputs[0] if len(inputs) == 1 else inputs)
+    return Model(inputs=segment_input, outputs=tensors[end.name])
+
+# Upper bound of the smallest tile length, aligned to the jump, with at least one output unaffected by the tile sides
+def _min_tile(rf, jump):
+    return 2 * rf + 3 * jump
+
+# FCN split at its cut layers in consecutive segments, each one as long as its smallest exact tile fits in memory_mb,
+# by model and budget: [(segment model, receptive field, jump, estimated peak activation bytes per input element)].
+# The segments are tiled one after the other, each with the margins of its own receptive field, much smaller than the
+# receptive field of the whole FCN (e.g. InceptionResNetV2, Xception).
+_fcn_segments = {}
+
+def fcn_segments(model, memory_mb):
+    key = (id(model), memory_mb)
+    if key not in _fcn_segments:
+        cuts = cut_layers(model)
+        segments = []
+        start = cuts[0]
+        while start is not cuts[-1]:
+            fields = _layer_geometry(model, start)
+            segment = None
+            for end in cuts[cuts.index(start) + 1:]:
+                rf, jump, _ = fields[end.name]
+                bytes_per_element = tile_memory_safety * max(
+                    fields[layer.name][2] for layer in model.layers[model.layers.index(start):model.layers.index(end) + 1])
+                if _min_tile(rf[0], jump[0]) * _min_tile(rf[1], jump[1]) * bytes_per_element > memory_mb * 2 ** 20:
+                    break
+                segment = (end, rf, jump, bytes_per_element)
+            if segment is None:
+                raise MemoryError("tiled inference of {} from layer {} does not fit in {} MB: raise tile_memory_mb or "
+                                  "disable TILING".format(model.name, start.name, memory_mb))
+            end, rf, jump, bytes_per_element = segment
+            segments.append((_segment_model(model, start, end), rf, jump, bytes_per_element))
+            start = end
+        _fcn_segments[key] = segments
+    return _fcn_segments[key]
+
+# Tile length along an axis of the given length, close to target, equal to the length modulo the jump and not shorter
+# than the smallest exact tile
+def _tile_length(length, rf, jump, target):
+    tile = max(int(target), _min_tile(rf, jump))
+    return min(length, tile - (tile - length) % jump)
+
+# Tiles along an axis of the given length and n outputs, with tiles of the given length: (first input element of the
+# tile, first and last + 1 output kept from it). Inside the input, the outputs kept from a tile are at least one
+# receptive field away from its sides.
+def tile_spans(length, tile, rf, jump, n):
+    if tile >= length:
+        return [(0, 0, n)]
+    margin = -(-rf // jump)
+    kept = (tile - 1 - rf) // jump + 1
+    spans = []
+    start = keep_from = 0
+    while start + tile < length:
+        keep_to = start // jump + kept
+        spans.append((start, keep_from, keep_to))
+        keep_from = keep_to
+        start = (keep_to - margin) * jump
+    spans.append((length - tile, keep_from, n))
+    return spans
+
+# Megabytes of x held in memory, none when it is in a temporary file
+def _resident_mb(x):
+    return 0. if isinstance(x, np.memmap) else x.nbytes / 2 ** 20
+
+# float32 buffer of the given shape, in memory when it fits in memory_mb, otherwise in an anonymous temporary file
+# (removed when the buffer is released)
+def _stitch_buffer(shape, memory_mb):
+    if np.prod(shape) * 4 <= memory_mb * 2 ** 20:
+        return np.empty(shape, dtype=np.float32)
+    with tempfile.TemporaryFile(dir=tile_spill_dir) as spill_file:
+        return np.memmap(spill_file, dtype=np.float32, mode='w+', shape=shape)
+
+# x moved to a temporary file when it takes more than half of memory_mb, as the input of predict_tiled
+def spill_buffer(x, memory_mb=None):
+    memory_mb = tile_memory_mb if memory_mb is None else memory_mb
+    if _resident_mb(x) <= memory_mb / 2.:
+        return x
+    spilled = _stitch_buffer(x.shape, 0)
+    spilled[...] = x
+    return spilled
+
+# Output of a segment on x, written to out, computed in tiles when its estimated activation memory exceeds memory_mb.
+# Tiles start at multiples of the jump and have the length of the input modulo the jump, so that the padding and the
+# grids of the strided layers are the same as on the whole input and the kept outputs see exactly the same elements.
+def _predict_segment(segment, x, out, rf, jump, bytes_per_element, memory_mb):
+    height, width = x.shape[1:3]
+    max_elements = memory_mb * 2 ** 20 / bytes_per_element
+    if height * width <= max_elements:
+        out[...] = segment.predict(x)
+        return out
+    out_shape = out.shape
+    tile_h = _tile_length(height, rf[0], jump[0], min(np.sqrt(max_elements), max_elements / _min_tile(rf[1], jump[1])))
+    tile_w = _tile_length(width, rf[1], jump[1], max_elements / tile_h)
+    for row, row_from, row_to in tile_spans(height, tile_h, rf[0], jump[0], out_shape[1]):
+        for col, col_from, col_to in tile_spans(width, tile_w, rf[1], jump[1], out_shape[2]):
+            tile_out = segment.predict(x[:, row:row + tile_h, col:col + tile_w])
+            out[:, row_from:row_to, col_from:col_to] = \
+                tile_out[:, row_from - row // jump[0]:row_to - row // jump[0], col_from - col // jump[1]:col_to - col // jump[1]]
+    return out
+
+# Heatmap of an FCN on the preprocessed input x, computed in tiles when the input and its estimated activation memory
+# exceed memory_mb. The FCN runs segment by segment (fcn_segments), each segment tiled with its own margins and its
+# stitched output fed to the next one. The input and output of the running segment are held in memory up to half of
+# memory_mb and in temporary files beyond (spill_buffer), the tiles take the rest, so the peak memory stays within
+# memory_mb whatever the input size. The input is spilled here if needed: callers holding no other reference to it
+# (predict_from_filename spills it itself) do not keep it in memory.
+# Raises MemoryError when a segment between two consecutive cut layers does not fit in half of memory_mb.
+def predict_tiled(model, x, memory_mb=None):
+    memory_mb = tile_memory_mb if memory_mb is None else memory_mb
+    _, bytes_per_pixel = fcn_geometry(model)
+    if _resident_mb(x) + x.shape[1] * x.shape[2] * bytes_per_pixel / 2 ** 20 <= memory_mb:
+        return model.predict(x)
+    buffers_mb = memory_mb / 2.
+    x = spill_buffer(x, memory_mb)
+    for segment, rf, jump, bytes_per_element in fcn_segments(model, memory_mb - buffers_mb):
+        out = _stitch_buffer(segment.compute_output_shape(x.shape), buffers_mb - _resident_mb(x))
+        x = _predict_segment(segment, x, out, rf, jump, bytes_per_element,
+                             memory_mb - _resident_mb(x) - _resident_mb(out))
+    return x
+
+# Largest absolute difference and argmax agreement between the tiled and untiled heatmaps of a preprocessed input
+def tiling_difference(model, x, memory_mb=64):
+    reference = model.predict(x)[0]
+    tiled = predict_tiled(model, x, memory_mb=memory_mb)[0]
+    return dict(max_abs_diff=float(np.max(np.abs(reference - tiled))),
+                argmax_agreement=float(np.mean(np.argmax(reference, axis=2) == np.argmax(tiled, axis=2))))
+
+# tiling_difference on an image file
+def validate_tiling(model, filename, input_size, preprocess, memory_mb=64):
+    return tiling_difference(model, load_input(filename, input_size, preprocess), memory_mb=memory_mb)
+
 def get_top1data(preds, additionalClassIx):
     maxix = np.argmax(preds)
     return (maxix, ix_to_class_name(maxix), preds[maxix], preds[class_name_to_idx(additionalClassIx)])
 
 # ensemble declaration
 kernel_sizes = [288, 295, 299, 299]
-FCNs = [vgg16FCN, xceptionFCN, incresv2FCN, incv3FCN]
+FCNs = None  # fcn_ensemble() models, loaded by the main script
+fcn_names = ["vgg16FCN", "xceptionFCN", "incresv2FCN", "incv3FCN"]
 preprocess_func = [  keras.applications.vgg16.preprocess_input
                    , keras.applications.xception.preprocess_input
                    , keras.applications.inception_resnet_v2.preprocess_input
                    , keras.applications.inception_v3.preprocess_input]
 
+# cascaded ensemble: at each scale the FCNs run in cascade_order (cheapest first, InceptionV3, Xception,
+# InceptionResNetV2, VGG16) and the remaining ones are skipped as soon as the scale cannot beat the best
+# (votes, score) crop of the previous scales, or when none of the first cascade_exit_members FCNs votes for the label
+CASCADE = False
+cascade_order = [3, 1, 2, 0]
+cascade_exit_members = 2
+# forward passes run and skipped by the cascade, over all the processed images
+forward_passes = dict(run=0, skipped=0)
+
+# scale-mosaic packing: the scales of an image (or of several images) are placed on one canvas per FCN, at offsets
+# multiple of the FCN stride and separated by gutters as wide as the reach of the FCN receptive field beyond a tile
+# (packing_gutter), so that a single forward pass computes the heatmaps of all of them and no heatmap element sees the
+# pixels of another tile. Every layer output is masked to the tiles (masked_fcn), so the heatmaps are the ones of
+# separate forward passes. Canvases are limited to packing_max_canvas_pixels.
+# Only the FCNs in packing_fcns are packed, the others run scale by scale: VGG16 is the only one that can be masked,
+# and the receptive fields of Xception and of the Inception FCNs would need gutters larger than the canvases.
+PACKING = False
+packing_fcns = [0]
+packing_max_canvas_pixels = 2 ** 21
+# images of the main script checked against the unpacked heatmaps and crops (validate_packing) when packing, and
+# largest difference allowed between heatmap elements computed on different input sizes
+packing_validation_images = 5
+packing_tolerance = 1e-4
+
 # Formula to comput the output size after application of a convolutional kernel
 def dim_size(w, k, s):
   return ((w - k) // s + 1)
 
+# True if no crop of a scale, after running part of the ensemble, can reach the best (votes, score) found so far.
+# Every one of the remaining FCNs can add at most a vote and a score of 1 to each heatmap element.
+def cannot_improve(ncix_max_map, score_sum_map, remaining, n_fcns, best_votes, best_score):
+    votes_bound = ncix_max_map + remaining
+    max_votes_bound = np.max(votes_bound)
+    if max_votes_bound != best_votes:
+        return max_votes_bound < best_votes
+    score_bound = (score_sum_map + remaining) / n_fcns
+    return np.max(score_bound[votes_bound == best_votes]) <= best_score
+
+# Fusion of the ensemble heatmaps of a scale: the heatmap element (crop) that maximizes the label for the highest
+# number of FCNs, and among them the one with the highest mean score
+def fuse_heatmaps(heatmaps, bool_cix_maps, input_cix, scale_factor):
+    # ncix_max_map is a int map, that will have the number of FCN that maximize the label (values from 0 to 4)
+    ncix_max_map = np.zeros(bool_cix_maps[-1].shape, dtype=int)
+    for bool_cix_map in bool_cix_maps:
+        ncix_max_map += bool_cix_map
+
+    maxcn = np.max(ncix_max_map)
+    positions = np.nonzero(ncix_max_map == maxcn)  # tuple with the indices of max_cn relative to ncix_max_map
+    positions = list(zip(positions[0], positions[1]))
+
+    def sum_crop_score(x):
+        res = 0
+        for map in heatmaps:
+            res += map[x[0], x[1], input_cix]
+        return res
+
+    best_crop_ix = max(positions, key=sum_crop_score)
+    best_crop_score = sum_crop_score(best_crop_ix) / len(heatmaps)
+    correct_fcn = [bool_cix_map[best_crop_ix[0], best_crop_ix[1]] for bool_cix_map in bool_cix_maps]
+
+    return {"factor": scale_factor, "heatmap_shape": heatmaps[-1].shape[0:2], "ix": best_crop_ix,
+            "score": best_crop_score, "nfcn_clf_ix": maxcn, "fcn_clf_ix": correct_fcn}
+
 # Ensemble image processing at different scales and heatmaps informations extraction.
-# Returns a list with the best heatmap element and relative score at each scale
-def process_image(input_fn, input_cix, img_shape, upsampling_step = 1.2, max_scale_factor = 3.0):
+# Returns a list with the best heatmap element and relative score at each scale (except the scales pruned by the cascade)
+def process_image(input_fn, input_cix, img_shape, upsampling_step = 1.2, max_scale_factor = 3.0, fcns=None,
+                  cascade=None, pack=None):
+    fcns = FCNs if fcns is None else fcns
+    cascade = CASCADE if cascade is None else cascade
+    pack = PACKING if pack is None else pack
+    if pack:
+        if cascade:
+            raise ValueError("The cascaded ensemble decides scale by scale which FCNs to run: it cannot be packed")
+        return process_images([(input_fn, input_cix, img_shape)], upsampling_step, max_scale_factor, fcns)[0]
+    fcn_order = cascade_order if cascade else range(len(fcns))
+    best_votes, best_score = 0, 0.
     results = []
     if (os.path.exists(input_fn)):
         base_kernel_size = 295 # any of the kernels would do
         scale_factor = float(base_kernel_size) / min(img_shape[0], img_shape[1])
         maxcn = 0
-        
+        scale_ix = 0
+
         while scale_factor < max_scale_factor and maxcn < 4:
             # we define the expected heatmap dimension at this scale using the kernel size of the first FCN
             base_kernel_size = kernel_sizes[0]
@@ -255,108 +523,281 @@ def process_image(input_fn, input_cix, img_shape, upsampling_step = 1.2, max_sca
             heatmap_w = dim_size(round(img_shape[1]*scale_factor), base_kernel_size, 32)
             
             # we search, at this scale, the heatmap element (crop) that maximize the label for highest number of FNCs
-            heatmaps = []
-            bool_cix_maps = []
-            for ix, fcn in enumerate(FCNs):
+            heatmaps = [None] * len(fcns)
+            bool_cix_maps = [None] * len(fcns)
+            ncix_max_map = score_sum_map = None
+            pruned = False
+            for k, ix in enumerate(fcn_order):
+                fcn = fcns[ix]
                 # we adjust the input size for each FCN to get comparable (equal-size) heatmaps
                 scaled_w = kernel_sizes[ix] + (heatmap_w - 1) * 32
                 scaled_h = kernel_sizes[ix] + (heatmap_h - 1) * 32
 
-                heatmaps.append(predict_from_filename(fcn, input_fn, (scaled_h, scaled_w), preprocess_func[ix])[0])
-
-                bool_cix_map = np.argmax(heatmaps[-1], axis=2) == input_cix   # boolean map that indicate label maximization
-                bool_cix_maps.append(bool_cix_map)
-
-            # ncix_max_map is a int map, that will have the number of FCN that maximize the label (values from 0 to 4)
-            ncix_max_map = np.zeros(bool_cix_maps[-1].shape, dtype=int)
-            for bool_cix_map in bool_cix_maps:
-                ncix_max_map += bool_cix_map
-
-            maxcn = np.max(ncix_max_map)
-            positions = np.nonzero(ncix_max_map == maxcn)  # tuple with the indices of max_cn relative to ncix_max_map
-            positions = list(zip(positions[0], positions[1]))
-
-            def sum_crop_score(x):
-                res = 0
-                for map in heatmaps:
-                    res += map[x[0], x[1], input_cix]
-                return res
-
-            best_crop_ix = max(positions, key=sum_crop_score)
-            best_crop_score = sum_crop_score(best_crop_ix) / 4
-            correct_fcn = [bool_cix_map[best_crop_ix[0], best_crop_ix[1]] for bool_cix_map in bool_cix_maps]
-
-            results.append({"factor": scale_factor, "heatmap_shape": heatmaps[-1].shape[0:2], "ix": best_crop_ix,
-                            "score": best_crop_score, "nfcn_clf_ix": maxcn, "fcn_clf_ix": correct_fcn})
+                heatmaps[ix] = predict_from_filename(fcn, input_fn, (scaled_h, scaled_w), preprocess_func[ix],
+                                                     "predict/" + fcn_names[ix] + "/scale" + str(scale_ix))[0]
+                forward_passes["run"] += 1
+
+                bool_cix_maps[ix] = np.argmax(heatmaps[ix], axis=2) == input_cix   # boolean map that indicate label maximization
+
+                remaining = len(fcns) - k - 1
+                if cascade and remaining > 0:
+                    if ncix_max_map is None:
+                        ncix_max_map = bool_cix_maps[ix].astype(int)
+                        score_sum_map = heatmaps[ix][:, :, input_cix].copy()
+                    else:
+                        ncix_max_map += bool_cix_maps[ix]
+                        score_sum_map += heatmaps[ix][:, :, input_cix]
+                    # the vote-based exit is a heuristic, so it is used only when a crop has already been found
+                    pruned = (len(results) > 0 and k + 1 >= cascade_exit_members and not np.any(ncix_max_map)) or \
+                             cannot_improve(ncix_max_map, score_sum_map, remaining, len(fcns), best_votes, best_score)
+                    if pruned:
+                        forward_passes["skipped"] += remaining
+                        break
+
+            if pruned:
+                scale_factor *= upsampling_step
+                scale_ix += 1
+                continue
+
+            with profiler.stage("fusion"):
+                results.append(fuse_heatmaps(heatmaps, bool_cix_maps, input_cix, scale_factor))
+                maxcn = results[-1]["nfcn_clf_ix"]
+                best_votes, best_score = max((best_votes, best_score), (maxcn, results[-1]["score"]))
 
             # step to the next scale
             scale_factor *= upsampling_step
+            scale_ix += 1
 
     else:
         print ("The image file " + str(input_fn) + " does not exist")
 
     return results
 
+# Scale factors of process_image and heatmap size (height, width) at each of them
+def scale_pyramid(img_shape, upsampling_step=1.2, max_scale_factor=3.0):
+    scales = []
+    scale_factor = float(295) / min(img_shape[0], img_shape[1])
+    while scale_factor < max_scale_factor:
+        scales.append((scale_factor, dim_size(round(img_shape[0]*scale_factor), kernel_sizes[0], 32),
+                       dim_size(round(img_shape[1]*scale_factor), kernel_sizes[0], 32)))
+        scale_factor *= upsampling_step
+    return scales
+
+# Pixels that the receptive field of the heatmap elements of the FCN with the given kernel size reaches beyond
+# the input sides, per axis, rounded up to the stride (at most the receptive field minus the kernel, on each side)
+def receptive_margin(fcn, kernel_size, stride=32):
+    rf, _ = fcn_geometry(fcn)
+    return tuple(-(-max(0, rf[a] - kernel_size) // stride) * stride for a in (0, 1))
+
+# Gutter between the packed tiles of an FCN with the given kernel size: a heatmap element of a tile does not see the
+# pixels of the others
+def packing_gutter(fcn, kernel_size):
+    return max(receptive_margin(fcn, kernel_size))
+
+# layers without spatial extent, whose output at a position depends only on their input at the same position
+_elementwise_layers = (keras.layers.InputLayer, keras.layers.Activation, keras.layers.BatchNormalization,
+                       keras.layers.Dropout, keras.layers.LeakyReLU)
+
+# Two-input version of an FCN, by model: (canvas, mask of the tiles). The output of every layer but the last is
+# multiplied by the mask of the tiles at its resolution, so that around a tile every layer sees zeros, exactly as the
+# zero padding of the tile processed alone. Only FCNs made of stride 1 convolutions with 'same' padding, 'valid'
+# convolutions and poolings (whose mask is min-pooled) and element-wise layers can be masked: ValueError for the
+# others, e.g. strided 'same' convolutions (padding that depends on the input size) or 'same' poolings (not padded
+# with zeros).
+_masked_fcns = {}
+
+def masked_fcn(fcn):
+    if id(fcn) not in _masked_fcns:
+        canvas = keras.layers.Input(shape=(None, None, 3))
+        mask = keras.layers.Input(shape=(None, None, 1))
+        tensors = {fcn.layers[0].name: (canvas, mask)}
+        for layer in fcn.layers[1:]:
+            inbound = _inbound_layers(layer)
+            kernel = getattr(layer, 'kernel_size', None) or getattr(layer, 'pool_size', None)
+            if len(inbound) != 1:
+                raise ValueError("Layer {} of {} has several inputs: the FCN cannot be packed".format(layer.name, fcn.name))
+            x, m = tensors[inbound[0].name]
+            if kernel and layer.padding == 'valid' and tuple(getattr(layer, 'dilation_rate', (1, 1))) == (1, 1):
+                m = keras.layers.Lambda(lambda t, kernel=kernel, strides=layer.strides:
+                                        1 - K.pool2d(1 - t, kernel, strides, padding='valid', pool_mode='max'))(m)
+            elif kernel and not (isinstance(layer, Conv2D) and layer.padding == 'same' and tuple(layer.strides) == (1, 1)):
+                raise ValueError("Layer {} of {} is padded depending on its input: the FCN cannot be packed"
+                                 .format(layer.name, fcn.name))
+            elif not kernel and not isinstance(layer, _elementwise_layers):
+                raise ValueError("Layer {} of {} is not supported by packing".format(layer.name, fcn.name))
+            x = layer(x)
+            if layer is not fcn.layers[-1]:
+                x = keras.layers.Lambda(lambda tensors: tensors[0] * tensors[1])([x, m])
+            tensors[layer.name] = (x, m)
+        _masked_fcns[id(fcn)] = Model(inputs=[canvas, mask], outputs=tensors[fcn.layers[-1].name][0])
+    return _masked_fcns[id(fcn)]
+
+# Shelf packing of tiles (height, width) on a canvas, tallest first. Every tile gets a slot rounded up to the
+# stride plus a gutter, so tile offsets are multiples of the stride and the heatmap of a tile is a slice of the
+# canvas heatmap. Returns the tile offsets (y, x) and the canvas size (height, width).
+def pack_tiles(tile_sizes, gutter, stride=32):
+    slots = [(-(-h // stride) * stride + gutter, -(-w // stride) * stride + gutter) for h, w in tile_sizes]
+    width = max(max(w for _, w in slots), int(np.sqrt(sum(h * w for h, w in slots))) // stride * stride)
+    offsets = [None] * len(slots)
+    x, y, shelf_h = 0, 0, 0
+    for i in sorted(range(len(slots)), key=lambda i: -slots[i][0]):
+        if x + slots[i][1] > width:
+            x, y, shelf_h = 0, y + shelf_h, 0
+        offsets[i] = (y, x)
+        x += slots[i][1]
+        shelf_h = max(shelf_h, slots[i][0])
+    canvas_h = max(offset[0] + size[0] for offset, size in zip(offsets, tile_sizes))
+    canvas_w = max(offset[1] + size[1] for offset, size in zip(offsets, tile_sizes))
+    return offsets, (canvas_h, canvas_w)
+
+# Splits consecutive tiles in groups of at most max_pixels (slots included); a larger tile gets a canvas of its own
+def canvas_groups(tile_sizes, gutter, max_pixels=None):
+    max_pixels = packing_max_canvas_pixels if max_pixels is None else max_pixels
+    groups, pixels = [[]], 0
+    for i, (h, w) in enumerate(tile_sizes):
+        area = (h + gutter) * (w + gutter)
+        if groups[-1] and pixels + area > max_pixels:
+            groups.append([])
+            pixels = 0
+        groups[-1].append(i)
+        pixels += area
+    return [group for group in groups if group]
+
+# One forward pass of the masked FCN (stride 32, given kernel size) on a canvas with the given preprocessed tiles
+# (height, width, 3), returns the heatmap of each tile
+def predict_canvas(fcn, kernel_size, tiles, stage_name="predict/packed"):
+    offsets, canvas_size = pack_tiles([tile.shape[0:2] for tile in tiles], packing_gutter(fcn, kernel_size))
+    canvas = np.zeros((1,) + canvas_size + (3,), dtype=np.float32)
+    mask = np.zeros((1,) + canvas_size + (1,), dtype=np.float32)
+    for tile, (y, x) in zip(tiles, offsets):
+        canvas[0, y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+        mask[0, y:y + tile.shape[0], x:x + tile.shape[1]] = 1
+    with profiler.stage(stage_name, size=canvas_size):
+        canvas_heatmap = masked_fcn(fcn).predict([canvas, mask])[0]
+    forward_passes["run"] += 1
+    return [canvas_heatmap[y // 32:y // 32 + dim_size(tile.shape[0], kernel_size, 32),
+                           x // 32:x // 32 + dim_size(tile.shape[1], kernel_size, 32)]
+            for tile, (y, x) in zip(tiles, offsets)]
+
+# predict_canvas of the ix-th FCN on the tiles (filename, input size)
+def predict_packed(fcn, ix, tiles):
+    return predict_canvas(fcn, kernel_sizes[ix], [load_input(filename, size, preprocess_func[ix])[0]
+                                                  for filename, size in tiles], "predict/" + fcn_names[ix] + "/packed")
+
+# Heatmaps of every FCN at every scale of the images (filename, shape), computed on packed canvases for the FCNs in
+# packing_fcns and scale by scale for the others.
+# Returns the scale pyramid of each image and the heatmaps indexed by [image][scale][fcn]
+def packed_heatmaps(inputs, upsampling_step=1.2, max_scale_factor=3.0, fcns=None):
+    fcns = FCNs if fcns is None else fcns
+    pyramids = [scale_pyramid(img_shape, upsampling_step, max_scale_factor) for _, img_shape in inputs]
+    # image-major order: the tiles of a canvas come from as few images as possible, decoded once
+    keys = [(i, s) for i, pyramid in enumerate(pyramids) for s in range(len(pyramid))]
+    heatmaps = [[[None] * len(fcns) for _ in pyramid] for pyramid in pyramids]
+    for ix, fcn in enumerate(fcns):
+        sizes = [(kernel_sizes[ix] + (pyramids[i][s][1] - 1) * 32, kernel_sizes[ix] + (pyramids[i][s][2] - 1) * 32)
+                 for i, s in keys]
+        if ix not in packing_fcns:
+            for (i, s), size in zip(keys, sizes):
+                heatmaps[i][s][ix] = predict_from_filename(fcn, inputs[i][0], size, preprocess_func[ix],
+                                                           "predict/" + fcn_names[ix] + "/scale" + str(s))[0]
+                forward_passes["run"] += 1
+            continue
+        for group in canvas_groups(sizes, packing_gutter(fcn, kernel_sizes[ix])):
+            tiles = [(inputs[keys[j][0]][0], sizes[j]) for j in group]
+            for j, heatmap in zip(group, predict_packed(fcn, ix, tiles)):
+                heatmaps[keys[j][0]][keys[j][1]][ix] = heatmap
+    return pyramids, heatmaps
+
+# Fusion of the heatmaps [scale][fcn] of an image, scale by scale as in process_image
+def fuse_pyramid(pyramid, image_heatmaps, input_cix):
+    results = []
+    for (scale_factor, _, _), scale_heatmaps in zip(pyramid, image_heatmaps):
+        with profiler.stage("fusion"):
+            bool_cix_maps = [np.argmax(heatmap, axis=2) == input_cix for heatmap in scale_heatmaps]
+            results.append(fuse_heatmaps(scale_heatmaps, bool_cix_maps, input_cix, scale_factor))
+        # the larger scales are not used once all the FCNs agree on a crop
+        if results[-1]["nfcn_clf_ix"] >= 4:
+            break
+    return results
+
+# Packed counterpart of process_image for several images (filename, label index, shape): the scales of all the
+# images are packed on a few canvases per FCN
+def process_images(inputs, upsampling_step=1.2, max_scale_factor=3.0, fcns=None):
+    existing = []
+    for input_fn, _, img_shape in inputs:
+        if os.path.exists(input_fn):
+            existing.append((input_fn, img_shape))
+        else:
+            print ("The image file " + str(input_fn) + " does not exist")
+    pyramids, heatmaps = packed_heatmaps(existing, upsampling_step, max_scale_factor, fcns)
+    all_results = []
+    for input_fn, input_cix, _ in inputs:
+        if os.path.exists(input_fn):
+            all_results.append(fuse_pyramid(pyramids.pop(0), heatmaps.pop(0), input_cix))
+        else:
+            all_results.append([])
+    return all_results
+
+# Checks the packed heatmaps of an image against separate forward passes of each scale, raising an AssertionError
+# when a heatmap element of a packed FCN differs by more than packing_tolerance or the two fusions select different
+# crops. Returns per packed FCN the largest absolute difference.
+def validate_packing(input_fn, input_cix, img_shape, upsampling_step=1.2, max_scale_factor=3.0, fcns=None):
+    fcns = FCNs if fcns is None else fcns
+    pyramids, heatmaps = packed_heatmaps([(input_fn, img_shape)], upsampling_step, max_scale_factor, fcns)
+    pyramid, image_heatmaps = pyramids[0], heatmaps[0]
+    references = []
+    max_abs_diff = dict((fcn_names[ix], 0.) for ix in packing_fcns if ix < len(fcns))
+    for (scale_factor, heatmap_h, heatmap_w), scale_heatmaps in zip(pyramid, image_heatmaps):
+        # the FCNs not packed are computed scale by scale in both cases
+        references.append(list(scale_heatmaps))
+        for ix, fcn in enumerate(fcns):
+            if ix not in packing_fcns:
+                continue
+            input_size = (kernel_sizes[ix] + (heatmap_h - 1) * 32, kernel_sizes[ix] + (heatmap_w - 1) * 32)
+            reference = predict_from_filename(fcn, input_fn, input_size, preprocess_func[ix])[0]
+            if reference.shape != scale_heatmaps[ix].shape:
+                raise ValueError("Packed heatmap of " + fcn_names[ix] + " at scale " + str(scale_factor) + " has shape "
+                                 + str(scale_heatmaps[ix].shape) + " instead of " + str(reference.shape))
+            diff = float(np.max(np.abs(reference - scale_heatmaps[ix])))
+            assert diff <= packing_tolerance, "Packed heatmap of {} at scale {} differs from the unpacked one " \
+                                              "(max difference {})".format(fcn_names[ix], scale_factor, diff)
+            max_abs_diff[fcn_names[ix]] = max(max_abs_diff[fcn_names[ix]], diff)
+            references[-1][ix] = reference
+    packed_crop = select_best_crop(fuse_pyramid(pyramid, image_heatmaps, input_cix))
+    crop = select_best_crop(fuse_pyramid(pyramid, references, input_cix))
+    assert packed_crop["factor"] == crop["factor"] and packed_crop["ix"] == crop["ix"], \
+        "Packing selects the crop {} at scale {} instead of {} at scale {}".format(
+            packed_crop["ix"], packed_crop["factor"], crop["ix"], crop["factor"])
+    return max_abs_diff
+
 def select_best_crop(res_list):
     return max(res_list, key=lambda res: (res["nfcn_clf_ix"], res["score"]))
 
 def traslation(heat_coord, factor, fcn_stride=32):
     return(int(fcn_stride * heat_coord / factor))
 
-file_list = []
-set = "test"
-class_folders = os.listdir(os.path.join(dataset_path, set))
-folder_to_scan = 101
-instances_per_folder = 250
-
-for i_folder, class_folder in enumerate(class_folders[0:folder_to_scan]):
-    instances = os.listdir(os.path.join(dataset_path, set, class_folder))
-    for i_instance, instance in enumerate(instances[0:instances_per_folder]):
-        filename = os.path.join(dataset_path, set, class_folder, instance)
-        file_list.append((filename, class_folder))
-
-# for statics
-factors = np.empty(len(file_list))
-scores = np.empty(len(file_list))
-nfcns = np.empty(len(file_list), dtype=int)
-
-# for exporting crops coordinates
-crops_list = []
-
-i_processed = 0
-for filename, class_folder in file_list:
-
-    img = image.load_img(filename)
-    img = image.img_to_array(img)
-    imgh, imgw = img.shape[0:2]
-
-    res_list = process_image(filename, class_name_to_idx(class_folder), (imgh, imgw))
-    crop = select_best_crop(res_list)
+# Images of the dataset split, as (filename, class folder), for the first instances_per_folder images of the first
+# folder_to_scan class folders
+def dataset_file_list(set="test", folder_to_scan=101, instances_per_folder=250):
+    file_list = []
+    class_folders = os.listdir(os.path.join(dataset_path, set))
+    for i_folder, class_folder in enumerate(class_folders[0:folder_to_scan]):
+        instances = os.listdir(os.path.join(dataset_path, set, class_folder))
+        for i_instance, instance in enumerate(instances[0:instances_per_folder]):
+            filename = os.path.join(dataset_path, set, class_folder, instance)
+            file_list.append((filename, class_folder))
+    return file_list
+
+# Crop record of the cropsdata file (the format read by yield_crops and export_crops.py) for the selected crop
+# of the FCNs with the given names
+def crop_record(filename, label, crop, names=None):
+    names = fcn_names if names is None else names
     coordh = traslation(crop["ix"][0], crop["factor"])
     coordw = traslation(crop["ix"][1], crop["factor"])
     rect_dim = int(295 / crop["factor"])
-
-    factors[i_processed] = crop["factor"]
-    scores[i_processed] = crop["score"]
-    nfcns[i_processed] = crop["nfcn_clf_ix"]
-
-    # debug-purpose
-    print("Max confidence", crop["score"], "at scale", crop["factor"],
-          "heatmap crop", (crop["ix"][0], crop["ix"][1]),
-          "in range [" + str(crop["heatmap_shape"][0]) + ", " + str(crop["heatmap_shape"][1]) + "] ->",
-          "relative img point", (coordh, coordw), "in range [" + str(imgh) + ", " + str(imgw) + "]")
-    # fig, ax = plt.subplots(1)
-    # ax.imshow(img / 255.)
-    # ax.set_title(class_folder)
-    # rect = patches.Rectangle((coordw, coordh), rect_dim, rect_dim, linewidth=2, edgecolor='g', facecolor='none')
-    # ax.add_patch(rect)
-    # plt.show()
-
-    ix_label = class_name_to_idx(class_folder)
-
-    crops_list.append(dict(filename=str(filename),
-                           label=str(class_folder),
-                           crop=dict(
+    return dict(filename=str(filename),
+                label=str(label),
+                crop=dict(
                     factor=float(crop["factor"]),
                     heath=int(crop["heatmap_shape"][0]),
                     heatw=int(crop["heatmap_shape"][1]),
@@ -364,19 +805,77 @@ for filename, class_folder in file_list:
                     cropixw=int(crop["ix"][1]),
                     score=float(crop["score"]),
                     nfcn=int(crop["nfcn_clf_ix"]),
-                    fcn=dict(vgg16FCN=str(crop["fcn_clf_ix"][0]),
-                             xceptionFCN=str(crop["fcn_clf_ix"][1]),
-                             incresv2FCN=str(crop["fcn_clf_ix"][2]),
-                             incv3FCN=str(crop["fcn_clf_ix"][3])
-                    )
+                    fcn={name: str(correct) for name, correct in zip(names, crop["fcn_clf_ix"])}
                 ),
-                           rect=dict(lower_left=(int(coordh), int(coordw)), side=int(rect_dim))
-                           )
-                      )
-
-    i_processed += 1
-    if i_processed % instances_per_folder == 0:
-        print(time.strftime("%Y-%m-%d %H:%M:%S") + " started class " + str(i_processed//instances_per_folder) + " of " + str(folder_to_scan))
-
-print("Averages: score", np.mean(scores), "nfcn", np.mean(nfcns), "factor", np.mean(factors))
-pickle.dump(crops_list, open("cropsdata.pickle", "wb"), protocol=pickle.HIGHEST_PROTOCOL)
\ No newline at end of file
+                rect=dict(lower_left=(int(coordh), int(coordw)), side=int(rect_dim)))
+
+if __name__ == "__main__":
+    memory_growth_config(model_name="localization")
+    FCNs = fcn_ensemble()
+
+    folder_to_scan = 101
+    instances_per_folder = 250
+    file_list = dataset_file_list("test", folder_to_scan, instances_per_folder)
+
+    # for statics
+    factors = np.empty(len(file_list))
+    scores = np.empty(len(file_list))
+    nfcns = np.empty(len(file_list), dtype=int)
+
+    # for exporting crops coordinates
+    crops_list = []
+
+    i_processed = 0
+    for filename, class_folder in file_list:
+        image_start = time.perf_counter()
+
+        with profiler.stage("driver/image_load"):
+            imgh, imgw = image_shape(filename)
+
+        if PACKING and i_processed < packing_validation_images:
+            print("Packing validation:", validate_packing(filename, class_name_to_idx(class_folder), (imgh, imgw)))
+        res_list = process_image(filename, class_name_to_idx(class_folder), (imgh, imgw))
+        with profiler.stage("driver/select_best_crop"):
+            crop = select_best_crop(res_list)
+        coordh = traslation(crop["ix"][0], crop["factor"])
+        coordw = traslation(crop["ix"][1], crop["factor"])
+        rect_dim = int(295 / crop["factor"])
+
+        factors[i_processed] = crop["factor"]
+        scores[i_processed] = crop["score"]
+        nfcns[i_processed] = crop["nfcn_clf_ix"]
+
+        # debug-purpose
+        print("Max confidence", crop["score"], "at scale", crop["factor"],
+              "heatmap crop", (crop["ix"][0], crop["ix"][1]),
+              "in range [" + str(crop["heatmap_shape"][0]) + ", " + str(crop["heatmap_shape"][1]) + "] ->",
+              "relative img point", (coordh, coordw), "in range [" + str(imgh) + ", " + str(imgw) + "]")
+        # fig, ax = plt.subplots(1)
+        # ax.imshow(image.load_img(filename))
+        # ax.set_title(class_folder)
+        # rect = patches.Rectangle((coordw, coordh), rect_dim, rect_dim, linewidth=2, edgecolor='g', facecolor='none')
+        # ax.add_patch(rect)
+        # plt.show()
+
+        ix_label = class_name_to_idx(class_folder)
+
+        crops_list.append(crop_record(filename, class_folder, crop))
+
+        if PROFILING:
+            profiler.add("driver/image_total", time.perf_counter() - image_start, (imgh, imgw))
+        i_processed += 1
+        if i_processed % instances_per_folder == 0:
+            print(time.strftime("%Y-%m-%d %H:%M:%S") + " started class " + str(i_processed//instances_per_folder) + " of " + str(folder_to_scan))
+        if PROFILING and i_processed % profiling_interval == 0:
+            profiler.dump(i_processed)
+
+    print("Averages: score", np.mean(scores), "nfcn", np.mean(nfcns), "factor", np.mean(factors))
+    if CASCADE:
+        print("Cascade: {} forward passes run, {} skipped ({:.1f}% saved)".format(
+            forward_passes["run"], forward_passes["skipped"],
+            100. * forward_passes["skipped"] / max(1, forward_passes["run"] + forward_passes["skipped"])))
+    with profiler.stage("driver/output_write"):
+        pickle.dump(crops_list, open("cropsdata.pickle", "wb"), protocol=pickle.HIGHEST_PROTOCOL)
+    if PROFILING:
+        profiler.dump(i_processed, final=True)
+        profiler.summary()
@@ -1,3 +1,5 @@
+import os
+import numpy as np
 import keras
 from keras.models import Model
 from keras.regularizers import l2
@@ -5,85 +7,112 @@ from keras.preprocessing.image import ImageDataGenerator
 from keras.layers import Dense, BatchNormalization, LeakyReLU, GlobalAveragePooling2D, Dropout
 
 from utils.crop_generator import yield_crops
-
-# Test-set evaluation using Keras evaluate_generator function
-def eval_on_orig_cropped_test_set(model, input_size, input_name, preprocess_func, cropfilename):
+from utils.classification_metrics import ClassificationMetrics, compare_per_class, save_comparison
+from utils.plot_utils import save_confusion_matrix, save_confusion_matrix_delta
+from utils.weight_bundles import load_weights
+
+# Streams steps batches of the generator through the model, accumulating the metrics of every prediction
+def accumulate_predictions(model, generator, steps, metrics):
+    for _ in range(steps):
+        x, y = next(generator)
+        if isinstance(y, dict):
+            y = list(y.values())[0]
+        metrics.update(y, model.predict_on_batch(x))
+    return metrics
+
+
+# Test-set evaluation on the original and cropped images: aggregate loss/top-1/top-5 plus, from the same
+# predictions, confusion matrices and per-class accuracies saved in results_dir (if given).
+# The loss is the categorical crossentropy, without the regularization terms of the training loss.
+def eval_on_orig_cropped_test_set(model, input_size, input_name, preprocess_func, cropfilename, steps=25250,
+                                  results_dir=None):
     test_datagen = ImageDataGenerator(preprocessing_function=preprocess_func)
     validation_generator = test_datagen.flow_from_directory(
         'dataset-ethz101food/test',
         target_size=input_size,
         batch_size=1,
         class_mode='categorical')
-    model.compile(loss='categorical_crossentropy', optimizer='rmsprop', metrics=['categorical_accuracy', 'top_k_categorical_accuracy'])
-    (loss, top1acc, top5acc) = model.evaluate_generator(validation_generator, 25250)
-    print("Original classification accuracy: loss {:.4f}, top1 {:.4f}%, top5 {:.4f}%".format(loss, top1acc * 100, top5acc * 100))
-
-    (loss, top1acc, top5acc) = model.evaluate_generator(yield_crops(cropfilename=cropfilename,
-                                                          input_size=input_size,
-                                                          preprocess_func=preprocess_func,
-                                                          input_name=input_name), 25250)
-    print("Crop classification accuracy: loss {:.4f}, top1 {:.4f}%, top5 {:.4f}%".format(loss, top1acc * 100, top5acc * 100))
+    orig = accumulate_predictions(model, validation_generator, steps, ClassificationMetrics())
+    print("Original classification accuracy: loss {:.4f}, top1 {:.4f}%, top5 {:.4f}%".format(orig.loss, orig.top1 * 100, orig.topk * 100))
+
+    crop = accumulate_predictions(model, yield_crops(cropfilename=cropfilename,
+                                                     input_size=input_size,
+                                                     preprocess_func=preprocess_func,
+                                                     input_name=input_name), steps, ClassificationMetrics())
+    print("Crop classification accuracy: loss {:.4f}, top1 {:.4f}%, top5 {:.4f}%".format(crop.loss, crop.top1 * 100, crop.topk * 100))
+
+    with open("dataset-ethz101food/meta/classes.txt") as file:
+        class_names = [label.strip('\n') for label in file.readlines()]
+    comparison = compare_per_class(orig, crop, class_names)
+    evaluated = [row for row in comparison if not np.isnan(row["top1_delta"])]
+    print("Classes helped the most by cropping:", ", ".join("{} ({:+.1f}%)".format(row["label"], row["top1_delta"] * 100)
+                                                           for row in evaluated[:5]))
+    print("Classes hurt the most by cropping:", ", ".join("{} ({:+.1f}%)".format(row["label"], row["top1_delta"] * 100)
+                                                         for row in evaluated[::-1][:5]))
+    if results_dir:
+        os.makedirs(results_dir, exist_ok=True)
+        orig.save(os.path.join(results_dir, "metrics_orig.npz"))
+        crop.save(os.path.join(results_dir, "metrics_crop.npz"))
+        save_comparison(comparison, os.path.join(results_dir, "per_class_orig_vs_crop.json"))
+        save_confusion_matrix(orig.confusion, class_names, os.path.join(results_dir, "confusion_orig.png"),
+                              title='Confusion matrix (original)')
+        save_confusion_matrix(crop.confusion, class_names, os.path.join(results_dir, "confusion_crop.png"),
+                              title='Confusion matrix (cropped)')
+        save_confusion_matrix_delta(orig.confusion, crop.confusion, class_names,
+                                    os.path.join(results_dir, "confusion_crop_minus_orig.png"),
+                                    title='Confusion matrix, cropped - original')
+    return orig, crop
 
 
 # -----------------------------------
-# CLFs
-vgg16CLF = keras.applications.vgg16.VGG16(include_top=False, weights='imagenet', input_shape=(224, 224, 3))
-x = GlobalAveragePooling2D()(vgg16CLF.output)
-out = Dense(101, activation='softmax', name='output_layer')(x)
-vgg16CLF = Model(inputs=vgg16CLF.input, outputs=out)
-vgg16CLF.load_weights("trained_models/top5_vgg16_acc77_2017-12-24/vgg16_ft_weights_acc0.78_e15_2017-12-23_22-53-03.hdf5")
-
-vgg19CLF = keras.applications.vgg19.VGG19(include_top=False, weights='imagenet', input_shape=(224, 224, 3))
-x = GlobalAveragePooling2D()(vgg19CLF.output)
-out = Dense(101, activation='softmax', name='output_layer')(x)
-vgg19CLF = Model(inputs=vgg19CLF.input, outputs=out)
-vgg19CLF.load_weights("trained_models/top4_vgg19_acc78_2017-12-23/vgg19_ft_weights_acc0.78_e26_2017-12-22_23-55-53.hdf5")
-
-xceptionCLF = keras.applications.xception.Xception(include_top=False, weights='imagenet', input_shape=(299, 299, 3))
-x = GlobalAveragePooling2D()(xceptionCLF.output)
-out = Dense(101, activation='softmax', name='output_layer')(x)
-xceptionCLF = Model(inputs=xceptionCLF.input, outputs=out)
-xceptionCLF.load_weights("trained_models/top1_xception_acc80_2017-12-25/xception_ft_weights_acc0.81_e9_2017-12-24_13-00-22.hdf5")
-
-incresv2CLF = keras.applications.inception_resnet_v2.InceptionResNetV2(include_top=False, weights='imagenet', input_shape=(299, 299, 3))
-x = GlobalAveragePooling2D()(incresv2CLF.output)
-out = Dense(101, activation='softmax', name='output_layer')(x)
-incresv2CLF = Model(inputs=incresv2CLF.input, outputs=out)
-incresv2CLF.load_weights("trained_models/top2_incresnetv2_acc79_2017-12-22/incv2resnet_ft_weights_acc0.79_e4_2017-12-21_09-02-16.hdf5")
-
-incv3CLF = keras.applications.inception_v3.InceptionV3(include_top=False, weights='imagenet', input_shape=(299, 299, 3))
-x = GlobalAveragePooling2D()(incv3CLF.output)
-x = Dense(1024, kernel_initializer='he_uniform', bias_initializer="he_uniform", kernel_regularizer=l2(.0005), bias_regularizer=l2(.0005))(x)
-x = LeakyReLU()(x)
-x = BatchNormalization()(x)
-x = Dropout(0.5)(x)
-x = Dense(512, kernel_initializer='he_uniform', bias_initializer="he_uniform", kernel_regularizer=l2(.0005), bias_regularizer=l2(.0005))(x)
-x = LeakyReLU()(x)
-x = BatchNormalization()(x)
-x = Dropout(0.5)(x)
-out = Dense(101, kernel_initializer='he_uniform', bias_initializer="he_uniform", activation='softmax', name='output_layer')(x)
-incv3CLF = Model(inputs=incv3CLF.input, outputs=out)
-incv3CLF.load_weights("trained_models/top3_inceptionv3_acc79_2017-12-27/inceptionv3_ft_weights_acc0.79_e10_2017-12-25_22-10-02.hdf5")
-
-cropfilename = "results/cropping_eval/cropsdata.pickle"
-
-print("VGG16")
-eval_on_orig_cropped_test_set(vgg16CLF, (224, 224), vgg16CLF.get_config()['layers'][0]['config']['name'],
-                              keras.applications.vgg16.preprocess_input, cropfilename)
-
-print("\nVGG19")
-eval_on_orig_cropped_test_set(vgg19CLF, (224, 224), vgg19CLF.get_config()['layers'][0]['config']['name'],
-                              keras.applications.vgg19.preprocess_input, cropfilename)
-
-print("\nXCEPTION")
-eval_on_orig_cropped_test_set(xceptionCLF, (299, 299), xceptionCLF.get_config()['layers'][0]['config']['name'],
-                              keras.applications.xception.preprocess_input, cropfilename)
-
-print("\nINCEPTION_RESNET_V2")
-eval_on_orig_cropped_test_set(incresv2CLF, (299, 299), incresv2CLF.get_config()['layers'][0]['config']['name'],
-                              keras.applications.inception_resnet_v2.preprocess_input, cropfilename)
-
-print("\nINCEPTION_V3")
-eval_on_orig_cropped_test_set(incv3CLF, (299, 299), incv3CLF.get_config()['layers'][0]['config']['name'],
-                              keras.applications.inception_v3.preprocess_input, cropfilename)
-
+# CLFs: architecture, input size, preprocessing function and fine-tuned weights
+classifiers = {
+    "vgg16": (keras.applications.vgg16.VGG16, (224, 224), keras.applications.vgg16.preprocess_input,
+              "trained_models/top5_vgg16_acc77_2017-12-24/vgg16_ft_weights_acc0.78_e15_2017-12-23_22-53-03.hdf5"),
+    "vgg19": (keras.applications.vgg19.VGG19, (224, 224), keras.applications.vgg19.preprocess_input,
+              "trained_models/top4_vgg19_acc78_2017-12-23/vgg19_ft_weights_acc0.78_e26_2017-12-22_23-55-53.hdf5"),
+    "xception": (keras.applications.xception.Xception, (299, 299), keras.applications.xception.preprocess_input,
+                 "trained_models/top1_xception_acc80_2017-12-25/xception_ft_weights_acc0.81_e9_2017-12-24_13-00-22.hdf5"),
+    "incresv2": (keras.applications.inception_resnet_v2.InceptionResNetV2, (299, 299),
+                 keras.applications.inception_resnet_v2.preprocess_input,
+                 "trained_models/top2_incresnetv2_acc79_2017-12-22/incv2resnet_ft_weights_acc0.79_e4_2017-12-21_09-02-16.hdf5"),
+    "incv3": (keras.applications.inception_v3.InceptionV3, (299, 299), keras.applications.inception_v3.preprocess_input,
+              "trained_models/top3_inceptionv3_acc79_2017-12-27/inceptionv3_ft_weights_acc0.79_e10_2017-12-25_22-10-02.hdf5"),
+}
+
+
+# Builds one of the fine-tuned classifiers, with random weights if not trained (e.g. for benchmarking)
+def build_classifier(architecture, trained=True):
+    base_model, input_size, _, weights_fn = classifiers[architecture]
+    # the fine-tuned weights replace all the ImageNet ones, which are not loaded
+    clf = base_model(include_top=False, weights=None, input_shape=input_size + (3,))
+    x = GlobalAveragePooling2D()(clf.output)
+    if architecture == "incv3":
+        x = Dense(1024, kernel_initializer='he_uniform', bias_initializer="he_uniform", kernel_regularizer=l2(.0005), bias_regularizer=l2(.0005))(x)
+        x = LeakyReLU()(x)
+        x = BatchNormalization()(x)
+        x = Dropout(0.5)(x)
+        x = Dense(512, kernel_initializer='he_uniform', bias_initializer="he_uniform", kernel_regularizer=l2(.0005), bias_regularizer=l2(.0005))(x)
+        x = LeakyReLU()(x)
+        x = BatchNormalization()(x)
+        x = Dropout(0.5)(x)
+        out = Dense(101, kernel_initializer='he_uniform', bias_initializer="he_uniform", activation='softmax', name='output_layer')(x)
+    else:
+        out = Dense(101, activation='softmax', name='output_layer')(x)
+    clf = Model(inputs=clf.input, outputs=out)
+    if trained:
+        load_weights(clf, weights_fn)
+    return clf
+
+
+if __name__ == "__main__":
+    cropfilename = "results/cropping_eval/cropsdata.pickle"
+
+    for i, (architecture, title) in enumerate([("vgg16", "VGG16"), ("vgg19", "VGG19"), ("xception", "XCEPTION"),
+                                               ("incresv2", "INCEPTION_RESNET_V2"), ("incv3", "INCEPTION_V3")]):
+        clf = build_classifier(architecture)
+        _, input_size, preprocess_func, _ = classifiers[architecture]
+        print(("\n" if i > 0 else "") + title)
+        eval_on_orig_cropped_test_set(clf, input_size, clf.get_config()['layers'][0]['config']['name'],
+                                      preprocess_func, cropfilename,
+                                      results_dir=os.path.join("results/cropping_eval", architecture))
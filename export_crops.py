@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+import pickle
+import argparse
+import multiprocessing
+import numpy as np
+
+from utils.image_decoding import load_crop
+
+# Materializes the cropped Food-101 dataset described by the crop records written by ensemble_localization.py.
+# For every target resolution the crops are written either as a class-folder tree usable by flow_from_directory
+# (<output>/<resolution>/<set>/<class>/<image>.jpg) or as packed uint8 shards (<output>/<resolution>/shard_*.npz).
+# A manifest keeps the signature of every exported record, so that a new run only exports new or changed records.
+
+parser = argparse.ArgumentParser(description='script used to export the cropped dataset')
+parser.add_argument('--crops', type=str, default='cropsdata.pickle', help='crop records file. Default: cropsdata.pickle')
+parser.add_argument('--output', type=str, default='dataset-ethz101food-cropped', help='output directory')
+parser.add_argument('--resolutions', type=int, nargs='+', default=[224, 299], help='crops side. Default: 224 299')
+parser.add_argument('--format', type=str, default='folders', choices=['folders', 'shards'], help='output format')
+parser.add_argument('--shards', type=int, default=64, help='number of shards per resolution. Default: 64')
+parser.add_argument('--quality', type=int, default=95, help='JPEG quality of the folders format. Default: 95')
+parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of export processes')
+
+dataset_path = "dataset-ethz101food"
+manifest_filename = "manifest.json"
+
+
+# Path of the exported crop relative to the resolution directory, e.g. test/apple_pie/1011328.jpg
+def relative_path(record):
+    parts = os.path.normpath(record["filename"]).split(os.sep)
+    if dataset_path in parts[:-1]:
+        return os.path.join(*parts[len(parts) - 1 - parts[::-1].index(dataset_path) + 1:])
+    return os.path.join(record["label"], os.path.basename(record["filename"]))
+
+
+# Changes when the crop rect or the source image change
+def record_signature(record):
+    mtime = os.path.getmtime(record["filename"]) if os.path.exists(record["filename"]) else 0
+    return "{}|{}|{}|{:.0f}".format(record["rect"]["lower_left"][0], record["rect"]["lower_left"][1],
+                                    record["rect"]["side"], mtime)
+
+
+# Stable shard of a crop, from the hash of its path
+def shard_index(path, n_shards):
+    return int(hashlib.md5(path.encode()).hexdigest(), 16) % n_shards
+
+
+def crop_array(record, resolution):
+    img = load_crop(record["filename"], (int(record["rect"]["lower_left"][0]), int(record["rect"]["lower_left"][1])),
+                    int(record["rect"]["side"]), (resolution, resolution))
+    return np.asarray(img, dtype=np.uint8)
+
+
+# Worker task of the folders format: writes the crops of a record at every resolution
+def export_record(task):
+    record, output, resolutions, quality = task
+    from PIL import Image
+    for resolution in resolutions:
+        out_filename = os.path.join(output, str(resolution), relative_path(record))
+        os.makedirs(os.path.dirname(out_filename), exist_ok=True)
+        Image.fromarray(crop_array(record, resolution)).save(out_filename, quality=quality)
+    return relative_path(record)
+
+
+# Worker task of the shards format: writes one shard at one resolution
+def export_shard(task):
+    records, output, resolution, shard = task
+    out_filename = os.path.join(output, str(resolution), "shard_{:05d}.npz".format(shard))
+    os.makedirs(os.path.dirname(out_filename), exist_ok=True)
+    images = np.empty((len(records), resolution, resolution, 3), dtype=np.uint8)
+    for i, record in enumerate(records):
+        images[i] = crop_array(record, resolution)
+    tmp_filename = out_filename + ".tmp.npz"
+    np.savez(tmp_filename, images=images, labels=np.array([record["label"] for record in records]),
+             filenames=np.array([relative_path(record) for record in records]))
+    os.replace(tmp_filename, out_filename)
+    return shard
+
+
+def load_manifest(output):
+    manifest_path = os.path.join(output, manifest_filename)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    return {}
+
+
+def save_manifest(output, manifest):
+    manifest_path = os.path.join(output, manifest_filename)
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def export_crops(crops, output, resolutions, export_format='folders', n_shards=64, quality=95, workers=1):
+    os.makedirs(output, exist_ok=True)
+    manifest = load_manifest(output)
+    config = dict(format=export_format, resolutions=sorted(resolutions), shards=n_shards, quality=quality)
+    if manifest.get("config") != config:
+        # a different output layout invalidates everything exported before
+        manifest = dict(config=config, records={})
+    exported = manifest["records"]
+    signatures = {relative_path(record): record_signature(record) for record in crops}
+    changed = [record for record in crops if exported.get(relative_path(record)) != signatures[relative_path(record)]]
+    removed = [path for path in exported if path not in signatures]
+    print("{} crop records: {} new or changed, {} removed".format(len(crops), len(changed), len(removed)))
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        if export_format == 'folders':
+            for path in removed:
+                for resolution in resolutions:
+                    stale = os.path.join(output, str(resolution), path)
+                    if os.path.exists(stale):
+                        os.remove(stale)
+                del exported[path]
+            tasks = ((record, output, resolutions, quality) for record in changed)
+            for i, path in enumerate(pool.imap_unordered(export_record, tasks, chunksize=16)):
+                exported[path] = signatures[path]
+                if (i + 1) % 1000 == 0:
+                    print("Exported", i + 1, "of", len(changed))
+                    save_manifest(output, manifest)
+        else:
+            # a shard is rewritten entirely when any of its records is new, changed or removed
+            shards = [[] for _ in range(n_shards)]
+            for record in crops:
+                shards[shard_index(relative_path(record), n_shards)].append(record)
+            dirty = {shard_index(relative_path(record), n_shards) for record in changed}
+            dirty |= {shard_index(path, n_shards) for path in removed}
+            tasks = [(shards[shard], output, resolution, shard) for shard in sorted(dirty) for resolution in resolutions]
+            for i, _ in enumerate(pool.imap_unordered(export_shard, tasks)):
+                print("Exported shard", i + 1, "of", len(tasks))
+            for path in removed:
+                del exported[path]
+            for shard in dirty:
+                for record in shards[shard]:
+                    exported[relative_path(record)] = signatures[relative_path(record)]
+    finally:
+        pool.close()
+        pool.join()
+        save_manifest(output, manifest)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with open(args.crops, "rb") as cropfile:
+        crops = pickle.load(cropfile)
+    export_crops(crops, args.output, args.resolutions, args.format, args.shards, args.quality, args.workers)
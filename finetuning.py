@@ -1,11 +1,11 @@
 import os
 import sys
 import signal
+import argparse
 import time
 import json
 
 import keras
-from keras.preprocessing.image import ImageDataGenerator
 from keras.layers import GlobalAveragePooling2D, Dense, Dropout, BatchNormalization, Flatten
 from keras.layers.advanced_activations import LeakyReLU
 from keras.models import Model
@@ -13,20 +13,57 @@ from keras.regularizers import l2
 
 from utils.plot_utils import save_acc_loss_plots
 from utils.randomization import lower_randomization_effects
-from utils.callbacks import checkpointer, early_stopper, lr_reducer, csv_logger
+from utils.callbacks import checkpointer, early_stopper, lr_reducer, csv_logger, throughput_logger
 from utils.memory_management import memory_growth_config
 from utils.outputs_directories import create_empty_directories
+from utils.augmentation import BatchImageDataGenerator
+from utils.progressive_resizing import resizing_phases, merge_histories, PhaseStateCarrier
+from utils.training_state import TrainingStateSaver, load_training_state, history_from_dict
+from utils.batch_sizing import probe_batch_size, GradientAccumulation, has_gpu, cpu_memory_limit_mb
+from utils.validation_subset import validation_subset, SubsetValidation, GeneratorValidation
+from utils.data_parallel import launch_local_ranks, Communicator, AllReduceOptimizer, AverageReplicaState, \
+    FollowRankZero, default_master
+
+parser = argparse.ArgumentParser(description='script used to fine-tune a network on Food-101')
+parser.add_argument('batch_size', type=int, nargs='?', default=32, help='training batch size. Default: 32')
+parser.add_argument('--resume', type=str, help='training state snapshot (models/*_trainstate_*.pickle) to resume from')
+parser.add_argument('--workers', type=int, default=1,
+                    help='data parallel training processes on this host, each training on batch_size / (workers * hosts) '
+                         'images of every batch. Default: 1')
+parser.add_argument('--hosts', type=int, default=1, help='hosts of the data parallel training. Default: 1')
+parser.add_argument('--host_rank', type=int, default=0, help='index of this host, 0 on the master host. Default: 0')
+parser.add_argument('--master', type=str, default=default_master,
+                    help='address:port of the first process of the master host. Default: ' + default_master)
+args = parser.parse_args()
+
+# data parallel training: this process starts the other ranks of its host, rank 0 writes all the outputs
+communicator = None
+rank = 0
+if args.workers * args.hosts > 1:
+    if args.batch_size % (args.workers * args.hosts):
+        raise ValueError('The batch size has to be a multiple of the number of data parallel processes')
+    rank = launch_local_ranks(args.workers, args.host_rank)
+    communicator = Communicator(rank, args.workers * args.hosts, args.master)
+resumed_state = load_training_state(args.resume) if args.resume and rank == 0 else None
+if communicator:
+    # the other ranks resume at the same stage and epoch, also without access to the snapshot file
+    resumed_state = communicator.broadcast(resumed_state)
 
 create_empty_directories(['results','logs', 'models'], empty_dirs=False)
 lower_randomization_effects()
-memory_growth_config()
 
 IMG_WIDTH = 299
 IMG_HEIGHT = 299
+# progressive resizing: each training stage starts at lower resolution (with larger batches) and ends at IMG_WIDTH.
+# (side, epochs) phases, None epochs means the remaining epochs of the stage. Requires a variable size network input.
+PROGRESSIVE_RESIZING = False
+resizing_schedule = [(160, 3), (224, 3), (IMG_WIDTH, None)] if PROGRESSIVE_RESIZING else None
+input_shape = (None, None, 3) if PROGRESSIVE_RESIZING else (IMG_WIDTH, IMG_HEIGHT, 3)
 # network to finetune
 from keras.applications.xception import preprocess_input
 model_name = 'xception'
-base_model = keras.applications.xception.Xception(include_top=False, weights='imagenet', input_shape=(IMG_WIDTH, IMG_HEIGHT, 3))
+memory_growth_config(model_name=model_name, processes=args.workers)
+base_model = keras.applications.xception.Xception(include_top=False, weights='imagenet', input_shape=input_shape)
 
 # 80% - 3dLRBN - 30bs - keras.applications.xception.Xception(include_top=False, weights='imagenet', input_shape=(IMG_WIDTH, IMG_HEIGHT, 3))
 # 79% - 1dense - 32bs - keras.applications.inception_resnet_v2.InceptionResNetV2(include_top=False, weights='imagenet', input_shape=(IMG_WIDTH, IMG_HEIGHT, 3))
@@ -91,13 +128,32 @@ custom_model = Model(inputs=base_model.input, outputs=topnet_output)
 base_model_nlayers = len(base_model.layers)
 topnn_nlayers = len(custom_model.layers) - base_model_nlayers
 
-print('Network structure')
-custom_model.summary()
+if rank == 0:
+    print('Network structure')
+    custom_model.summary()
 
 data_augmentation_level = 4
+# memory-aware batch sizing (off by default): at every training stage the largest micro-batch that fits in memory for
+# the trainable layers is probed, and the gradients of batch_size // micro-batch steps are accumulated, so that the
+# effective batch size stays batch_size on every host. On CPU hosts, where an allocation failure kills the process,
+# the probe needs a memory limit (MB of process RSS): None derives it from the memory available on the host, and the
+# probe is skipped when that is unknown.
+BATCH_PROBING = False
+batch_memory_limit_mb = None
+
+# cheap validation: the epochs are validated on a cached class-stratified subset of the test split (images per class),
+# the whole split only every full_validation_every epochs and at the end of each stage. None (default) validates
+# every epoch on the whole split.
+validation_subset_per_class = None
+full_validation_every = 5
+
+# number of fit_generator workers preparing the augmented batches, processes if augmentation_multiprocessing is set.
+# They are shared among the data parallel ranks of a host.
+augmentation_workers = max(1, 4 // args.workers)
+augmentation_multiprocessing = True
 
 dict_augmentation = dict(preprocessing_function=preprocess_input)
-test_datagen = ImageDataGenerator(**dict_augmentation)
+test_datagen = BatchImageDataGenerator(**dict_augmentation)
 
 if data_augmentation_level > 0:
     dict_augmentation["horizontal_flip"] = True
@@ -114,12 +170,14 @@ if data_augmentation_level > 3:
     dict_augmentation["shear_range"] = 0.2
     dict_augmentation["rotation_range"] = 40
 
-train_datagen = ImageDataGenerator(**dict_augmentation)
+train_datagen = BatchImageDataGenerator(**dict_augmentation)
 
 # Training function.
 # Takes all the necessary parameter and train the model for the specified epochs, optionally evaluating it at the end.
 def train_top_n_layers(model, threshold_train, epochs, optimizer, batch_size=32, callbacks=None, train_steps=None,
-                       val_steps=None, test_epoch_end=True, top5acc_metric=True):
+                       val_steps=None, test_epoch_end=True, top5acc_metric=True, workers=augmentation_workers,
+                       use_multiprocessing=augmentation_multiprocessing, resizing_schedule=None, initial_epoch=0,
+                       probe_batch=False, subset_per_class=None, full_every=None, communicator=None):
     ltrained = lfreezed = 0
     for i in range(len(model.layers)):
         if i < threshold_train:
@@ -128,64 +186,174 @@ def train_top_n_layers(model, threshold_train, epochs, optimizer, batch_size=32,
         else:
             model.layers[i].trainable = True
             ltrained += 1
-    print('Training on {} layers, {} freezed layers'.format(ltrained, lfreezed))
-
-    # Keras generator yielding the augmented images of Food-101
-    train_generator = train_datagen.flow_from_directory(
-        'dataset-ethz101food/train',
-        target_size=(IMG_WIDTH, IMG_HEIGHT),
-        batch_size=batch_size,
-        class_mode='categorical')
-
-    validation_generator = test_datagen.flow_from_directory(
-        'dataset-ethz101food/test',
-        target_size=(IMG_WIDTH, IMG_HEIGHT),
-        batch_size=batch_size,
-        class_mode='categorical')
-    print('Batch size is ' + str(batch_size))
+    # data parallel training: every rank trains on its shard of the images, with its part of each batch
+    world_size = communicator.world_size if communicator else 1
+    is_rank_zero = communicator is None or communicator.rank == 0
+    if is_rank_zero:
+        print('Training on {} layers, {} freezed layers'.format(ltrained, lfreezed))
+
+    # re-probed at every stage, as the memory needed by a training step grows with the trainable layers
+    accumulation_steps = 1
+    memory_limit_mb = batch_memory_limit_mb
+    if probe_batch and memory_limit_mb is None and not has_gpu():
+        memory_limit_mb = cpu_memory_limit_mb(args.workers)
+        probe_batch = memory_limit_mb is not None
+    if communicator:
+        # the ranks probe together or not at all
+        probe_batch = all(communicator.allgather(probe_batch))
+    if probe_batch:
+        rank_batch_size = max(1, batch_size // world_size)
+        micro_batch_size = probe_batch_size(model, (IMG_HEIGHT, IMG_WIDTH, 3), rank_batch_size, optimizer,
+                                            memory_limit_mb=memory_limit_mb)
+        if communicator:
+            # the ranks step together, so they all use the micro-batch fitting on every one of them
+            micro_batch_size = min(communicator.allgather(micro_batch_size))
+        accumulation_steps = rank_batch_size // micro_batch_size
+        if is_rank_zero:
+            print('Batch probing: micro-batches of {} images, {} accumulation steps'.format(micro_batch_size, accumulation_steps))
+    # the gradients accumulated on every rank are averaged over the ranks only at the update steps
+    if communicator:
+        optimizer = AllReduceOptimizer(optimizer, communicator)
+    if accumulation_steps > 1:
+        optimizer = GradientAccumulation(optimizer, accumulation_steps)
 
     custom_model.compile(loss='categorical_crossentropy', optimizer=optimizer,
                          metrics=['categorical_accuracy', 'top_k_categorical_accuracy'] if top5acc_metric else ['categorical_accuracy'])
 
+    if resizing_schedule:
+        phases = resizing_phases(resizing_schedule, epochs, batch_size, full_size=IMG_WIDTH)
+    else:
+        phases = [dict(size=IMG_WIDTH, batch_size=batch_size, initial_epoch=0, epochs=epochs)]
+    # a resumed stage restarts from the first epoch not completed
+    phases = [dict(phase, initial_epoch=max(phase["initial_epoch"], initial_epoch)) for phase in phases
+              if phase["epochs"] > initial_epoch]
+
+    # checkpoints saved during a progressive resizing phase are tagged with its input size
+    model_savers = [c for c in callbacks or [] if isinstance(c, keras.callbacks.ModelCheckpoint)]
+    model_savers_filepaths = [c.filepath for c in model_savers]
+
+    # early stopping (patience, best value) and the other callbacks keep their state across the phases of the stage
+    phase_state = PhaseStateCarrier(callbacks or [])
+
     start = time.time()
-    history = model.fit_generator(train_generator,
-                                  steps_per_epoch=train_steps,
-                                  epochs=epochs, verbose=1,
-                                  validation_data=validation_generator,
-                                  validation_steps=val_steps,
-                                  callbacks=callbacks)
-    print('Training time {0:.2f} minutes'.format(-(start - time.time()) / 60))
-
-    if test_epoch_end:
+    phase_histories = []
+    for phase in phases:
+        # the generators yield micro-batches, accumulation_steps of them on each of the world_size ranks make a
+        # batch of the phase
+        micro_batch_size = max(1, phase["batch_size"] // (accumulation_steps * world_size))
+
+        # Keras generator yielding the augmented images of Food-101
+        train_generator = train_datagen.flow_from_directory(
+            'dataset-ethz101food/train',
+            target_size=(phase["size"], phase["size"]),
+            batch_size=micro_batch_size,
+            class_mode='categorical',
+            shard=(communicator.rank, world_size) if communicator else None)
+
+        # only rank 0 validates
+        validation_generator = test_datagen.flow_from_directory(
+            'dataset-ethz101food/test',
+            target_size=(phase["size"], phase["size"]),
+            batch_size=micro_batch_size,
+            class_mode='categorical') if is_rank_zero else None
+        if is_rank_zero and world_size > 1:
+            print('Batch size is {} ({} ranks, {} accumulated micro-batches of {})'.format(
+                micro_batch_size * accumulation_steps * world_size, world_size, accumulation_steps, micro_batch_size))
+        elif is_rank_zero and accumulation_steps > 1:
+            print('Batch size is {} ({} accumulated micro-batches of {})'.format(
+                micro_batch_size * accumulation_steps, accumulation_steps, micro_batch_size))
+        elif is_rank_zero:
+            print('Batch size is ' + str(micro_batch_size))
+
+        # the number of images seen per epoch is kept constant across phases, and an epoch ends with an update
+        phase_train_steps = train_steps * batch_size // (micro_batch_size * accumulation_steps * world_size) \
+            * accumulation_steps if train_steps else None
+        phase_val_steps = val_steps * batch_size // micro_batch_size if val_steps else None
+
+        if resizing_schedule:
+            if is_rank_zero:
+                print('Progressive resizing: epochs {} to {} at {}x{}'.format(phase["initial_epoch"] + 1, phase["epochs"],
+                                                                              phase["size"], phase["size"]))
+            for model_saver, filepath in zip(model_savers, model_savers_filepaths):
+                model_saver.filepath = filepath.replace('.hdf5', '_{}px.hdf5'.format(phase["size"]))
+
+        # only rank 0 validates and runs the callbacks, the other ranks follow its decisions
+        phase_callbacks = (callbacks or []) + [phase_state] if is_rank_zero else []
+        if subset_per_class and is_rank_zero:
+            # the subset validation sets the val_* metrics before the callbacks monitoring them
+            images, labels = validation_subset('dataset-ethz101food/test', (phase["size"], phase["size"]),
+                                               per_class=subset_per_class, cache_dir='cache')
+            phase_callbacks = [SubsetValidation(images, labels, preprocess_input, batch_size=micro_batch_size,
+                                                full_validation=(validation_generator, phase_val_steps),
+                                                full_every=full_every, workers=workers,
+                                                use_multiprocessing=use_multiprocessing)] + phase_callbacks
+        elif communicator and is_rank_zero:
+            # the validation of fit_generator would run before AverageReplicaState, with the statistics of rank 0
+            phase_callbacks = [GeneratorValidation(validation_generator, phase_val_steps, workers=workers,
+                                                   use_multiprocessing=use_multiprocessing)] + phase_callbacks
+        if communicator:
+            phase_callbacks = [AverageReplicaState(communicator)] + (phase_callbacks or []) + \
+                              [FollowRankZero(communicator)]
+
+        phase_histories.append(model.fit_generator(train_generator,
+                                                   steps_per_epoch=phase_train_steps,
+                                                   epochs=phase["epochs"], verbose=1 if is_rank_zero else 0,
+                                                   validation_data=None if subset_per_class or communicator
+                                                   else validation_generator,
+                                                   validation_steps=phase_val_steps,
+                                                   callbacks=phase_callbacks,
+                                                   workers=workers,
+                                                   use_multiprocessing=use_multiprocessing,
+                                                   initial_epoch=phase["initial_epoch"]))
+        # early stopping ends the stage, not only the phase
+        if model.stop_training:
+            break
+
+    for model_saver, filepath in zip(model_savers, model_savers_filepaths):
+        model_saver.filepath = filepath
+    history = merge_histories(phase_histories)
+    if is_rank_zero:
+        print('Training time {0:.2f} minutes'.format(-(start - time.time()) / 60))
+
+    if test_epoch_end and is_rank_zero:
         if top5acc_metric:
-            (loss, acc, top5acc) = model.evaluate_generator(validation_generator, val_steps)
+            (loss, acc, top5acc) = model.evaluate_generator(validation_generator, phase_val_steps, workers=workers, use_multiprocessing=use_multiprocessing)
             print("[EVAL] loss={:.4f}, top-1 accuracy: {:.4f}%, top-5 accuracy: {:.4f}%".format(loss, acc * 100, top5acc * 100))
         else:
-            (loss, acc) = model.evaluate_generator(validation_generator, val_steps)
+            (loss, acc) = model.evaluate_generator(validation_generator, phase_val_steps, workers=workers, use_multiprocessing=use_multiprocessing)
             print("[EVAL] loss={:.4f}, top-1 accuracy: {:.4f}%".format(loss, acc * 100))
     return history
 
 # Handling a smooth exit during training
 def close_signals_handler(signum, frame):
+    # forked data loading workers inherit the handler, only the training process saves the run
+    if os.getpid() != main_pid:
+        os._exit(1)
+    # the other data parallel ranks get the signal as well, rank 0 saves the run
+    if rank != 0:
+        os._exit(1)
     sys.stdout.flush()
     print('\n\nReceived KeyboardInterrupt (CTRL-C), preparing to exit')
-    save_acc_loss_plots(histories,
-                        os.path.join(os.getcwd(), 'results', plot_acc_file),
-                        os.path.join(os.getcwd(), 'results', plot_loss_file))
+    # the snapshot of the last completed epoch, the epoch in progress is run again on resume
+    state_saver.save()
+    print('Training state of the last completed epoch saved in ' + state_saver.filepath + ', use --resume to continue')
+    if histories:
+        save_acc_loss_plots(histories,
+                            os.path.join(os.getcwd(), 'results', plot_acc_file),
+                            os.path.join(os.getcwd(), 'results', plot_loss_file))
     sys.exit(1)
 
 
-signal.signal(signal.SIGTERM, close_signals_handler)
-signal.signal(signal.SIGINT, close_signals_handler)
-
-timestamp = time.strftime("%Y-%m-%d_%H-%M-%S")
+# a resumed run keeps writing on the files of the original one
+timestamp = resumed_state["config"]["timestamp"] if resumed_state else time.strftime("%Y-%m-%d_%H-%M-%S")
 
 # output filenames
 model_arch_file = model_name + '_architecture_' + timestamp + '.json'
 traincfg_file =  model_name + '_trainconfig_' + timestamp + '.json'
 logfile = model_name + '_ft_' + timestamp + '.csv'
-checkpoints_filename = model_name + '_ft_weights_acc{val_categorical_accuracy:.2f}_e{epoch:d}_' + time.strftime(
-    "%Y-%m-%d_%H-%M-%S") + '.hdf5'
+throughput_logfile = model_name + '_ft_throughput_' + timestamp + '.csv'
+checkpoints_filename = model_name + '_ft_weights_acc{val_categorical_accuracy:.2f}_e{epoch:d}_' + timestamp + '.hdf5'
+trainstate_file = model_name + '_trainstate_' + timestamp + '.pickle'
 plot_acc_file = model_name + '_ft_acc' + timestamp
 plot_loss_file = model_name + '_ft_loss' + timestamp
 
@@ -196,12 +364,13 @@ sgd = keras.optimizers.SGD(lr=1e-4, decay=1e-6, momentum=0.9, nesterov=True)
 
 # Keras callbacks used during training
 logger = csv_logger(logfile)
+throughput = throughput_logger(throughput_logfile)
 lr_reduce = lr_reducer(factor=0.1, patience=3)
 stopper = early_stopper(monitor='val_categorical_accuracy', patience=3)
 model_saver = checkpointer(checkpoints_filename, monitor="val_categorical_accuracy")
 
 # training parameters
-batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+batch_size = resumed_state["config"]["batch_size"] if resumed_state else args.batch_size
 train_steps = None or 75750 // batch_size
 val_steps = None or 25250 // batch_size
 epochs = 250
@@ -213,6 +382,15 @@ traincfg = {
     "batch_size": batch_size,
     "train_batches_per_epoch": train_steps,
     "val_batches_per_epoch": train_steps,
+    "data_augmentation_level": data_augmentation_level,
+    "augmentation_workers": augmentation_workers,
+    "resizing_schedule": resizing_schedule,
+    "batch_probing": BATCH_PROBING,
+    "batch_memory_limit_mb": batch_memory_limit_mb,
+    "validation_subset_per_class": validation_subset_per_class,
+    "full_validation_every": full_validation_every,
+    "data_parallel_workers": args.workers,
+    "data_parallel_hosts": args.hosts,
 
     "threshold_train_1": base_model_nlayers,
     "optimizer_train_1": "RMSPROP",
@@ -227,71 +405,67 @@ traincfg = {
     "ft_step": str(ft_bottumup_step),
 }
 
-# exporting training configuration
-with open(os.path.join(os.getcwd(), 'logs', traincfg_file), 'w') as outfile:
-    json.dump(traincfg, outfile, indent=2, sort_keys=True)
+# Keras callback saving the resumable training state, after the callbacks whose state it stores
+state_saver = TrainingStateSaver(trainstate_file, stateful_callbacks=[stopper, model_saver],
+                                 config=dict(timestamp=timestamp, batch_size=batch_size), state=resumed_state)
 
-# exporting network structure
-with open(os.path.join(os.getcwd(), 'models', model_arch_file), 'w') as outfile:
-    json.dump(json.loads(custom_model.to_json()), outfile, indent=2)
+if not resumed_state and rank == 0:
+    # exporting training configuration
+    with open(os.path.join(os.getcwd(), 'logs', traincfg_file), 'w') as outfile:
+        json.dump(traincfg, outfile, indent=2, sort_keys=True)
 
+    # exporting network structure
+    with open(os.path.join(os.getcwd(), 'models', model_arch_file), 'w') as outfile:
+        json.dump(json.loads(custom_model.to_json()), outfile, indent=2)
 
-train_time = time.time()
 
 # train last layers, then whole net
 if FT_TECNIQUE == twopass:
-    histories = [train_top_n_layers(
-        model=custom_model,
-        threshold_train=base_model_nlayers,
-        epochs=epochs,
-        optimizer=rmsprop,
-        batch_size=batch_size,
-        train_steps=train_steps, val_steps=val_steps,
-        callbacks=[stopper, logger, model_saver])]
-    histories.append(train_top_n_layers(
-        model=custom_model,
-        threshold_train=-1,
-        epochs=epochs,
-        optimizer=rmsprop,
-        batch_size=batch_size,
-        train_steps=train_steps, val_steps=val_steps,
-        callbacks=[stopper, logger, model_saver]))
+    thresholds = [base_model_nlayers, -1]
 
 # train last layers, then increase the trainability threshold using a fixed step
 elif FT_TECNIQUE == bottomup:
-    histories = [train_top_n_layers(
-        model=custom_model,
-        threshold_train=base_model_nlayers,
-        epochs=epochs,
-        optimizer=rmsprop,
-        batch_size=batch_size,
-        train_steps=train_steps, val_steps=val_steps,
-        callbacks=[stopper, logger, model_saver])]
-    for threshold in range(base_model_nlayers - ft_bottumup_step, -1, -ft_bottumup_step):
-        histories.append(train_top_n_layers(
-            model=custom_model,
-            threshold_train=threshold,
-            epochs=epochs,
-            optimizer=rmsprop,
-            batch_size=batch_size,
-            train_steps=train_steps, val_steps=val_steps,
-            callbacks=[stopper, logger, model_saver]))
+    thresholds = [base_model_nlayers] + list(range(base_model_nlayers - ft_bottumup_step, -1, -ft_bottumup_step))
 
 # train all the network layers together
 elif FT_TECNIQUE == whole_net:
-    histories = [train_top_n_layers(
-        model=custom_model,
-        threshold_train=-1,
-        epochs=epochs,
-        optimizer=rmsprop,
-        batch_size=batch_size,
-        train_steps=train_steps, val_steps=val_steps,
-        callbacks=[stopper, logger, model_saver])]
+    thresholds = [-1]
 
 else:
     raise ValueError('Unspecified training technique')
 
-print('Total training time {0:.2f} minutes'.format(-(train_time - time.time()) / 60))
-save_acc_loss_plots(histories,
-                    os.path.join(os.getcwd(), 'results', plot_acc_file),
-                    os.path.join(os.getcwd(), 'results', plot_loss_file))
+main_pid = os.getpid()
+histories = []
+signal.signal(signal.SIGTERM, close_signals_handler)
+signal.signal(signal.SIGINT, close_signals_handler)
+
+train_time = time.time()
+
+histories.extend(history_from_dict(history) for history in state_saver.histories)
+for stage, threshold in enumerate(thresholds):
+    if stage < state_saver.stage:
+        continue
+    initial_epoch = state_saver.begin_stage(stage, threshold)
+    resumed_history = history_from_dict(state_saver.stage_history) if initial_epoch > 0 else None
+    history = train_top_n_layers(
+        model=custom_model,
+        threshold_train=threshold,
+        epochs=epochs,
+        optimizer=rmsprop,
+        batch_size=batch_size,
+        train_steps=train_steps, val_steps=val_steps, resizing_schedule=resizing_schedule,
+        callbacks=[stopper, logger, throughput, model_saver, state_saver],
+        initial_epoch=initial_epoch, probe_batch=BATCH_PROBING,
+        subset_per_class=validation_subset_per_class, full_every=full_validation_every,
+        communicator=communicator)
+    if resumed_history is not None:
+        history = merge_histories([resumed_history, history])
+    histories.append(history)
+    if rank == 0:
+        state_saver.end_stage(history)
+
+if rank == 0:
+    print('Total training time {0:.2f} minutes'.format(-(train_time - time.time()) / 60))
+    save_acc_loss_plots(histories,
+                        os.path.join(os.getcwd(), 'results', plot_acc_file),
+                        os.path.join(os.getcwd(), 'results', plot_loss_file))
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import pickle
+import argparse
+import numpy as np
+from keras.preprocessing import image
+
+import ensemble_localization
+from ensemble_localization import fcn_ensemble, process_image, select_best_crop, crop_record, dataset_file_list, \
+    profiler
+from evaluation import classifiers, build_classifier
+from utils.image_decoding import image_shape, load_crop
+from utils.labels_ix_mapping import class_name_to_idx, ix_to_class_name
+from utils.classification_metrics import ClassificationMetrics
+from utils.memory_management import memory_growth_config
+
+# Streaming localize-then-classify pipeline: for every image, the ensemble localization selects the best crop,
+# which is cut from the image already decoded by the localization and batched into the configured classifiers.
+# Crop records and classifications are written to JSON lines files as they are produced, so neither the
+# cropsdata pickle nor a second decoding of the dataset in another process is needed to get the cropped predictions.
+#   python pipeline.py --classifiers xception incv3
+
+parser = argparse.ArgumentParser(description='fused localization and classification of the cropped images')
+parser.add_argument('--classifiers', type=str, nargs='+', default=['xception'], choices=sorted(classifiers),
+                    help='classifiers of the crops. Default: xception')
+parser.add_argument('--batch_size', type=int, default=16, help='crops per classifier batch. Default: 16')
+parser.add_argument('--set', type=str, default='test', help='dataset split. Default: test')
+parser.add_argument('--folders', type=int, default=101, help='number of class folders. Default: 101')
+parser.add_argument('--instances', type=int, default=250, help='images per class folder. Default: 250')
+parser.add_argument('--output', type=str, help='output directory. Default: results/pipeline_<time>')
+parser.add_argument('--top', type=int, default=5, help='predictions written per crop. Default: 5')
+parser.add_argument('--student', type=str, help='weights of a distilled student localizer (distillation.py) '
+                                                'used instead of the FCN ensemble')
+
+
+# Crops batched for one classifier, classified when the batch is full
+class CropClassifier(object):
+    def __init__(self, name, batch_size, predictions_file, top=5):
+        self.name = name
+        self.model = build_classifier(name)
+        _, self.input_size, self.preprocess, _ = classifiers[name]
+        self.batch_size = batch_size
+        self.predictions_file = predictions_file
+        self.top = top
+        self.metrics = ClassificationMetrics()
+        self.inputs = []
+        self.records = []
+
+    def add(self, crop_img, record):
+        self.inputs.append(self.preprocess(np.expand_dims(image.img_to_array(crop_img), axis=0)))
+        self.records.append(record)
+        if len(self.inputs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.inputs:
+            return
+        with profiler.stage("pipeline/classify/" + self.name, size=len(self.inputs)):
+            preds = self.model.predict_on_batch(np.concatenate(self.inputs))
+        labels = [class_name_to_idx(record["label"]) for record in self.records]
+        self.metrics.update(np.array(labels), preds)
+        for record, label, pred in zip(self.records, labels, preds):
+            top = np.argsort(-pred)[:self.top]
+            self.predictions_file.write(json.dumps(dict(
+                filename=record["filename"], label=record["label"], classifier=self.name,
+                prediction=ix_to_class_name(top[0]), correct=bool(top[0] == label),
+                top=[(ix_to_class_name(ix), float(pred[ix])) for ix in top])) + "\n")
+        self.predictions_file.flush()
+        self.inputs, self.records = [], []
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    output = args.output or os.path.join("results", "pipeline_" + time.strftime("%Y-%m-%d_%H-%M-%S"))
+    os.makedirs(output, exist_ok=True)
+
+    memory_growth_config(model_name="localization")
+    if args.student:
+        from distillation import student_fcn, student_process_image, student_names
+        student = student_fcn(args.student)
+    else:
+        ensemble_localization.FCNs = fcn_ensemble()
+
+    crops_file = open(os.path.join(output, "crops.jsonl"), "w")
+    predictions_file = open(os.path.join(output, "predictions.jsonl"), "w")
+    crop_classifiers = [CropClassifier(name, args.batch_size, predictions_file, args.top) for name in args.classifiers]
+    input_sizes = sorted({crop_classifier.input_size for crop_classifier in crop_classifiers})
+
+    file_list = dataset_file_list(args.set, args.folders, args.instances)
+    crops_list = []
+    start = time.time()
+    for i_processed, (filename, class_folder) in enumerate(file_list):
+        image_start = time.perf_counter()
+        imgh, imgw = image_shape(filename)
+        if args.student:
+            res_list = student_process_image(student, filename, class_name_to_idx(class_folder), (imgh, imgw))
+        else:
+            res_list = process_image(filename, class_name_to_idx(class_folder), (imgh, imgw))
+        if not res_list:
+            continue
+        record = crop_record(filename, class_folder, select_best_crop(res_list),
+                             names=student_names if args.student else None)
+        crops_list.append(record)
+        crops_file.write(json.dumps(record) + "\n")
+        crops_file.flush()
+
+        # one crop per classifier input size, from the decoded versions cached by the localization
+        with profiler.stage("pipeline/crop"):
+            crop_imgs = {input_size: load_crop(filename, record["rect"]["lower_left"], record["rect"]["side"],
+                                               (input_size[1], input_size[0]), cache=True)
+                         for input_size in input_sizes}
+        for crop_classifier in crop_classifiers:
+            crop_classifier.add(crop_imgs[crop_classifier.input_size], record)
+
+        if profiler.enabled:
+            profiler.add("pipeline/image_total", time.perf_counter() - image_start, (imgh, imgw))
+        if (i_processed + 1) % 100 == 0:
+            print("{} processed {} of {} images, {:.2f} images/sec".format(
+                time.strftime("%Y-%m-%d %H:%M:%S"), i_processed + 1, len(file_list),
+                (i_processed + 1) / (time.time() - start)))
+
+    for crop_classifier in crop_classifiers:
+        crop_classifier.flush()
+        metrics = crop_classifier.metrics
+        metrics.save(os.path.join(output, "metrics_" + crop_classifier.name + ".npz"))
+        print("{} crop classification accuracy: loss {:.4f}, top1 {:.4f}%, top5 {:.4f}%".format(
+            crop_classifier.name, metrics.loss, metrics.top1 * 100, metrics.topk * 100))
+    crops_file.close()
+    predictions_file.close()
+    # the crops in the format of the localization script, e.g. for export_crops.py
+    with open(os.path.join(output, "cropsdata.pickle"), "wb") as cropfile:
+        pickle.dump(crops_list, cropfile, protocol=pickle.HIGHEST_PROTOCOL)
+    if profiler.enabled:
+        profiler.summary()
@@ -0,0 +1,56 @@
+import multiprocessing
+import socket
+
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("keras")
+import numpy as np
+
+from utils.data_parallel import Communicator
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def run_rank(rank, port, shared_memory, results):
+    communicator = Communicator(rank, 2, '127.0.0.1:{}'.format(port), shared_memory=shared_memory, connect_timeout=60)
+    results.put((rank, dict(
+        local=communicator.local[1] if rank == 0 else communicator.is_local,
+        average=communicator.average([np.full(3, rank + 1, dtype=np.float32), np.array([[rank]], dtype=np.float32)]),
+        allgather=communicator.allgather(rank * 10),
+        # different sizes, so that the buffers are reallocated
+        means=[communicator.allreduce_mean(np.arange(size, dtype=np.float32) * (rank + 1)) for size in (5, 5, 7)])))
+    communicator.close()
+
+
+# two ranks on this host, through the shared memory files and through the TCP connection
+@pytest.mark.parametrize("shared_memory", [True, False])
+def test_communicator_two_processes(shared_memory):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    port = free_port()
+    ranks = [context.Process(target=run_rank, args=(rank, port, shared_memory, results)) for rank in (0, 1)]
+    for process in ranks:
+        process.start()
+    by_rank = dict(results.get(timeout=120) for _ in ranks)
+    for process in ranks:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    for rank in (0, 1):
+        result = by_rank[rank]
+        assert result["local"] == shared_memory
+        np.testing.assert_allclose(result["average"][0], [1.5, 1.5, 1.5])
+        np.testing.assert_allclose(result["average"][1], [[0.5]])
+        assert result["allgather"] == [0, 10]
+        for mean, size in zip(result["means"], (5, 5, 7)):
+            np.testing.assert_allclose(mean, np.arange(size) * 1.5)
+    # every rank gets exactly the same values
+    for mean_0, mean_1 in zip(by_rank[0]["means"], by_rank[1]["means"]):
+        np.testing.assert_array_equal(mean_0, mean_1)
@@ -0,0 +1,43 @@
+import pytest
+
+keras = pytest.importorskip("keras")
+pytest.importorskip("matplotlib")
+import numpy as np
+from keras.layers import Input, Conv2D, MaxPooling2D, AveragePooling2D
+from keras.models import Model
+
+import ensemble_localization
+
+
+# small FCN with the layers of the convolutionalized VGG16: 'same' convolutions and 'valid' poolings, stride 32,
+# and a 'valid' average pooling making a kernel of 96 pixels
+def small_vgg_fcn():
+    inputs = Input(shape=(None, None, 3))
+    x = inputs
+    for filters in (4, 8, 8, 16, 16):
+        x = Conv2D(filters, (3, 3), padding='same', activation='relu')(x)
+        x = MaxPooling2D((2, 2))(x)
+    x = AveragePooling2D((3, 3), strides=(1, 1))(x)
+    x = Conv2D(5, (1, 1), activation='softmax')(x)
+    return Model(inputs=inputs, outputs=x)
+
+
+def test_packed_heatmaps_match_separate_passes():
+    model = small_vgg_fcn()
+    kernel_size = 96
+    assert ensemble_localization.packing_gutter(model, kernel_size) > 0
+    rng = np.random.RandomState(0)
+    tiles = [rng.uniform(-1, 1, (kernel_size + 32 * h, kernel_size + 32 * w, 3)).astype(np.float32)
+             for h, w in [(0, 0), (1, 3), (4, 2), (2, 2), (6, 5)]]
+    for tile, heatmap in zip(tiles, ensemble_localization.predict_canvas(model, kernel_size, tiles)):
+        reference = model.predict(tile[np.newaxis])[0]
+        assert heatmap.shape == reference.shape
+        assert np.max(np.abs(heatmap - reference)) < 1e-5
+
+
+def test_fcns_padded_depending_on_their_input_are_not_packed():
+    inputs = Input(shape=(None, None, 3))
+    x = Conv2D(4, (3, 3), strides=(2, 2), padding='same')(inputs)
+    x = Conv2D(5, (1, 1), activation='softmax')(x)
+    with pytest.raises(ValueError):
+        ensemble_localization.masked_fcn(Model(inputs=inputs, outputs=x))
@@ -0,0 +1,53 @@
+import pytest
+
+keras = pytest.importorskip("keras")
+pytest.importorskip("matplotlib")
+import numpy as np
+from keras.layers import Input, Conv2D, BatchNormalization, LeakyReLU, Add, AveragePooling2D
+from keras.models import Model
+
+import ensemble_localization
+
+
+# small FCN with the layers of the convolutionalized backbones: strided 'same' convolutions, batch normalization,
+# a residual connection and a 'valid' pooling
+def small_fcn():
+    inputs = Input(shape=(None, None, 3))
+    x = Conv2D(8, (3, 3), strides=(2, 2), padding='same')(inputs)
+    x = BatchNormalization()(x)
+    x = LeakyReLU()(x)
+    y = Conv2D(8, (3, 3), padding='same')(x)
+    y = LeakyReLU()(y)
+    x = Add()([x, y])
+    x = Conv2D(16, (5, 5), strides=(2, 2), padding='same')(x)
+    x = LeakyReLU()(x)
+    x = Conv2D(16, (3, 3), strides=(2, 2), padding='same')(x)
+    x = AveragePooling2D((2, 2))(x)
+    x = Conv2D(5, (1, 1), activation='softmax')(x)
+    return Model(inputs=inputs, outputs=x)
+
+
+@pytest.mark.parametrize("shape", [(256, 256), (301, 227)])
+def test_predict_tiled_matches_predict(shape):
+    model = small_fcn()
+    x = np.random.RandomState(0).uniform(-1, 1, (1,) + shape + (3,)).astype(np.float32)
+    memory_mb = 0.2
+    assert len(ensemble_localization.fcn_segments(model, memory_mb)) > 1
+    difference = ensemble_localization.tiling_difference(model, x, memory_mb=memory_mb)
+    assert difference["max_abs_diff"] < 1e-5
+    assert difference["argmax_agreement"] == 1.
+
+
+def test_spill_buffer_moves_large_inputs_to_a_temporary_file():
+    x = np.random.RandomState(0).uniform(-1, 1, (1, 256, 256, 3)).astype(np.float32)
+    assert ensemble_localization.spill_buffer(x, memory_mb=64) is x
+    spilled = ensemble_localization.spill_buffer(x, memory_mb=0.2)
+    assert isinstance(spilled, np.memmap)
+    assert np.array_equal(spilled, x)
+
+
+def test_predict_tiled_raises_when_a_segment_does_not_fit():
+    model = small_fcn()
+    x = np.zeros((1, 256, 256, 3), dtype=np.float32)
+    with pytest.raises(MemoryError):
+        ensemble_localization.predict_tiled(model, x, memory_mb=0.001)
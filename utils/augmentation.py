@@ -0,0 +1,174 @@
+import os
+import numpy as np
+from keras import backend as K
+from keras.preprocessing.image import ImageDataGenerator, DirectoryIterator, load_img, img_to_array, array_to_img
+
+
+# Composes, for every image of a batch, the flip/shift/zoom/shear/rotation parameters of an ImageDataGenerator into a
+# single (row, col) homogeneous matrix mapping output pixel coordinates to input pixel coordinates.
+# The parameters are drawn with the same distributions used by ImageDataGenerator.random_transform (Keras 2.1.1).
+def random_affine_matrices(datagen, batch_size, h, w, rng):
+    ones, zeros = np.ones(batch_size), np.zeros(batch_size)
+
+    theta = np.deg2rad(rng.uniform(-datagen.rotation_range, datagen.rotation_range, batch_size)) \
+        if datagen.rotation_range else zeros
+    tx = rng.uniform(-datagen.height_shift_range, datagen.height_shift_range, batch_size) * h \
+        if datagen.height_shift_range else zeros
+    ty = rng.uniform(-datagen.width_shift_range, datagen.width_shift_range, batch_size) * w \
+        if datagen.width_shift_range else zeros
+    shear = rng.uniform(-datagen.shear_range, datagen.shear_range, batch_size) if datagen.shear_range else zeros
+    if datagen.zoom_range[0] == 1 and datagen.zoom_range[1] == 1:
+        zx, zy = ones, ones
+    else:
+        zx, zy = rng.uniform(datagen.zoom_range[0], datagen.zoom_range[1], (2, batch_size))
+
+    def stack(rows):
+        return np.stack([np.stack(row, axis=-1) for row in rows], axis=-2)
+
+    rotation = stack([[np.cos(theta), -np.sin(theta), zeros], [np.sin(theta), np.cos(theta), zeros], [zeros, zeros, ones]])
+    shift = stack([[ones, zeros, tx], [zeros, ones, ty], [zeros, zeros, ones]])
+    shearing = stack([[ones, -np.sin(shear), zeros], [zeros, np.cos(shear), zeros], [zeros, zeros, ones]])
+    zoom = stack([[zx, zeros, zeros], [zeros, zy, zeros], [zeros, zeros, ones]])
+
+    # same offset used by keras transform_matrix_offset_center
+    o_x, o_y = float(h) / 2 + 0.5, float(w) / 2 + 0.5
+    offset = np.array([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]])
+    reset = np.array([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]])
+    matrices = offset @ rotation @ shift @ shearing @ zoom @ reset
+
+    # flips are applied by Keras after the warp, so they compose on the right of the output->input mapping
+    if datagen.horizontal_flip:
+        flip = rng.random_sample(batch_size) < 0.5
+        hflip = np.tile(np.eye(3), (batch_size, 1, 1))
+        hflip[flip, 1, 1] = -1
+        hflip[flip, 1, 2] = w - 1
+        matrices = matrices @ hflip
+    if datagen.vertical_flip:
+        flip = rng.random_sample(batch_size) < 0.5
+        vflip = np.tile(np.eye(3), (batch_size, 1, 1))
+        vflip[flip, 0, 0] = -1
+        vflip[flip, 0, 2] = h - 1
+        matrices = matrices @ vflip
+    return matrices
+
+
+# Maps integer coordinates outside [0, n) back into the image, following the scipy.ndimage fill modes
+def _fill_coordinates(coords, n, fill_mode):
+    if fill_mode == 'reflect':
+        coords = np.mod(coords, 2 * n)
+        return np.where(coords >= n, 2 * n - 1 - coords, coords)
+    if fill_mode == 'wrap':
+        return np.mod(coords, n)
+    return np.clip(coords, 0, n - 1)
+
+
+# Warps a whole (batch, rows, cols, channels) tensor with one nearest-neighbour gather, as keras apply_transform does
+# (order=0) for a single image and channel at a time
+def warp_batch(x, matrices, fill_mode='nearest', cval=0.):
+    batch_size, h, w = x.shape[0:3]
+    rows, cols = np.mgrid[0:h, 0:w]
+    grid = np.stack([rows.ravel(), cols.ravel(), np.ones(h * w)]).astype(np.float32)
+    src = np.matmul(matrices[:, 0:2, :].astype(np.float32), grid)
+    src_r = np.floor(src[:, 0] + 0.5).astype(np.int64)
+    src_c = np.floor(src[:, 1] + 0.5).astype(np.int64)
+
+    outside = None
+    if fill_mode == 'constant':
+        outside = (src_r < 0) | (src_r >= h) | (src_c < 0) | (src_c >= w)
+    src_r = _fill_coordinates(src_r, h, fill_mode)
+    src_c = _fill_coordinates(src_c, w, fill_mode)
+
+    out = x[np.arange(batch_size)[:, None], src_r, src_c]
+    if outside is not None:
+        out[outside] = cval
+    return out.reshape(x.shape)
+
+
+# ImageDataGenerator replacement applying the random augmentations to whole batches at once.
+# It accepts the same arguments, so it can be used with the same augmentation dictionary.
+class BatchImageDataGenerator(ImageDataGenerator):
+
+    def random_transform_batch(self, x, rng=np.random):
+        batch_size, h, w = x.shape[0:3]
+        if self.channel_shift_range != 0:
+            # one shift per image and channel, clipped to the range of the image, as keras random_channel_shift
+            shift = rng.uniform(-self.channel_shift_range, self.channel_shift_range, (batch_size, 1, 1, x.shape[3]))
+            x = np.clip(x + shift, x.min(axis=(1, 2, 3), keepdims=True), x.max(axis=(1, 2, 3), keepdims=True))
+        if self.rotation_range or self.height_shift_range or self.width_shift_range or self.shear_range or \
+                self.zoom_range[0] != 1 or self.zoom_range[1] != 1 or self.horizontal_flip or self.vertical_flip:
+            x = warp_batch(x, random_affine_matrices(self, batch_size, h, w, rng), self.fill_mode, self.cval)
+        return x
+
+    def standardize_batch(self, x):
+        # statistics computed per sample or fitted on data are left to the per-image Keras implementation
+        if self.samplewise_center or self.samplewise_std_normalization or self.featurewise_center or \
+                self.featurewise_std_normalization or self.zca_whitening:
+            return np.stack([self.standardize(sample) for sample in x])
+        if self.preprocessing_function:
+            x = self.preprocessing_function(x)
+        if self.rescale:
+            x *= self.rescale
+        return x
+
+    def flow_from_directory(self, directory, target_size=(256, 256), color_mode='rgb', classes=None,
+                            class_mode='categorical', batch_size=32, shuffle=True, seed=None, save_to_dir=None,
+                            save_prefix='', save_format='png', follow_links=False, shard=None):
+        return BatchDirectoryIterator(directory, self, target_size=target_size, color_mode=color_mode,
+                                      classes=classes, class_mode=class_mode, data_format=self.data_format,
+                                      batch_size=batch_size, shuffle=shuffle, seed=seed, save_to_dir=save_to_dir,
+                                      save_prefix=save_prefix, save_format=save_format, follow_links=follow_links,
+                                      shard=shard)
+
+
+# DirectoryIterator decoding a batch into a single tensor and augmenting it with BatchImageDataGenerator.
+# Being a keras Sequence, it can be consumed by several fit_generator workers (threads or processes).
+# With shard = (index, count) it iterates only over every count-th image starting from index (in the sorted order of
+# the class folders, so each of the count disjoint shards keeps the class proportions), e.g. the images of a rank
+# of a data parallel training.
+class BatchDirectoryIterator(DirectoryIterator):
+
+    def __init__(self, directory, image_data_generator, shard=None, **kwargs):
+        super(BatchDirectoryIterator, self).__init__(directory, image_data_generator, **kwargs)
+        if shard:
+            index, count = shard
+            self.filenames = self.filenames[index::count]
+            self.classes = self.classes[index::count]
+            self.samples = self.n = len(self.filenames)
+            print('Shard {} of {}: {} images'.format(index, count, self.samples))
+
+    def _get_batches_of_transformed_samples(self, index_array):
+        if self.data_format != 'channels_last':
+            return super(BatchDirectoryIterator, self)._get_batches_of_transformed_samples(index_array)
+
+        grayscale = self.color_mode == 'grayscale'
+        batch_x = np.empty((len(index_array),) + self.image_shape, dtype=K.floatx())
+        for i, j in enumerate(index_array):
+            img = load_img(os.path.join(self.directory, self.filenames[j]), grayscale=grayscale,
+                           target_size=self.target_size)
+            batch_x[i] = img_to_array(img, data_format=self.data_format)
+
+        # each batch gets its own random stream, otherwise forked workers would repeat the same augmentations
+        rng = np.random.RandomState(None if self.seed is None else
+                                    (self.seed + int(np.sum(index_array) * 7919 + index_array[0])) % (2 ** 32))
+        batch_x = self.image_data_generator.random_transform_batch(batch_x, rng)
+        batch_x = self.image_data_generator.standardize_batch(batch_x).astype(K.floatx(), copy=False)
+
+        if self.save_to_dir:
+            for i, j in enumerate(index_array):
+                img = array_to_img(batch_x[i], self.data_format, scale=True)
+                fname = '{prefix}_{index}_{hash}.{format}'.format(prefix=self.save_prefix, index=j,
+                                                                  hash=np.random.randint(1e7), format=self.save_format)
+                img.save(os.path.join(self.save_to_dir, fname))
+
+        if self.class_mode == 'input':
+            batch_y = batch_x.copy()
+        elif self.class_mode == 'sparse':
+            batch_y = self.classes[index_array]
+        elif self.class_mode == 'binary':
+            batch_y = self.classes[index_array].astype(K.floatx())
+        elif self.class_mode == 'categorical':
+            batch_y = np.zeros((len(batch_x), self.num_classes), dtype=K.floatx())
+            batch_y[np.arange(len(batch_x)), self.classes[index_array]] = 1.
+        else:
+            return batch_x
+        return batch_x, batch_y
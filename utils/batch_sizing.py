@@ -0,0 +1,117 @@
+import resource
+from contextlib import contextmanager
+import numpy as np
+import tensorflow as tf
+import keras
+from keras import backend as K
+
+# Memory-aware batch sizing: the largest micro-batch whose training step fits in memory is probed for the current
+# model and trainable layers, and GradientAccumulation applies one optimizer update every accumulation_steps
+# micro-batches with their mean gradient, so that the effective batch size does not depend on the host memory.
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def has_gpu():
+    return any(device.device_type == 'GPU' for device in K.get_session().list_devices())
+
+
+# Default memory_limit_mb of probe_batch_size on a CPU host: the peak RSS so far plus a share of the memory available
+# on the host (MemAvailable), split among the processes of the host probing at the same time. None when the
+# available memory is unknown
+def cpu_memory_limit_mb(processes=1, available_fraction=0.8):
+    try:
+        with open('/proc/meminfo') as meminfo:
+            available_kb = next(int(line.split()[1]) for line in meminfo if line.startswith('MemAvailable:'))
+    except (IOError, StopIteration):
+        return None
+    return peak_rss_mb() + available_fraction * available_kb / 2 ** 10 / processes
+
+
+# Largest divisor of batch_size whose training step runs without exhausting the device memory and, if
+# memory_limit_mb is given (e.g. on CPU hosts, where an allocation failure kills the process instead of raising),
+# without the process peak RSS going over it. The candidates are tried in increasing order on random data, then
+# the model weights are restored; the model has to be compiled again afterwards.
+def probe_batch_size(model, input_shape, batch_size, optimizer, loss='categorical_crossentropy', memory_limit_mb=None):
+    weights = model.get_weights()
+    # a copy of the optimizer, so that the probe steps do not change its state (e.g. iterations of a decay)
+    optimizer = keras.optimizers.get(optimizer)
+    model.compile(loss=loss, optimizer=keras.optimizers.deserialize(keras.optimizers.serialize(optimizer)))
+    num_classes = model.output_shape[-1]
+    fitting = None
+    for candidate in [d for d in range(1, batch_size + 1) if batch_size % d == 0]:
+        x = np.random.uniform(-1, 1, (candidate,) + tuple(input_shape)).astype(np.float32)
+        y = keras.utils.to_categorical(np.random.randint(0, num_classes, candidate), num_classes)
+        try:
+            # two steps: the optimizer slots are allocated during the first one
+            model.train_on_batch(x, y)
+            model.train_on_batch(x, y)
+        except tf.errors.ResourceExhaustedError:
+            break
+        if memory_limit_mb and peak_rss_mb() > memory_limit_mb:
+            break
+        fitting = candidate
+    model.set_weights(weights)
+    if fitting is None:
+        raise MemoryError('Not even a batch of 1 image of shape {} fits in memory'.format(input_shape))
+    return fitting
+
+
+# Makes the K.update/K.update_add/K.update_sub calls of an optimizer conditional: when condition is false the
+# variables keep their value
+@contextmanager
+def conditional_updates(condition):
+    update, update_add, update_sub = K.update, K.update_add, K.update_sub
+    K.update = lambda x, new_x: update(x, K.switch(condition, new_x, x))
+    K.update_add = lambda x, increment: update_add(x, K.cast(condition, K.dtype(x)) * increment)
+    K.update_sub = lambda x, decrement: update_sub(x, K.cast(condition, K.dtype(x)) * decrement)
+    try:
+        yield
+    finally:
+        K.update, K.update_add, K.update_sub = update, update_add, update_sub
+
+
+# Optimizer wrapper accumulating the gradients of accumulation_steps micro-batches: at the last one the wrapped
+# optimizer runs its update with the mean gradient, at the others all its variables (slots, iterations) are left
+# unchanged. iterations, lr and the weights are the ones of the wrapped optimizer, so a training state snapshot
+# can be resumed with a different number of accumulation steps. The wrapped optimizer gets the condition of the
+# update steps in apply_condition. The BatchNormalization layers still normalize each micro-batch with its own
+# statistics.
+class GradientAccumulation(keras.optimizers.Optimizer):
+    def __init__(self, optimizer, accumulation_steps, **kwargs):
+        super(GradientAccumulation, self).__init__(**kwargs)
+        self.optimizer = keras.optimizers.get(optimizer)
+        if hasattr(self.optimizer, 'clipnorm') or hasattr(self.optimizer, 'clipvalue'):
+            raise ValueError('Gradient clipping of the wrapped optimizer is not supported')
+        self.accumulation_steps = accumulation_steps
+        with K.name_scope(self.__class__.__name__):
+            self.micro_steps = K.variable(0, dtype='int64', name='micro_steps')
+        self.iterations = self.optimizer.iterations
+        self.lr = self.optimizer.lr
+
+    def get_updates(self, loss, params):
+        grads = self.get_gradients(loss, params)
+        accumulators = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        apply = K.equal((self.micro_steps + 1) % self.accumulation_steps, 0)
+        mean_grads = [(a + g) / self.accumulation_steps for a, g in zip(accumulators, grads)]
+        self.optimizer.get_gradients = lambda loss, params: mean_grads
+        self.optimizer.apply_condition = apply
+        with conditional_updates(apply):
+            optimizer_updates = self.optimizer.get_updates(loss, params)
+        # the accumulators are reset (or incremented) only after the wrapped optimizer read them
+        with tf.control_dependencies(optimizer_updates):
+            accumulator_updates = [K.update(a, K.switch(apply, K.zeros_like(a), a + g))
+                                   for a, g in zip(accumulators, grads)]
+            with tf.control_dependencies(accumulator_updates):
+                step_update = K.update_add(self.micro_steps, 1)
+        self.updates = optimizer_updates + accumulator_updates + [step_update]
+        self.weights = self.optimizer.weights
+        return self.updates
+
+    def get_config(self):
+        config = {'optimizer': keras.optimizers.serialize(self.optimizer),
+                  'accumulation_steps': self.accumulation_steps}
+        base_config = super(GradientAccumulation, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
@@ -1,4 +1,7 @@
 import os
+import time
+import resource
+import numpy as np
 import keras
 
 
@@ -17,3 +20,76 @@ def lr_reducer(monitor='val_loss', factor=0.1, patience=5, epsilon=0.0001, coold
 
 def csv_logger(filename, separator='\t', append=True):
     return keras.callbacks.CSVLogger(os.path.join(os.getcwd(), 'logs', filename), separator=separator, append=append)
+
+
+def throughput_logger(filename, separator='\t', append=True):
+    return ThroughputLogger(os.path.join(os.getcwd(), 'logs', filename), separator=separator, append=append)
+
+
+# Resident set size of the current process in MB (peak RSS where /proc is not available)
+def process_rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+# Callback logging, for every batch, the time spent waiting for the data generator, the time spent in the train step,
+# the images/sec and the process RSS. At every epoch end a summary line is appended to the log and printed.
+# fit_generator calls on_batch_begin right after the generator returned a batch, so the time elapsed from the end
+# of the previous batch is the wait on the data pipeline.
+class ThroughputLogger(keras.callbacks.Callback):
+
+    def __init__(self, filename, separator='\t', append=True):
+        super(ThroughputLogger, self).__init__()
+        self.filename = filename
+        self.sep = separator
+        self.append = append
+        self.file = None
+        self.epoch = 0
+
+    def on_train_begin(self, logs=None):
+        header = not (self.append and os.path.exists(self.filename))
+        self.file = open(self.filename, 'a' if self.append else 'w')
+        if header:
+            self.file.write(self.sep.join(['epoch', 'batch', 'wait_ms', 'step_ms', 'images_sec', 'rss_mb']) + '\n')
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.batch_end = time.time()
+        self.waits, self.steps, self.sizes = [], [], []
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_begin = time.time()
+        self.waits.append(self.batch_begin - self.batch_end)
+
+    def on_batch_end(self, batch, logs=None):
+        self.batch_end = time.time()
+        step = self.batch_end - self.batch_begin
+        size = (logs or {}).get('size', 0)
+        self.steps.append(step)
+        self.sizes.append(size)
+        self.file.write(self.sep.join([str(self.epoch), str(batch), '{:.1f}'.format(self.waits[-1] * 1000),
+                                       '{:.1f}'.format(step * 1000),
+                                       '{:.1f}'.format(size / max(self.waits[-1] + step, 1e-9)),
+                                       '{:.0f}'.format(process_rss_mb())]) + '\n')
+
+    def on_epoch_end(self, epoch, logs=None):
+        train_time = sum(self.waits) + sum(self.steps)
+        validation_time = time.time() - self.batch_end
+        wait_fraction = sum(self.waits) / train_time if train_time > 0 else 0.
+        images_sec = sum(self.sizes) / train_time if train_time > 0 else 0.
+        summary = [str(epoch), 'epoch', '{:.1f}'.format(np.mean(self.waits) * 1000 if self.waits else 0.),
+                   '{:.1f}'.format(np.mean(self.steps) * 1000 if self.steps else 0.), '{:.1f}'.format(images_sec),
+                   '{:.0f}'.format(process_rss_mb())]
+        self.file.write(self.sep.join(summary) + '\n')
+        self.file.flush()
+        print('[THROUGHPUT] epoch {}: {:.1f} images/sec, {:.1f}% of training time waiting for data, '
+              'validation {:.1f}s, rss {}MB'.format(epoch + 1, images_sec, wait_fraction * 100, validation_time,
+                                                   summary[-1]))
+
+    def on_train_end(self, logs=None):
+        self.file.close()
+        self.file = None
+
@@ -0,0 +1,100 @@
+import os
+import json
+import numpy as np
+
+# Streaming classification metrics: a confusion matrix and per-class top-1/top-5 counts updated per batch of
+# predictions, so that per-class results come from the same inference pass as the aggregate accuracy.
+
+
+class ClassificationMetrics(object):
+    def __init__(self, num_classes=101, k=5):
+        self.num_classes = num_classes
+        self.k = k
+        self.confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+        self.topk_hits = np.zeros(num_classes, dtype=np.int64)
+        self.loss_sum = 0.
+
+    # y_true: class indices (batch,) or one-hot targets (batch, num_classes); y_pred: probabilities (batch, num_classes)
+    def update(self, y_true, y_pred):
+        y_true = np.asarray(y_true)
+        y_pred = np.asarray(y_pred)
+        if y_true.ndim > 1:
+            y_true = np.argmax(y_true, axis=1)
+        rows = np.arange(len(y_true))
+        np.add.at(self.confusion, (y_true, np.argmax(y_pred, axis=1)), 1)
+        # same tie handling as keras top_k_categorical_accuracy (in_top_k): the true class is in the top k
+        # if fewer than k classes have a strictly higher probability
+        true_prob = y_pred[rows, y_true]
+        hits = np.sum(y_pred > true_prob[:, np.newaxis], axis=1) < self.k
+        self.topk_hits += np.bincount(y_true[hits], minlength=self.num_classes)
+        self.loss_sum += float(-np.sum(np.log(np.clip(true_prob, 1e-7, 1.))))
+
+    @property
+    def support(self):
+        return self.confusion.sum(axis=1)
+
+    @property
+    def samples(self):
+        return int(self.confusion.sum())
+
+    @property
+    def loss(self):
+        return self.loss_sum / max(1, self.samples)
+
+    @property
+    def top1(self):
+        return float(np.trace(self.confusion)) / max(1, self.samples)
+
+    @property
+    def topk(self):
+        return float(self.topk_hits.sum()) / max(1, self.samples)
+
+    # per-class recall, i.e. top-1 accuracy on the samples of the class (nan for classes without samples)
+    def per_class_top1(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.diag(self.confusion) / self.support.astype(np.float64)
+
+    def per_class_topk(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.topk_hits / self.support.astype(np.float64)
+
+    def per_class_precision(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.diag(self.confusion) / self.confusion.sum(axis=0).astype(np.float64)
+
+    # compressed npz with the raw counts, from which every metric can be recomputed
+    def save(self, filename):
+        np.savez_compressed(filename, confusion=self.confusion, topk_hits=self.topk_hits,
+                            loss_sum=self.loss_sum, k=self.k)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        metrics = cls(num_classes=data["confusion"].shape[0], k=int(data["k"]))
+        metrics.confusion = data["confusion"]
+        metrics.topk_hits = data["topk_hits"]
+        metrics.loss_sum = float(data["loss_sum"])
+        return metrics
+
+
+# Per-class top-1/top-5 of two evaluations of the same test set (e.g. original and cropped images), sorted by
+# the top-1 difference: the first classes are the ones the second evaluation helps the most
+def compare_per_class(metrics_a, metrics_b, class_names, names=("orig", "crop")):
+    top1_a, top1_b = metrics_a.per_class_top1(), metrics_b.per_class_top1()
+    topk_a, topk_b = metrics_a.per_class_topk(), metrics_b.per_class_topk()
+    rows = []
+    for i, label in enumerate(class_names):
+        rows.append({"label": label, "support": int(metrics_b.support[i]),
+                     "top1_" + names[0]: float(top1_a[i]), "top1_" + names[1]: float(top1_b[i]),
+                     "top1_delta": float(top1_b[i] - top1_a[i]),
+                     "top{}_".format(metrics_a.k) + names[0]: float(topk_a[i]),
+                     "top{}_".format(metrics_b.k) + names[1]: float(topk_b[i]),
+                     "top{}_delta".format(metrics_b.k): float(topk_b[i] - topk_a[i])})
+    # classes without samples (nan) last
+    return sorted(rows, key=lambda row: -row["top1_delta"] if not np.isnan(row["top1_delta"]) else np.inf)
+
+
+def save_comparison(rows, filename):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, "w") as outfile:
+        json.dump(rows, outfile, indent=1)
@@ -1,11 +1,8 @@
 import pickle
-import PIL.Image
 import numpy as np
 from keras.preprocessing import image
 from keras.utils import to_categorical
-
-with open("dataset-ethz101food/meta/classes.txt") as file:
-    map_label_ix = {label.strip('\n'): ix for (ix, label) in enumerate(file.readlines())}
+from utils.image_decoding import load_crop
 
 def is_square_in_img(llh, llw, edge, imgh, imgw):
     def inside(width, height, x, y):
@@ -18,6 +15,8 @@ def is_square_in_img(llh, llw, edge, imgh, imgw):
 
 # Python generator yielding cropped and preprocessed images to a classifier
 def yield_crops(cropfilename, input_size, preprocess_func, input_name="input_1", output_name="output_layer"):
+    with open("dataset-ethz101food/meta/classes.txt") as file:
+        map_label_ix = {label.strip('\n'): ix for (ix, label) in enumerate(file.readlines())}
 
     count = 0
     while True:
@@ -29,21 +28,9 @@ def yield_crops(cropfilename, input_size, preprocess_func, input_name="input_1",
                 coordw = int(crop["rect"]["lower_left"][1])
                 rect_dim = int(crop["rect"]["side"])
 
-                img = image.load_img(crop["filename"])
-                img = image.img_to_array(img)
-                imgh, imgw = img.shape[0:2]
-
-                img = img[coordh:coordh + rect_dim, coordw:coordw + rect_dim]
-
-                # if not is_square_in_img(coordh, coordw, rect_dim, imgh, imgw):
-                #     print("Crop out of img bound, file:", crop["filename"], imgh, imgw, "Crop data:", crop)
-                #     fig, ax = plt.subplots(1)
-                #     ax.imshow(img / 255.)
-                #     ax.set_title(crop["filename"])
-                #     plt.show()
-
-                img = image.array_to_img(img)
-                img = img.resize((input_size[0], input_size[1]), PIL.Image.BICUBIC)
+                # crop in the uint8 domain of an image decoded at the lowest resolution that keeps the crop
+                # at least input_size large, then a single float conversion of the network input
+                img = load_crop(crop["filename"], (coordh, coordw), rect_dim, (input_size[0], input_size[1]))
                 img = image.img_to_array(img)
 
                 img = np.expand_dims(img, axis=0)
@@ -0,0 +1,323 @@
+import os
+import sys
+import time
+import atexit
+import pickle
+import socket
+import struct
+import subprocess
+import tempfile
+import numpy as np
+import tensorflow as tf
+import keras
+from keras import backend as K
+
+# Synchronous data parallel training: world_size processes (ranks) train replicas of the same model, each on a
+# disjoint shard of the training images, with batches of batch_size / world_size images. Before each optimizer step
+# the gradients are averaged across the ranks (AllReduceOptimizer), so that all the replicas apply the same update
+# and keep identical weights. Rank 0 takes every decision (validation, early stopping, learning rate, checkpoints,
+# logs) and the other ranks follow it (FollowRankZero).
+# Rank 0 reduces the gradients: the ranks on its host exchange them through shared memory files, the ranks on other
+# hosts through their TCP connection to rank 0. Every process started by hand starts the other ranks of its host:
+#   python finetuning.py 64 --workers 4
+#   hostA: python finetuning.py 64 --workers 4 --hosts 2 --host_rank 0 --master hostA:29500
+#   hostB: python finetuning.py 64 --workers 4 --hosts 2 --host_rank 1 --master hostA:29500
+
+# environment variable with the rank of the processes started by launch_local_ranks
+rank_variable = 'DATA_PARALLEL_RANK'
+default_master = '127.0.0.1:29500'
+
+# message header: operation, payload bytes
+_header = struct.Struct('!iq')
+HELLO, RESERVE, REDUCE, GATHER, BROADCAST = range(5)
+
+# processes of the other ranks of this host, started by launch_local_ranks
+_local_ranks = []
+
+
+# Rank of this process. A process started by hand is the first rank of its host, and starts the other workers - 1
+# ranks of the host running its same command line
+def launch_local_ranks(workers, host_rank=0):
+    if rank_variable in os.environ:
+        return int(os.environ[rank_variable])
+    first_rank = host_rank * workers
+    for local_rank in range(1, workers):
+        env = dict(os.environ, **{rank_variable: str(first_rank + local_rank)})
+        _local_ranks.append(subprocess.Popen([sys.executable] + sys.argv, env=env))
+    return first_rank
+
+
+def _send(sock, op, payload=b''):
+    sock.sendall(_header.pack(op, len(payload)))
+    if len(payload):
+        sock.sendall(payload)
+
+
+def _recv_into(sock, buffer):
+    view = memoryview(buffer).cast('B')
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError('Data parallel peer disconnected')
+        received += count
+
+
+def _recv_header(sock, expected_op):
+    header = bytearray(_header.size)
+    _recv_into(sock, header)
+    op, nbytes = _header.unpack(header)
+    if op != expected_op:
+        raise RuntimeError('Data parallel ranks out of step: expected operation {}, received {}'.format(expected_op, op))
+    return nbytes
+
+
+def _recv(sock, expected_op):
+    payload = bytearray(_recv_header(sock, expected_op))
+    _recv_into(sock, payload)
+    return payload
+
+
+# Collective operations among the ranks, to be called by all of them in the same order. Rank 0 listens on the master
+# address, the other ranks connect to it. The ranks on the host of rank 0 (same hostname) exchange the allreduce_mean
+# arrays through memory-mapped files in shm_dir, the others send them on their connection.
+class Communicator(object):
+
+    def __init__(self, rank, world_size, master=default_master, shared_memory=True, shm_dir='/dev/shm',
+                 connect_timeout=600):
+        self.rank = rank
+        self.world_size = world_size
+        self.shm_dir = shm_dir if os.path.isdir(shm_dir) else tempfile.gettempdir()
+        self.size = 0
+        self.slot = self.mean = None
+        self.slots = {}
+        host, port = master.rsplit(':', 1)
+        if rank == 0:
+            self.job = 'data_parallel_{}'.format(os.getpid())
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(('', int(port)))
+            server.listen(world_size)
+            server.settimeout(connect_timeout)
+            self.peers = [None] * world_size
+            self.local = [False] * world_size
+            for _ in range(world_size - 1):
+                conn, _ = server.accept()
+                conn.settimeout(None)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                peer_rank, hostname = pickle.loads(_recv(conn, HELLO))
+                self.peers[peer_rank] = conn
+                self.local[peer_rank] = shared_memory and hostname == socket.gethostname()
+            server.close()
+            for peer_rank, conn in self.peer_connections():
+                _send(conn, HELLO, pickle.dumps((self.job, self.local[peer_rank])))
+        else:
+            # rank 0 may still be loading its model
+            deadline = time.time() + connect_timeout
+            while True:
+                try:
+                    self.conn = socket.create_connection((host, int(port)))
+                    break
+                except OSError:
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(1)
+            self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            _send(self.conn, HELLO, pickle.dumps((rank, socket.gethostname())))
+            self.job, self.is_local = pickle.loads(_recv(self.conn, HELLO))
+        atexit.register(self.close)
+
+    def peer_connections(self):
+        return [(peer_rank, conn) for peer_rank, conn in enumerate(self.peers) if conn is not None]
+
+    def _path(self, name):
+        return os.path.join(self.shm_dir, '{}_{}.buf'.format(self.job, name))
+
+    # (re)allocates the shared memory buffers for arrays of size elements
+    def reserve(self, size):
+        self.slot = self.mean = None
+        self.slots = {}
+        if self.rank == 0:
+            for peer_rank, conn in self.peer_connections():
+                _recv_header(conn, RESERVE)
+            if any(self.local):
+                self.mean = np.memmap(self._path('mean'), dtype=np.float32, mode='w+', shape=(size,))
+                self.slots = {peer_rank: np.memmap(self._path(peer_rank), dtype=np.float32, mode='r', shape=(size,))
+                              for peer_rank in range(1, self.world_size) if self.local[peer_rank]}
+            for _, conn in self.peer_connections():
+                _send(conn, RESERVE)
+        else:
+            if self.is_local:
+                self.slot = np.memmap(self._path(self.rank), dtype=np.float32, mode='w+', shape=(size,))
+            _send(self.conn, RESERVE)
+            _recv_header(self.conn, RESERVE)
+            if self.is_local:
+                self.mean = np.memmap(self._path('mean'), dtype=np.float32, mode='r', shape=(size,))
+        self.size = size
+
+    # Mean of a float32 array over the ranks. The sum is computed by rank 0 in rank order and sent to all, so every
+    # rank gets exactly the same values
+    def allreduce_mean(self, array):
+        array = np.ascontiguousarray(array, dtype=np.float32).ravel()
+        if array.size != self.size:
+            self.reserve(array.size)
+        if self.rank == 0:
+            total = array.copy()
+            buffer = None
+            for peer_rank, conn in self.peer_connections():
+                _recv_header(conn, REDUCE)
+                if self.local[peer_rank]:
+                    total += self.slots[peer_rank]
+                else:
+                    buffer = np.empty_like(total) if buffer is None else buffer
+                    _recv_into(conn, buffer)
+                    total += buffer
+            total /= self.world_size
+            if self.mean is not None:
+                self.mean[:] = total
+            for peer_rank, conn in self.peer_connections():
+                _send(conn, REDUCE, b'' if self.local[peer_rank] else memoryview(total).cast('B'))
+            return total
+        if self.is_local:
+            self.slot[:] = array
+            _send(self.conn, REDUCE)
+        else:
+            _send(self.conn, REDUCE, memoryview(array).cast('B'))
+        mean = np.empty_like(array)
+        if _recv_header(self.conn, REDUCE):
+            _recv_into(self.conn, mean)
+        else:
+            mean[:] = self.mean
+        return mean
+
+    # list of the objects of all the ranks on rank 0, None on the others
+    def gather(self, obj):
+        if self.rank == 0:
+            objs = [obj] + [None] * (self.world_size - 1)
+            for peer_rank, conn in self.peer_connections():
+                objs[peer_rank] = pickle.loads(_recv(conn, GATHER))
+            return objs
+        _send(self.conn, GATHER, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+        return None
+
+    # object of rank 0 on all the ranks
+    def broadcast(self, obj=None):
+        if self.rank == 0:
+            payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+            for _, conn in self.peer_connections():
+                _send(conn, BROADCAST, payload)
+            return obj
+        return pickle.loads(_recv(self.conn, BROADCAST))
+
+    def allgather(self, obj):
+        return self.broadcast(self.gather(obj))
+
+    # element-wise means over the ranks of a list of arrays
+    def average(self, arrays):
+        gathered = self.gather(arrays)
+        if self.rank == 0:
+            arrays = [np.mean([rank_arrays[i] for rank_arrays in gathered], axis=0) for i in range(len(arrays))]
+        return self.broadcast(arrays)
+
+    def close(self):
+        self.slot = self.mean = None
+        self.slots = {}
+        if self.rank == 0:
+            for _, conn in self.peer_connections():
+                conn.close()
+            self.peers = [None] * self.world_size
+            names = ['mean'] + list(range(1, self.world_size))
+        else:
+            self.conn.close()
+            names = [self.rank]
+        for name in names:
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+
+
+# Optimizer wrapper averaging the gradients over the ranks before the update of the wrapped optimizer. iterations,
+# lr and the weights are the ones of the wrapped optimizer. Wrapped in a GradientAccumulation, it gets its apply steps
+# in apply_condition and averages the accumulated gradients only at them, not at every micro-batch.
+class AllReduceOptimizer(keras.optimizers.Optimizer):
+    def __init__(self, optimizer, communicator, **kwargs):
+        super(AllReduceOptimizer, self).__init__(**kwargs)
+        self.optimizer = keras.optimizers.get(optimizer)
+        if hasattr(self.optimizer, 'clipnorm') or hasattr(self.optimizer, 'clipvalue'):
+            raise ValueError('Gradient clipping of the wrapped optimizer is not supported')
+        self.communicator = communicator
+        self.apply_condition = None
+        self.iterations = self.optimizer.iterations
+        self.lr = self.optimizer.lr
+
+    def get_updates(self, loss, params):
+        grads = self.get_gradients(loss, params)
+        shapes = [K.int_shape(p) for p in params]
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        flat_grads = tf.concat([tf.reshape(tf.convert_to_tensor(g), [-1]) for g in grads], axis=0)
+
+        def allreduce():
+            flat_mean = tf.py_func(self.communicator.allreduce_mean, [flat_grads], tf.float32, stateful=True)
+            flat_mean.set_shape(flat_grads.get_shape())
+            return flat_mean
+        # the gradients are left as they are when the wrapped optimizer does not update the variables
+        flat_mean = allreduce() if self.apply_condition is None else \
+            tf.cond(self.apply_condition, allreduce, lambda: flat_grads)
+        mean_grads = [tf.reshape(g, shape) for g, shape in zip(tf.split(flat_mean, sizes), shapes)]
+        self.optimizer.get_gradients = lambda loss, params: mean_grads
+        self.updates = self.optimizer.get_updates(loss, params)
+        self.weights = self.optimizer.weights
+        return self.updates
+
+    def get_config(self):
+        config = {'optimizer': keras.optimizers.serialize(self.optimizer)}
+        base_config = super(AllReduceOptimizer, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+# Callback averaging over the ranks, at every epoch end, the BatchNormalization moving statistics (each replica
+# updates them on its own images) and the training metrics of the epoch. It has to come before the validation.
+class AverageReplicaState(keras.callbacks.Callback):
+
+    def __init__(self, communicator):
+        super(AverageReplicaState, self).__init__()
+        self.communicator = communicator
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        statistics = [w for w in self.model.weights if 'moving_' in w.name]
+        names = [name for name in self.model.metrics_names if name in logs]
+        means = self.communicator.average(K.batch_get_value(statistics) + [np.array([logs[n] for n in names])])
+        K.batch_set_value(list(zip(statistics, means[:-1])))
+        for name, value in zip(names, means[-1]):
+            logs[name] = float(value)
+
+
+# Callback making the other ranks follow rank 0: at the beginning of a training they get its model weights and
+# optimizer state (e.g. restored from a snapshot), at every epoch end its learning rate and early stopping decision.
+# It has to come after the callbacks of rank 0 changing them.
+class FollowRankZero(keras.callbacks.Callback):
+
+    def __init__(self, communicator):
+        super(FollowRankZero, self).__init__()
+        self.communicator = communicator
+
+    def on_train_begin(self, logs=None):
+        optimizer = self.model.optimizer
+        state = None
+        if self.communicator.rank == 0:
+            state = dict(model_weights=self.model.get_weights(), optimizer_weights=optimizer.get_weights(),
+                         iterations=K.get_value(optimizer.iterations))
+        state = self.communicator.broadcast(state)
+        if self.communicator.rank != 0:
+            self.model.set_weights(state["model_weights"])
+            if state["optimizer_weights"]:
+                optimizer.set_weights(state["optimizer_weights"])
+            K.set_value(optimizer.iterations, state["iterations"])
+
+    def on_epoch_end(self, epoch, logs=None):
+        state = None
+        if self.communicator.rank == 0:
+            state = dict(stop_training=bool(self.model.stop_training), lr=float(K.get_value(self.model.optimizer.lr)))
+        state = self.communicator.broadcast(state)
+        self.model.stop_training = state["stop_training"]
+        K.set_value(self.model.optimizer.lr, state["lr"])
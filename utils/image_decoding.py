@@ -0,0 +1,75 @@
+from PIL import Image
+
+# JPEG DCT-domain downscaling factors supported by the decoder (PIL draft mode)
+draft_reductions = (8, 4, 2, 1)
+
+# Decoded versions of the most recently opened file, by reduction factor: the localization decodes the same image
+# for every FCN and scale
+_last_filename = None
+_decoded = {}
+
+
+# Reduction factor chosen by PIL draft for a requested size: the largest one keeping the image at least that large
+def draft_reduction(native_size, requested_size):
+    scale = min(native_size[0] // max(1, requested_size[0]), native_size[1] // max(1, requested_size[1]))
+    for reduction in draft_reductions:
+        if scale >= reduction:
+            return reduction
+    return 1
+
+
+# Opens an RGB image, letting the JPEG decoder downscale it in the DCT domain when min_size (width, height) is
+# well below the native size: the returned image is at least min_size large, but may be smaller than the native one
+def open_image(filename, min_size=None, cache=True):
+    global _last_filename, _decoded
+    img = Image.open(filename)
+    reduction = 1
+    if min_size is not None and img.format == 'JPEG':
+        reduction = draft_reduction(img.size, min_size)
+    if cache:
+        if filename != _last_filename:
+            _last_filename, _decoded = filename, {}
+        if reduction in _decoded:
+            return _decoded[reduction]
+    if reduction > 1:
+        img.draft('RGB', (img.size[0] // reduction, img.size[1] // reduction))
+    img = img.convert('RGB') if img.mode != 'RGB' else img
+    img.load()
+    if cache:
+        _decoded[reduction] = img
+    return img
+
+
+# Size (height, width) of an image, read from its header without decoding it
+def image_shape(filename):
+    width, height = Image.open(filename).size
+    return height, width
+
+
+# Decoded version of filename already in the cache that is at least min_size (width, height) large,
+# the smallest one if there are several, or None
+def cached_image(filename, min_size):
+    if filename != _last_filename:
+        return None
+    large_enough = [img for img in _decoded.values() if img.size[0] >= min_size[0] and img.size[1] >= min_size[1]]
+    return min(large_enough, key=lambda img: img.size[0]) if large_enough else None
+
+
+# Square crop (lower_left = (row, column) corner and side in native pixel coordinates) of an image resized to
+# input_size (width, height), cropped in the uint8 domain of an image decoded at reduced resolution when possible.
+# As with numpy slicing, the parts of the rect outside the image are clipped.
+# With cache, the crop is cut from a decoded version of the image kept by open_image when one is large enough
+# (e.g. the ones decoded by the localization of the same image)
+def load_crop(filename, lower_left, side, input_size, resample=Image.BICUBIC, cache=False):
+    native = Image.open(filename).size
+    top, left = lower_left
+    bottom, right = min(top + side, native[1]), min(left + side, native[0])
+    top, left = max(0, top), max(0, left)
+    # the decoded image has to keep the crop at least as large as the network input
+    min_size = (int(native[0] * input_size[0] / max(1, right - left)), int(native[1] * input_size[1] / max(1, bottom - top)))
+    img = cached_image(filename, (min(min_size[0], native[0]), min(min_size[1], native[1]))) if cache else None
+    if img is None:
+        img = open_image(filename, min_size=min_size, cache=cache)
+    sw, sh = float(img.size[0]) / native[0], float(img.size[1]) / native[1]
+    img = img.crop((int(round(left * sw)), int(round(top * sh)), int(round(right * sw)), int(round(bottom * sh))))
+    return img.resize(input_size, resample)
@@ -2,19 +2,24 @@ import os
 
 dataset_path = "dataset-ethz101food"
 
+# class names and name -> index mapping, by dataset path, read once from classes.txt
+_class_labels = {}
+
+def class_labels():
+    if dataset_path not in _class_labels:
+        with open(os.path.join(dataset_path, "meta", "classes.txt")) as file:
+            labels = [line.strip('\n') for line in file.readlines()]
+        _class_labels[dataset_path] = (labels, {label_name: i for i, label_name in enumerate(labels)})
+    return _class_labels[dataset_path]
+
 # Helper function to construct labels array
 def ix_to_class_name(idx):
-    with open(os.path.join(dataset_path, "meta", "classes.txt")) as file:
-        class_labels = [line.strip('\n') for line in file.readlines()]
-    return class_labels[idx]
+    return class_labels()[0][idx]
 
 # Helper function to get the label index given its name
 def class_name_to_idx(name):
-    with open(os.path.join(dataset_path, "meta", "classes.txt")) as file:
-        class_labels = [line.strip('\n') for line in file.readlines()]
-        for i, label_name in enumerate(class_labels):
-            if label_name == name:
-                return i
-        else:
-            print("class idx not found!")
-            exit(-1)
+    labels_ix = class_labels()[1]
+    if name not in labels_ix:
+        print("class idx not found!")
+        exit(-1)
+    return labels_ix[name]
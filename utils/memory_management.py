@@ -1,11 +1,25 @@
+import multiprocessing
 import tensorflow as tf
 from keras import backend as K
+from utils.thread_autotuner import load_thread_config
 
 
-def memory_growth_config(cpu_parallelism=True, allow_growth=True, memory_fraction=None):
+# model_name selects the thread configuration calibrated by utils/thread_autotuner.py on this host for processes
+# processes sharing its cores (e.g. the ranks of a data parallel training), if any. Without it, each process gets an
+# equal share of the cores.
+def memory_growth_config(cpu_parallelism=True, allow_growth=True, memory_fraction=None, model_name=None, processes=1):
     K.clear_session()
+    thread_config = load_thread_config(model_name, processes) if cpu_parallelism and model_name else None
     if not cpu_parallelism:
         session_conf = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)
+    elif thread_config:
+        print('Using calibrated thread configuration: {} intra-op, {} inter-op threads ({} processes per host)'.format(
+            thread_config["intra_op_threads"], thread_config["inter_op_threads"], thread_config["processes"]))
+        session_conf = tf.ConfigProto(intra_op_parallelism_threads=thread_config["intra_op_threads"],
+                                      inter_op_parallelism_threads=thread_config["inter_op_threads"])
+    elif processes > 1:
+        session_conf = tf.ConfigProto(intra_op_parallelism_threads=max(1, multiprocessing.cpu_count() // processes),
+                                      inter_op_parallelism_threads=2)
     else:
         session_conf = tf.ConfigProto()
     session_conf.gpu_options.allow_growth = allow_growth
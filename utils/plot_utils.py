@@ -52,6 +52,10 @@ def save_acc_loss_plots(histories, acc_fn, loss_fn):
     plt.savefig(loss_fn)
     plt.close()
 
+# above this number of classes the confusion matrix is neither printed nor annotated cell by cell
+annotation_max_classes = 20
+
+
 def plot_confusion_matrix(cm, classes,
                           normalize=False,
                           title='Confusion matrix',
@@ -59,28 +63,64 @@ def plot_confusion_matrix(cm, classes,
     """
     This function prints and plots the confusion matrix.
     Normalization can be applied by setting `normalize=True`.
+    Large matrices (e.g. 101x101 for Food-101) are drawn without per-cell text and not printed.
     """
     if normalize:
-        cm = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
+        cm = cm.astype('float') / np.maximum(cm.sum(axis=1), 1)[:, np.newaxis]
         print("Normalized confusion matrix")
     else:
         print('Confusion matrix, without normalization')
 
-    print(cm)
+    annotate = len(classes) <= annotation_max_classes
+    if annotate:
+        print(cm)
 
     plt.imshow(cm, interpolation='nearest', cmap=cmap)
     plt.title(title)
     plt.colorbar()
     tick_marks = np.arange(len(classes))
-    plt.xticks(tick_marks, classes, rotation=90)
-    plt.yticks(tick_marks, classes)
+    fontsize = None if annotate else 4
+    plt.xticks(tick_marks, classes, rotation=90, fontsize=fontsize)
+    plt.yticks(tick_marks, classes, fontsize=fontsize)
+
+    if annotate:
+        thresh = cm.max() / 2.
+        for i, j in itertools.product(range(cm.shape[0]), range(cm.shape[1])):
+            plt.text(j, i, cm[i, j],
+                     horizontalalignment="center",
+                     color="white" if cm[i, j] > thresh else "black")
+
+    plt.tight_layout()
+    plt.ylabel('True label')
+    plt.xlabel('Predicted label')
 
-    thresh = cm.max() / 2.
-    for i, j in itertools.product(range(cm.shape[0]), range(cm.shape[1])):
-        plt.text(j, i, cm[i, j],
-                 horizontalalignment="center",
-                 color="white" if cm[i, j] > thresh else "black")
 
+# save the confusion matrix as a figure with class names on the axes. Row normalized by default: the diagonal
+# is the per-class top-1 accuracy
+def save_confusion_matrix(cm, classes, filename, normalize=True, title='Confusion matrix', cmap=plt.cm.Blues):
+    size = max(6, len(classes) * 0.12)
+    plt.figure(figsize=(size, size))
+    plot_confusion_matrix(cm, classes, normalize=normalize, title=title, cmap=cmap)
+    plt.savefig(filename, dpi=200)
+    plt.close()
+
+
+# save the difference of two row normalized confusion matrices (e.g. cropped - original) with a diverging
+# colormap: blue cells gained predictions, red cells lost them
+def save_confusion_matrix_delta(cm_a, cm_b, classes, filename, title='Confusion matrix difference'):
+    delta = cm_b.astype('float') / np.maximum(cm_b.sum(axis=1), 1)[:, np.newaxis] - \
+        cm_a.astype('float') / np.maximum(cm_a.sum(axis=1), 1)[:, np.newaxis]
+    limit = max(np.abs(delta).max(), 1e-6)
+    size = max(6, len(classes) * 0.12)
+    plt.figure(figsize=(size, size))
+    plt.imshow(delta, interpolation='nearest', cmap=plt.cm.RdBu, vmin=-limit, vmax=limit)
+    plt.title(title)
+    plt.colorbar()
+    tick_marks = np.arange(len(classes))
+    plt.xticks(tick_marks, classes, rotation=90, fontsize=4 if len(classes) > annotation_max_classes else None)
+    plt.yticks(tick_marks, classes, fontsize=4 if len(classes) > annotation_max_classes else None)
     plt.tight_layout()
     plt.ylabel('True label')
     plt.xlabel('Predicted label')
+    plt.savefig(filename, dpi=200)
+    plt.close()
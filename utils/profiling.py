@@ -0,0 +1,89 @@
+import json
+import time
+from collections import defaultdict
+import numpy as np
+
+
+# Context manager returned by a disabled profiler: entering and exiting it costs two method calls
+class _NoopStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_noop_stage = _NoopStage()
+
+
+class _Stage(object):
+    __slots__ = ('profiler', 'name', 'size', 'start')
+
+    def __init__(self, profiler, name, size):
+        self.profiler = profiler
+        self.name = name
+        self.size = size
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, time.perf_counter() - self.start, self.size)
+        return False
+
+
+# Hot-path profiler collecting wall times of named pipeline stages, e.g.
+#     with profiler.stage('predict/vgg16FCN/scale0', size=(h, w)):
+#         ...
+# report() aggregates the timings of each stage in percentiles, dump() appends the report as a JSON line to
+# report_filename, so that periodic and final reports of a run can be read back with one json.loads per line.
+class StageProfiler(object):
+
+    def __init__(self, enabled=True, report_filename=None):
+        self.enabled = enabled
+        self.report_filename = report_filename
+        self.timings = defaultdict(list)
+        self.sizes = defaultdict(list)
+
+    def stage(self, name, size=None):
+        if not self.enabled:
+            return _noop_stage
+        return _Stage(self, name, size)
+
+    def add(self, name, seconds, size=None):
+        self.timings[name].append(seconds)
+        if size is not None:
+            self.sizes[name].append(size)
+
+    def report(self):
+        report = {}
+        for name, timings in sorted(self.timings.items()):
+            ms = np.array(timings) * 1000
+            p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+            report[name] = dict(count=len(ms), total_s=float(ms.sum() / 1000), mean_ms=float(ms.mean()),
+                                p50_ms=float(p50), p90_ms=float(p90), p99_ms=float(p99), max_ms=float(ms.max()))
+            if self.sizes[name]:
+                report[name]["mean_input_size"] = [float(side) for side in np.mean(self.sizes[name], axis=0)]
+        return report
+
+    def dump(self, processed_images, final=False):
+        if not self.enabled:
+            return
+        line = dict(time=time.strftime("%Y-%m-%d %H:%M:%S"), images=processed_images, final=final,
+                    stages=self.report())
+        if self.report_filename:
+            with open(self.report_filename, 'a') as reportfile:
+                reportfile.write(json.dumps(line, sort_keys=True) + '\n')
+        else:
+            print(json.dumps(line, sort_keys=True))
+
+    # prints a human readable table of the slowest stages
+    def summary(self, top=20):
+        report = self.report()
+        for name in sorted(report, key=lambda stage: -report[stage]["total_s"])[0:top]:
+            stage = report[name]
+            print('{:40s} n={:<7d} total {:9.1f}s  p50 {:8.1f}ms  p90 {:8.1f}ms  p99 {:8.1f}ms'.format(
+                name, stage["count"], stage["total_s"], stage["p50_ms"], stage["p90_ms"], stage["p99_ms"]))
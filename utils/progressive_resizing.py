@@ -0,0 +1,60 @@
+# Progressive resizing: a training stage is split in phases of increasing input resolution.
+# Smaller inputs cost a fraction of the FLOPs, so the batch grows with the inverse of the image area.
+import keras
+from utils.training_state import callback_state_attributes
+
+
+# Builds the phases of a training stage.
+# schedule is a list of (image side, number of epochs) pairs in increasing side order, the epochs of the last pair
+# can be None to assign all the remaining epochs of the stage to it (the last phase should use the full resolution).
+# Returns a list of dictionaries with the image side, batch size, and the initial/final epoch of each phase.
+def resizing_phases(schedule, epochs, batch_size, full_size=299, max_batch_size=None):
+    phases = []
+    initial_epoch = 0
+    for i, (size, phase_epochs) in enumerate(schedule):
+        if phase_epochs is None:
+            if i != len(schedule) - 1:
+                raise ValueError('Only the last progressive resizing phase can take the remaining epochs')
+            phase_epochs = epochs - initial_epoch
+        final_epoch = min(initial_epoch + phase_epochs, epochs)
+        if final_epoch <= initial_epoch:
+            break
+        phase_batch_size = max(1, int(batch_size * (float(full_size) / size) ** 2))
+        if max_batch_size:
+            phase_batch_size = min(phase_batch_size, max_batch_size)
+        phases.append(dict(size=size, batch_size=phase_batch_size, initial_epoch=initial_epoch, epochs=final_epoch))
+        initial_epoch = final_epoch
+    return phases
+
+
+# Concatenates the Keras History objects of consecutive phases into the first one, so that a stage trained
+# in several phases is seen as a single training history by save_acc_loss_plots
+def merge_histories(histories):
+    merged = histories[0]
+    for history in histories[1:]:
+        merged.epoch += history.epoch
+        for key, values in history.history.items():
+            merged.history.setdefault(key, []).extend(values)
+    return merged
+
+
+# Callback carrying the state of other callbacks (e.g. EarlyStopping wait/best) from a phase to the next one of the
+# same stage: every phase is a separate fit_generator call, whose on_train_begin resets it. It has to come after
+# those callbacks.
+class PhaseStateCarrier(keras.callbacks.Callback):
+
+    def __init__(self, callbacks):
+        super(PhaseStateCarrier, self).__init__()
+        self.callbacks = callbacks
+        self.states = None
+
+    def on_train_begin(self, logs=None):
+        if self.states is None:
+            return
+        for callback, state in zip(self.callbacks, self.states):
+            for attribute, value in state.items():
+                setattr(callback, attribute, value)
+
+    def on_train_end(self, logs=None):
+        self.states = [{attribute: getattr(callback, attribute) for attribute in callback_state_attributes
+                        if hasattr(callback, attribute)} for callback in self.callbacks]
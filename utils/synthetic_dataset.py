@@ -0,0 +1,60 @@
+import os
+import pickle
+import numpy as np
+from PIL import Image
+
+# Food-101 images have the longest side resized to 512 pixels, most of them are 512x512, 512x384 or 384x512
+# (height, width, probability), the remaining probability gives smaller images with random aspect ratio
+food101_sizes = [((512, 512), 0.5), ((384, 512), 0.2), ((512, 384), 0.2)]
+
+
+def synthetic_image_size(rng):
+    p = rng.random_sample()
+    for size, probability in food101_sizes:
+        if p < probability:
+            return size
+        p -= probability
+    longest = 512
+    shortest = rng.randint(200, 512)
+    return (longest, shortest) if rng.random_sample() < 0.5 else (shortest, longest)
+
+
+# Smooth random image with some high frequency noise, so that its JPEG size and decode cost resemble a photo
+def synthetic_image(h, w, rng):
+    coarse = rng.randint(0, 256, (max(2, h // 32), max(2, w // 32), 3)).astype(np.uint8)
+    img = np.asarray(Image.fromarray(coarse).resize((w, h), Image.BICUBIC), dtype=np.float32)
+    img += rng.normal(0, 12, img.shape)
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+
+# Creates in root a Food-101-like tree (meta/classes.txt and test/<class>/*.jpg) with n_images synthetic JPEGs
+# spread over num_classes classes, and a crops pickle file with a random square crop per image, in the format
+# written by ensemble_localization.py. Returns the list of (filename, label, (h, w)) of the created images.
+def create_synthetic_dataset(root, n_images, num_classes=101, set="test", crops_filename="cropsdata.pickle",
+                             quality=85, seed=42):
+    rng = np.random.RandomState(seed)
+    dataset_path = os.path.join(root, "dataset-ethz101food")
+    classes = ["class_{:03d}".format(i) for i in range(num_classes)]
+    os.makedirs(os.path.join(dataset_path, "meta"), exist_ok=True)
+    with open(os.path.join(dataset_path, "meta", "classes.txt"), "w") as file:
+        file.write("\n".join(classes) + "\n")
+    # flow_from_directory infers the number of classes from the folders, so all of them are created
+    for label in classes:
+        os.makedirs(os.path.join(dataset_path, set, label), exist_ok=True)
+
+    images = []
+    crops = []
+    for i in range(n_images):
+        label = classes[i % num_classes]
+        h, w = synthetic_image_size(rng)
+        filename = os.path.join(dataset_path, set, label, "{:06d}.jpg".format(i))
+        synthetic_image(h, w, rng).save(filename, quality=quality)
+        images.append((filename, label, (h, w)))
+
+        side = int(min(h, w) * rng.uniform(0.4, 1.0))
+        lower_left = (rng.randint(0, h - side + 1), rng.randint(0, w - side + 1))
+        crops.append(dict(filename=filename, label=label, rect=dict(lower_left=lower_left, side=side)))
+
+    with open(os.path.join(root, crops_filename), "wb") as cropfile:
+        pickle.dump(crops, cropfile, protocol=pickle.HIGHEST_PROTOCOL)
+    return images
@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import multiprocessing
+from queue import Empty
+
+# Calibration of the TensorFlow thread pools: a short benchmark of a workload over a grid of
+# (processes, intra-op threads, inter-op threads) configurations. For every number of processes, the thread
+# configuration with the highest aggregate images/sec is saved per host and model in thread_config_path, and applied
+# by memory_growth_config to the runs with that number of processes per host.
+#   python -m utils.thread_autotuner xception localization
+
+thread_config_path = os.path.join(os.path.expanduser('~'), '.keras', 'thread_config.json')
+
+# FCN input sizes (height, width) of the first scales of process_image on a 384x512 image (VGG16 kernel)
+localization_input_sizes = [(288, 384), (352, 448), (416, 544)]
+
+# seconds a configuration may take (model building, warm-up and timed steps) before it is considered infeasible
+calibration_timeout = 600
+
+
+def host_key():
+    return "{}-{}cpu".format(socket.gethostname(), multiprocessing.cpu_count())
+
+
+# Thread configuration calibrated for processes processes per host, None if that number was not calibrated
+def load_thread_config(model_name, processes=1):
+    if not os.path.exists(thread_config_path):
+        return None
+    with open(thread_config_path) as config_file:
+        configs = json.load(config_file).get(host_key(), {}).get(model_name)
+    if not configs:
+        return None
+    return configs.get("by_processes", {}).get(str(processes))
+
+
+def save_thread_config(model_name, config):
+    configs = {}
+    if os.path.exists(thread_config_path):
+        with open(thread_config_path) as config_file:
+            configs = json.load(config_file)
+    configs.setdefault(host_key(), {})[model_name] = config
+    os.makedirs(os.path.dirname(thread_config_path), exist_ok=True)
+    with open(thread_config_path + '.tmp', 'w') as config_file:
+        json.dump(configs, config_file, indent=2, sort_keys=True)
+    os.replace(thread_config_path + '.tmp', thread_config_path)
+
+
+# Default grid: 1, 2, 4... processes sharing the cores, each with all its share of cores or half of it as intra-op
+# threads, and 1 or 2 inter-op threads
+def default_grid(cpus=None):
+    cpus = cpus or multiprocessing.cpu_count()
+    grid = []
+    processes = 1
+    while processes <= cpus and processes <= 8:
+        for intra in sorted({max(1, cpus // processes), max(1, cpus // processes // 2)}):
+            for inter in (1, 2):
+                grid.append(dict(processes=processes, intra_op_threads=intra, inter_op_threads=inter))
+        processes *= 2
+    return grid
+
+
+# Workloads: build the model and return a function running one step on random data and returning its images
+def localization_workload():
+    import numpy as np
+    from ensemble_localization import convolutionalize_vgg16
+    fcn = convolutionalize_vgg16(None)
+    inputs = [np.random.uniform(-120, 130, (1, h, w, 3)).astype(np.float32) for h, w in localization_input_sizes]
+
+    def step():
+        for x in inputs:
+            fcn.predict(x)
+        return len(inputs)
+    return step
+
+
+def finetuning_workload(batch_size=8):
+    import numpy as np
+    import keras
+    from keras.layers import GlobalAveragePooling2D, Dense
+    from keras.models import Model
+    base_model = keras.applications.xception.Xception(include_top=False, weights=None, input_shape=(299, 299, 3))
+    out = Dense(101, activation='softmax', name='output_layer')(GlobalAveragePooling2D()(base_model.output))
+    model = Model(inputs=base_model.input, outputs=out)
+    model.compile(loss='categorical_crossentropy', optimizer='rmsprop')
+    x = np.random.uniform(-1, 1, (batch_size, 299, 299, 3)).astype(np.float32)
+    y = keras.utils.to_categorical(np.random.randint(0, 101, batch_size), 101)
+
+    def step():
+        model.train_on_batch(x, y)
+        return batch_size
+    return step
+
+
+workloads = dict(localization=localization_workload, xception=finetuning_workload)
+
+
+def _calibration_process(model_name, intra, inter, steps, barrier, queue, timeout):
+    import tensorflow as tf
+    from keras import backend as K
+    K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=intra,
+                                                   inter_op_parallelism_threads=inter)))
+    step = workloads[model_name]()
+    step()  # warm-up: graph optimization and memory allocation
+    barrier.wait(timeout)
+    start = time.time()
+    images = sum(step() for _ in range(steps))
+    queue.put(images / (time.time() - start))
+
+
+# Runs the workload with processes concurrent processes configured with the given threads, returns the aggregate
+# images/sec, None if a process fails (e.g. killed when out of memory) or the configuration takes more than timeout
+# seconds
+def measure(model_name, processes, intra_op_threads, inter_op_threads, steps=5, timeout=calibration_timeout):
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(processes)
+    queue = context.Queue()
+    workers = [context.Process(target=_calibration_process,
+                               args=(model_name, intra_op_threads, inter_op_threads, steps, barrier, queue, timeout))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    deadline = time.time() + timeout
+    rates = []
+    while len(rates) < processes and time.time() < deadline:
+        try:
+            rates.append(queue.get(timeout=1))
+        except Empty:
+            if any(worker.exitcode not in (None, 0) for worker in workers):
+                break
+    for worker in workers:
+        worker.join(max(1, deadline - time.time()))
+        if worker.is_alive():
+            worker.terminate()
+            worker.join()
+    if len(rates) < processes or any(worker.exitcode != 0 for worker in workers):
+        return None
+    return sum(rates)
+
+
+def calibrate(model_name, grid=None, steps=5):
+    results = []
+    for config in grid or default_grid():
+        images_sec = measure(model_name, steps=steps, **config)
+        if images_sec is None:
+            print("{}: {} -> failed, infeasible".format(model_name, config))
+            continue
+        print("{}: {} -> {:.2f} images/sec".format(model_name, config, images_sec))
+        results.append(dict(config, images_sec=images_sec))
+    if not results:
+        print("No feasible configuration for {} on {}".format(model_name, host_key()))
+        return None, results
+    calibrated = time.strftime("%Y-%m-%d %H:%M:%S")
+    by_processes = {}
+    for result in results:
+        key = str(result["processes"])
+        if key not in by_processes or result["images_sec"] > by_processes[key]["images_sec"]:
+            by_processes[key] = dict(result, calibrated=calibrated)
+    best = max(by_processes.values(), key=lambda result: result["images_sec"])
+    save_thread_config(model_name, dict(best=best, by_processes=by_processes))
+    for key in sorted(by_processes, key=int):
+        print("Best configuration for {} on {} with {} processes: {}".format(model_name, host_key(), key,
+                                                                             by_processes[key]))
+    print("Best number of processes for {} on {}: {}".format(model_name, host_key(), best["processes"]))
+    return best, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='TensorFlow thread configuration autotuner')
+    parser.add_argument('models', type=str, nargs='+', choices=sorted(workloads), help='workloads to calibrate')
+    parser.add_argument('--steps', type=int, default=5, help='timed steps per configuration. Default: 5')
+    args = parser.parse_args()
+    sys.path.insert(0, os.getcwd())
+    for model_name in args.models:
+        calibrate(model_name, steps=args.steps)
@@ -0,0 +1,132 @@
+import os
+import pickle
+import tempfile
+import keras
+from keras import backend as K
+
+# attributes holding the internal state of the Keras callbacks used during training
+# (EarlyStopping, ReduceLROnPlateau, ModelCheckpoint)
+callback_state_attributes = ('wait', 'best', 'stopped_epoch', 'cooldown_counter')
+
+
+# Loads a training state snapshot written by TrainingStateSaver
+def load_training_state(filepath):
+    with open(filepath, 'rb') as statefile:
+        return pickle.load(statefile)
+
+
+# Keras History object rebuilt from the history dictionary stored in a snapshot
+def history_from_dict(history_dict):
+    history = keras.callbacks.History()
+    history.history = {key: list(values) for key, values in history_dict.items()}
+    history.epoch = list(range(len(next(iter(history.history.values()), []))))
+    return history
+
+
+# Callback saving a resumable snapshot of a multi-stage fine-tuning: model weights, optimizer slots and learning rate,
+# current stage and epoch, state of the other callbacks and histories of the completed stages.
+# The snapshot is taken at epoch boundaries only (every epoch end and stage end), as the position of the training
+# generators inside an epoch cannot be restored: it is written atomically when taken, and written again by save()
+# (e.g. from a signal handler), so an interrupted run loses at most the epoch in progress. A run is resumed by passing
+# the loaded snapshot as state: the model and the callbacks are restored at the beginning of the first training of
+# the resumed stage, which restarts from the first epoch not completed.
+class TrainingStateSaver(keras.callbacks.Callback):
+
+    def __init__(self, filename, stateful_callbacks=None, config=None, state=None):
+        super(TrainingStateSaver, self).__init__()
+        self.filepath = os.path.join(os.getcwd(), 'models', filename)
+        self.stateful_callbacks = stateful_callbacks or []
+        self.config = config or {}
+        self.stage = 0
+        self.threshold = None
+        self.epoch = 0
+        self.histories = []
+        self.stage_history = {}
+        self.to_restore = None
+        # last snapshot taken, the resumed one until the first epoch end
+        self.snapshot = state
+        if state is not None:
+            self.config = state["config"]
+            self.stage = state["stage"]
+            self.threshold = state["threshold"]
+            self.epoch = state["epoch"]
+            self.histories = state["histories"]
+            self.stage_history = state["stage_history"]
+            self.to_restore = state
+
+    # epoch from which the current stage has to (re)start
+    def begin_stage(self, stage, threshold):
+        if stage != self.stage or self.to_restore is None:
+            self.epoch = 0
+            self.stage_history = {}
+        self.stage = stage
+        self.threshold = threshold
+        return self.epoch
+
+    def end_stage(self, history):
+        self.histories.append(history.history)
+        self.stage += 1
+        self.epoch = 0
+        self.stage_history = {}
+        self.take_snapshot()
+
+    def on_train_begin(self, logs=None):
+        # the other callbacks reset their state in on_train_begin, so this callback has to come after them
+        if self.to_restore is None:
+            return
+        state, self.to_restore = self.to_restore, None
+        self.model.set_weights(state["model_weights"])
+        if state["optimizer_weights"] and len(state["optimizer_weights"]) == len(self.model.optimizer.weights):
+            self.model.optimizer.set_weights(state["optimizer_weights"])
+        if state["optimizer_iterations"] is not None and hasattr(self.model.optimizer, 'iterations'):
+            K.set_value(self.model.optimizer.iterations, state["optimizer_iterations"])
+        if state["lr"] is not None:
+            K.set_value(self.model.optimizer.lr, state["lr"])
+        for callback, callback_state in zip(self.stateful_callbacks, state["callbacks"]):
+            for attribute, value in callback_state.items():
+                setattr(callback, attribute, value)
+        print('Resumed training state at stage {}, epoch {}'.format(self.stage + 1, self.epoch))
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch = epoch + 1
+        for key, value in (logs or {}).items():
+            self.stage_history.setdefault(key, []).append(value)
+        self.take_snapshot()
+
+    # snapshot of the current state, at an epoch boundary, then written
+    def take_snapshot(self):
+        # nothing to take before training started, or before the snapshot being resumed has been restored
+        if self.model is None or self.to_restore is not None:
+            return
+        optimizer = self.model.optimizer
+        self.snapshot = dict(config=self.config,
+                             stage=self.stage,
+                             threshold=self.threshold,
+                             epoch=self.epoch,
+                             histories=self.histories,
+                             stage_history=self.stage_history,
+                             model_weights=self.model.get_weights(),
+                             optimizer_weights=optimizer.get_weights() if optimizer is not None else [],
+                             optimizer_iterations=K.get_value(optimizer.iterations) if hasattr(optimizer, 'iterations') else None,
+                             lr=float(K.get_value(optimizer.lr)) if optimizer is not None else None,
+                             callbacks=[{attribute: getattr(callback, attribute) for attribute in callback_state_attributes
+                                         if hasattr(callback, attribute)} for callback in self.stateful_callbacks])
+        self.save()
+
+    # writes the last snapshot taken
+    def save(self):
+        if self.snapshot is None:
+            return
+        # write and rename, so that a preemption during the dump never leaves a truncated snapshot. Every save has its
+        # own temporary file, as a signal handler may save while another save is writing
+        descriptor, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(self.filepath),
+                                                    prefix=os.path.basename(self.filepath) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as statefile:
+                pickle.dump(self.snapshot, statefile, protocol=pickle.HIGHEST_PROTOCOL)
+                statefile.flush()
+                os.fsync(statefile.fileno())
+            os.replace(tmp_filepath, self.filepath)
+        finally:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
@@ -0,0 +1,135 @@
+import os
+import math
+import numpy as np
+import keras
+from keras.preprocessing import image
+
+# Cheap validation: a fixed class-stratified subset of the validation split, decoded and resized once (cached on disk
+# and in memory across epochs and stages), on which the val_* metrics of every epoch are computed. The whole split
+# is evaluated only every few epochs, in the full_val_* metrics.
+
+# same image formats listed by flow_from_directory
+image_extensions = ('png', 'jpg', 'jpeg', 'bmp', 'ppm')
+# two-sided 95% normal quantile of the confidence intervals
+confidence_z = 1.96
+
+# decoded subsets of this process, by directory, size, images per class and seed
+_subsets = {}
+
+
+# per_class images of every class folder of directory, chosen with a fixed seed. The class indices are the ones
+# of flow_from_directory (sorted class folders)
+def stratified_subset(directory, per_class, seed=42):
+    classes = sorted(d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d)))
+    rng = np.random.RandomState(seed)
+    samples = []
+    for class_ix, class_name in enumerate(classes):
+        filenames = sorted(f for f in os.listdir(os.path.join(directory, class_name))
+                           if f.lower().endswith(image_extensions))
+        for filename in rng.choice(filenames, min(per_class, len(filenames)), replace=False):
+            samples.append((os.path.join(directory, class_name, filename), class_ix))
+    return samples, len(classes)
+
+
+# Images (uint8, resized as flow_from_directory does) and one-hot labels of the subset. The images are decoded once
+# per process and, with cache_dir, stored in a .npy file memory-mapped by the following runs
+def validation_subset(directory, target_size, per_class=20, seed=42, cache_dir=None):
+    key = (os.path.abspath(directory), tuple(target_size), per_class, seed)
+    if key not in _subsets:
+        samples, num_classes = stratified_subset(directory, per_class, seed)
+        images = None
+        cache_filename = None
+        if cache_dir:
+            cache_filename = os.path.join(cache_dir, 'valsubset_{}_{}x{}_{}per_class_seed{}.npy'.format(
+                os.path.basename(os.path.normpath(directory)), target_size[0], target_size[1], per_class, seed))
+            if os.path.exists(cache_filename):
+                images = np.load(cache_filename, mmap_mode='r')
+                if images.shape[0] != len(samples):
+                    images = None
+        if images is None:
+            images = np.empty((len(samples),) + tuple(target_size) + (3,), dtype=np.uint8)
+            for i, (filename, _) in enumerate(samples):
+                images[i] = image.img_to_array(image.load_img(filename, target_size=target_size))
+            if cache_filename:
+                os.makedirs(cache_dir, exist_ok=True)
+                np.save(cache_filename + '.tmp.npy', images)
+                os.replace(cache_filename + '.tmp.npy', cache_filename)
+        labels = keras.utils.to_categorical([class_ix for _, class_ix in samples], num_classes)
+        _subsets[key] = (images, labels)
+    return _subsets[key]
+
+
+# Wilson score interval of an accuracy measured on n samples
+def accuracy_interval(accuracy, n, z=confidence_z):
+    if n == 0:
+        return 0., 1.
+    center = (accuracy + z ** 2 / (2 * n)) / (1 + z ** 2 / n)
+    half_width = z * math.sqrt(accuracy * (1 - accuracy) / n + z ** 2 / (4 * n ** 2)) / (1 + z ** 2 / n)
+    return max(0., center - half_width), min(1., center + half_width)
+
+
+# Callback computing the val_* metrics on the cached subset at every epoch end, with the confidence interval of the
+# accuracy, and the full_val_* metrics on the whole split (full_validation = (generator, steps)) every full_every
+# epochs (nan at the other epochs). It has to come before the callbacks monitoring the val_* metrics.
+class SubsetValidation(keras.callbacks.Callback):
+
+    def __init__(self, images, labels, preprocess_func, batch_size=32, full_validation=None, full_every=None,
+                 workers=1, use_multiprocessing=False):
+        super(SubsetValidation, self).__init__()
+        self.images = images
+        self.labels = labels
+        self.preprocess_func = preprocess_func
+        self.batch_size = batch_size
+        self.full_validation = full_validation
+        self.full_every = full_every
+        self.workers = workers
+        self.use_multiprocessing = use_multiprocessing
+
+    def evaluate(self):
+        totals = None
+        for start in range(0, len(self.images), self.batch_size):
+            x = self.preprocess_func(np.array(self.images[start:start + self.batch_size], dtype=np.float32))
+            values = np.array(self.model.test_on_batch(x, self.labels[start:start + self.batch_size]), ndmin=1)
+            totals = values * len(x) if totals is None else totals + values * len(x)
+        return totals / len(self.images)
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        for name, value in zip(self.model.metrics_names, self.evaluate()):
+            logs['val_' + name] = float(value)
+        low, high = accuracy_interval(logs['val_categorical_accuracy'], len(self.images))
+        logs['val_categorical_accuracy_ci_low'], logs['val_categorical_accuracy_ci_high'] = low, high
+        print('[VALIDATION] subset of {} images: top-1 {:.2f}% (95% CI {:.2f}%-{:.2f}%)'.format(
+            len(self.images), logs['val_categorical_accuracy'] * 100, low * 100, high * 100))
+
+        full = self.full_validation and self.full_every and (epoch + 1) % self.full_every == 0
+        if full:
+            generator, steps = self.full_validation
+            values = np.array(self.model.evaluate_generator(generator, steps, workers=self.workers,
+                                                            use_multiprocessing=self.use_multiprocessing), ndmin=1)
+        for i, name in enumerate(self.model.metrics_names):
+            logs['full_val_' + name] = float(values[i]) if full else float('nan')
+        if full:
+            print('[VALIDATION] full split: top-1 {:.2f}%'.format(logs['full_val_categorical_accuracy'] * 100))
+
+
+# Callback computing the val_* metrics on the whole split (generator, steps) at every epoch end, in the place of the
+# validation of fit_generator, which runs before the callbacks: after AverageReplicaState, it validates the model with
+# the batch normalization statistics averaged across the data parallel ranks. It has to come before the callbacks
+# monitoring the val_* metrics.
+class GeneratorValidation(keras.callbacks.Callback):
+
+    def __init__(self, generator, steps=None, workers=1, use_multiprocessing=False):
+        super(GeneratorValidation, self).__init__()
+        self.generator = generator
+        self.steps = steps
+        self.workers = workers
+        self.use_multiprocessing = use_multiprocessing
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs if logs is not None else {}
+        values = np.array(self.model.evaluate_generator(self.generator, self.steps, workers=self.workers,
+                                                        use_multiprocessing=self.use_multiprocessing), ndmin=1)
+        for name, value in zip(self.model.metrics_names, values):
+            logs['val_' + name] = float(value)
+        print('[VALIDATION] full split: top-1 {:.2f}%'.format(logs['val_categorical_accuracy'] * 100))